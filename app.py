@@ -1,30 +1,150 @@
 """Flask App for Flask Cafe."""
 
+import hashlib
+import os
+
+from flask import Flask, Blueprint, render_template, request, flash, jsonify
+from flask import redirect, session, g, abort, make_response, current_app
+from flask import send_from_directory, url_for
+from markupsafe import Markup
+
+from config import get_config
+from models import db, connect_db, Cafe, City, User, UserSnapshot, Like
+from models import co_likes, LikeState, CafeLikeRollup
+from passwords import PasswordPoolBusy
+from caches import LRUCache
+from fastjson import json_response
+from thumbnails import ThumbnailMaker, ThumbnailError, NAME_RE
+from thumbnails import thumbnail_name
+import assets
+import fulltext
+import likebuffer
+import ratelimit
+import replicas
+import sqlstats
 
-from flask import Flask, render_template, request, flash, jsonify
-from flask import redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy.exc import IntegrityError
 
-from models import db, connect_db, Cafe, City, User, Like
+from forms import AddOrEditCafe, SignupForm, LogInForm, ProfileEditForm
 
-from sqlalchemy.exc import IntegrityError
 
-from secrets import FLASK_SECRET_KEY
+bp = Blueprint('main', __name__, cli_group=None)
 
-from forms import AddOrEditCafe, SignupForm, LogInForm, ProfileEditForm
 
+def create_app(config=None, **settings):
+    """Return a new Flask Cafe app.
+
+    config is a profile name or class from config.py (default: the one
+    named by FLASK_CONFIG); settings override single values in it.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(get_config(config))
+    app.config.update(settings)
+
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError('Set FLASK_SECRET_KEY to run Flask Cafe')
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    # first, so throttled attempts skip every other hook
+    ratelimit.init_app(app)
+    replicas.init_app(app, db)
+    sqlstats.init_app(app)
+    likebuffer.init_app(app, write_buffered_likes)
+    assets.init_app(app)
+
+    user_cache.configure(
+        maxsize=app.config['USER_CACHE_SIZE'],
+        ttl=app.config['USER_CACHE_TTL'],
+    )
+    card_cache.configure(
+        maxsize=app.config['CARD_CACHE_SIZE'],
+        maxbytes=app.config['CARD_CACHE_BYTES'],
+    )
+
+    app.register_blueprint(bp)
+    return app
 
-app = Flask(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///flaskcafe'
-app.config['SECRET_KEY'] = FLASK_SECRET_KEY
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+@bp.cli.command('install-search')
+def install_search():
+    """Add the cafe search index to an existing database."""
+
+    with db.engine.begin() as connection:
+        fulltext.install(connection)
+
+
+@bp.cli.command('reconcile-likes')
+def reconcile_likes():
+    """Rebuild every cafe's like count from the likes table."""
+
+    fixed = Cafe.reconcile_like_counts()
+    db.session.commit()
+    print(f"Fixed like counts for {fixed} cafes.")
+
+
+@bp.cli.command('rebuild-like-rollups')
+def rebuild_like_rollups():
+    """Recount the trending rollups from the likes table."""
+
+    buckets = CafeLikeRollup.rebuild()
+    db.session.commit()
+    print(f"Rebuilt {buckets} like rollup buckets.")
+
+
+@bp.cli.command('prune-like-rollups')
+def prune_like_rollups():
+    """Delete trending rollups too old to be read, and empty ones."""
+
+    pruned = CafeLikeRollup.prune()
+    db.session.commit()
+    print(f"Pruned {pruned} like rollup buckets.")
+
 
-toolbar = DebugToolbarExtension(app)
+@bp.cli.command('make-thumbnails')
+def make_missing_thumbnails():
+    """Make thumbnails for every cafe and user image that has none."""
 
-connect_db(app)
+    if not thumbnail_maker.fetcher(current_app):
+        print("Thumbnails are off (THUMBNAIL_FETCHER isn't set).")
+        return
+
+    made = failed = 0
+    for model in [Cafe, User]:
+        rows = db.session.query(model.id, model.image_url) \
+            .filter(model.thumbnail.is_(None), model.image_url != '') \
+            .all()
+
+        for row_id, image_url in rows:
+            try:
+                thumbnail = thumbnail_maker.make_now(image_url)
+            except ThumbnailError as exc:
+                print(f"Skipped {image_url}: {exc}")
+                failed += 1
+                continue
+
+            model.set_thumbnail(row_id, image_url, thumbnail)
+            db.session.commit()
+            made += 1
+
+    print(f"Made thumbnails for {made} images; {failed} failed.")
+
+
+@bp.cli.command('flush-likes')
+def flush_likes():
+    """Write likes waiting in the like buffer to the database."""
+
+    buffer = current_app.extensions.get('like_buffer')
+    if buffer is None:
+        print("Likes aren't buffered (LIKE_BUFFER_PATH isn't set).")
+        return
+
+    flushed = buffer.flush(write_buffered_likes)
+    print(f"Wrote {flushed} buffered likes.")
 
 
 #######################################
@@ -32,19 +152,42 @@ connect_db(app)
 
 CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
+BUSY_MSG = "We're very busy right now. Please try again in a moment."
+
+# UserSnapshots by user id, shared across requests in this process; sized
+# by create_app
+user_cache = LRUCache()
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add snapshot of curr user to Flask global.
+
+    Handlers that change the user should load the full User themselves and
+    call forget_user afterwards.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user_id = session[CURR_USER_KEY]
+        user = user_cache.get(user_id)
+
+        if user is None:
+            user = UserSnapshot.load(user_id)
+            if user:
+                user_cache.set(user_id, user)
+
+        g.user = user
 
     else:
         g.user = None
 
 
+def forget_user(user_id):
+    """Drop cached snapshot of user, after they've been changed."""
+
+    user_cache.pop(user_id)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -58,46 +201,294 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+#######################################
+# conditional GET
+
+
+def page_etag(version):
+    """Return ETag for this request's page, when its data is at version.
+
+    Pages differ by URL and by who's looking at them (the navbar), so both
+    go into the tag along with version.
+    """
+
+    viewer = f'{g.user.id}:{g.user.get_full_name()}' if g.user else ''
+    raw = '|'.join([
+        current_app.config['ETAG_SALT'],
+        request.full_path,
+        viewer,
+        str(version),
+    ])
+    return hashlib.sha1(raw.encode('utf8')).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    """Return a 304 response if the client's copy of the page is current,
+    else None.
+
+    Last-Modified only identifies the data, not the viewer, so it's only
+    used for anonymous visitors. Pages with pending flash messages are
+    always rendered, so the messages get shown.
+    """
+
+    if '_flashes' in session:
+        return None
+
+    if request.if_none_match:
+        matched = request.if_none_match.contains(etag)
+
+    elif request.if_modified_since and last_modified and not g.user:
+        since = request.if_modified_since.replace(tzinfo=None)
+        matched = last_modified.replace(microsecond=0) <= since
+
+    else:
+        matched = False
+
+    if not matched:
+        return None
+
+    return _set_validators(make_response('', 304), etag, last_modified)
+
+
+def with_validators(html, etag, last_modified):
+    """Return response for html that clients must revalidate with etag
+    (and last_modified, for anonymous visitors)."""
+
+    return _set_validators(make_response(html), etag, last_modified)
+
+
+def _set_validators(response, etag, last_modified):
+    """Set the validator and caching headers shared by a page and its
+    304s, and return response."""
+
+    response.set_etag(etag)
+    if last_modified and not g.user:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
 #######################################
 # homepage
 
-@app.route("/")
+@bp.route("/")
 def homepage():
     """Show homepage."""
 
     return render_template("homepage.html")
 
 
+#######################################
+# static assets
+
+# built asset names change with their content, so clients can keep them
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@bp.app_template_global()
+def asset_url(path):
+    """Return the URL of static file path: its fingerprinted build if
+    there's an asset manifest; see assets.py."""
+
+    manifest, fallbacks = current_app.extensions['assets']
+
+    if path in manifest:
+        return url_for('main.asset', filename=manifest[path])
+    if path in fallbacks:
+        return fallbacks[path]
+    return url_for('static', filename=path)
+
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    """Serve a built asset, precompressed if the client accepts it."""
+
+    return assets.send_asset(
+        os.path.join(current_app.static_folder, assets.DIST),
+        filename,
+        ASSET_MAX_AGE,
+    )
+
+
+#######################################
+# thumbnails
+
+# thumbnail names change with their content, so clients can keep them
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
+
+thumbnail_maker = ThumbnailMaker()
+
+
+def make_thumbnails(obj):
+    """Start making thumbnails of the image of obj, a committed Cafe or
+    User, unless it has them already."""
+
+    if obj.thumbnail or not obj.image_url:
+        return
+
+    model, obj_id, image_url = type(obj), obj.id, obj.image_url
+
+    def save(thumbnail):
+        if thumbnail:
+            model.set_thumbnail(obj_id, image_url, thumbnail)
+            db.session.commit()
+
+    thumbnail_maker.submit(image_url, save)
+
+
+@bp.app_template_global()
+def thumbnail_url(obj, size, ext='jpg'):
+    """Return the URL of obj's size thumbnail (see thumbnails.SIZES), in
+    format ext; or its image_url, until its thumbnails are made."""
+
+    if not obj.thumbnail:
+        return obj.image_url
+
+    return url_for(
+        'main.thumbnail', name=thumbnail_name(obj.thumbnail, size, ext))
+
+
+@bp.route('/thumbnails/<name>')
+def thumbnail(name):
+    """Serve a thumbnail, to be cached for good."""
+
+    if not NAME_RE.match(name):
+        abort(404)
+
+    response = send_from_directory(
+        thumbnail_maker.directory(current_app),
+        name,
+        cache_timeout=THUMBNAIL_MAX_AGE,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 #######################################
 # cafes
 
 
-@app.route('/cafes')
+# rendered cafe/_card.html by cafe id, as (version, html); sized by
+# create_app
+card_cache = LRUCache(sizeof=lambda entry: len(entry[1]))
+
+
+def render_cards(cafes):
+    """Return list of card HTML for cafes, rendering only the cards that
+    aren't cached at the cafe's current version."""
+
+    cities = City.lookup()
+    cards = []
+    misses = 0
+
+    for cafe in cafes:
+        version = (cafe.updated_at, cities.get(cafe.city_code))
+        cached = card_cache.get(cafe.id)
+
+        if cached and cached[0] == version:
+            html = cached[1]
+        else:
+            misses += 1
+            html = render_template('cafe/_card.html', cafe=cafe)
+            card_cache.set(cafe.id, (version, html))
+
+        cards.append(Markup(html))
+
+    g.card_misses = misses
+    return cards
+
+
+@bp.route('/cafes')
 def cafe_list():
-    """Return list of all cafes."""
+    """Return one page of cafes, ordered by name, or most liked first
+    with sort=popular.
 
-    cafes = Cafe.query.order_by('name').all()
+    Takes optional "after" or "before" cursors from the previous page.
+    With "q", returns cafes matching that search instead, best first,
+    paged by "page" number.
+    """
 
-    return render_template(
+    q = request.args.get('q', '').strip()
+    sort = 'popular' if request.args.get('sort') == 'popular' else 'name'
+    per_page = current_app.config['CAFES_PER_PAGE']
+
+    # only the popular order depends on like counts
+    last_modified = Cafe.get_list_version('name' if q else sort)
+    etag = page_etag(last_modified)
+    unchanged = not_modified(etag, last_modified)
+    if unchanged:
+        return unchanged
+
+    if q:
+        page = Cafe.search(
+            q,
+            per_page,
+            page=max(request.args.get('page', 1, type=int), 1),
+        )
+
+    else:
+        try:
+            page = Cafe.get_page(
+                per_page,
+                after=request.args.get('after'),
+                before=request.args.get('before'),
+                sort=sort,
+            )
+        except ValueError:
+            abort(400)
+
+    cards = render_cards(page.items)
+
+    html = render_template(
         'cafe/list.html',
-        cafes=cafes,
+        cafes=page.items,
+        cards=cards,
+        page=page,
+        q=q,
+        sort=sort,
     )
+    response = with_validators(html, etag, last_modified)
+    response.headers['X-Card-Cache'] = \
+        f'{len(cards) - g.card_misses} hit, {g.card_misses} miss'
+    return response
 
 
-@app.route('/cafes/<int:cafe_id>')
+@bp.route('/cafes/<int:cafe_id>')
 def cafe_detail(cafe_id):
-    """Handle form for adding cafe. Redirects to cafe details
-    on successful submit or renders form
-    """
-    cafe = Cafe.query.get_or_404(cafe_id)
+    """Show cafe details, with whether the user likes it, or 304 if the
+    client's copy is current."""
 
-    return render_template(
+    detail = Cafe.get_detail(cafe_id, g.user.id if g.user else None)
+    if detail is None:
+        abort(404)
+
+    liked = detail.liked
+    if g.user:
+        liked = pending_likes(g.user.id).get(cafe_id, liked)
+    # this user's pending like or unlike isn't in the stored count yet
+    like_count = detail.cafe.like_count - detail.liked + liked
+
+    similar = co_likes.similar(
+        cafe_id, current_app.config['RECOMMENDATIONS_COUNT'])
+
+    etag = page_etag((detail.last_modified, liked, like_count, similar))
+    unchanged = not_modified(etag, detail.last_modified)
+    if unchanged:
+        return unchanged
+
+    html = render_template(
         'cafe/detail.html',
-        cafe=cafe,
+        cafe=detail.cafe,
+        liked=liked,
+        like_count=like_count,
+        similar=Cafe.get_names(similar),
     )
+    return with_validators(html, etag, detail.last_modified)
 
 
-@app.route('/cafes/new', methods=["GET", "POST"])
+@bp.route('/cafes/new', methods=["GET", "POST"])
 def add_cafe():
     """Show form for adding cafe."""
 
@@ -113,11 +504,14 @@ def add_cafe():
             url=form.url.data,
             address=form.address.data,
             city_code=form.city_code.data,
-            image_url=form.image_url.data
+            image_url=form.image_url.data,
+            latitude=form.latitude.data,
+            longitude=form.longitude.data,
         )
 
         db.session.add(cafe)
         db.session.commit()
+        make_thumbnails(cafe)
         flash(f"{cafe.name} added!", "success")
         return redirect(f"/cafes/{cafe.id}")
 
@@ -125,7 +519,7 @@ def add_cafe():
         return render_template("/cafe/add-form.html", form=form)
 
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@bp.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
 def edit_cafe(cafe_id):
     """Handle form for editing cafe. Redirects to cafe details
     on successful submit or renders form
@@ -145,8 +539,12 @@ def edit_cafe(cafe_id):
         cafe.address = form.address.data
         cafe.city_code = form.city_code.data
         cafe.image_url = form.image_url.data
+        cafe.latitude = form.latitude.data
+        cafe.longitude = form.longitude.data
 
         db.session.commit()
+        card_cache.pop(cafe.id)
+        make_thumbnails(cafe)
         flash(f"{cafe.name} edited!", "success")
         return redirect(f"/cafes/{cafe.id}")
 
@@ -154,10 +552,197 @@ def edit_cafe(cafe_id):
         return render_template("/cafe/edit-form.html", form=form, cafe=cafe)
 
 
+#######################################
+# cafes API
+
+MAX_API_PER_PAGE = 100
+
+
+def cafe_api_params():
+    """Return (fields, include) asked for by the fields= and include=
+    comma-separated lists. id is always returned. Raises ValueError for
+    names we don't know."""
+
+    fields = ['id']
+    if request.args.get('fields'):
+        names = request.args['fields'].split(',')
+    else:
+        names = Cafe.API_FIELDS
+
+    for name in names:
+        if name not in Cafe.API_FIELDS:
+            raise ValueError(f"Unknown field: {name}")
+        if name not in fields:
+            fields.append(name)
+
+    include = [name for name in request.args.get('include', '').split(',')
+               if name]
+    for name in include:
+        if name not in Cafe.API_INCLUDES:
+            raise ValueError(f"Unknown include: {name}")
+
+    return fields, include
+
+
+def cafe_row_json(row, fields, include):
+    """Return dict for JSON of an api_query row."""
+
+    values = row._asdict()
+    cafe = {name: values[name] for name in fields}
+
+    if 'like_count' in include:
+        cafe['like_count'] = values['like_count']
+    if 'city' in include:
+        cafe['city'] = {
+            'name': values['city_name'],
+            'state': values['city_state'],
+        }
+
+    return cafe
+
+
+@bp.route('/api/cafes')
+def list_cafes_json():
+    """returns JSON {"cafes": [{...}, ...], "next": cursor, "prev": cursor}
+    for one page of cafes, ordered by name or (sort=popular) most liked.
+
+    Takes optional fields= and include= (city, like_count) lists, per_page,
+    and "after" or "before" cursors from the previous page."""
+
+    try:
+        fields, include = cafe_api_params()
+    except ValueError as exc:
+        return json_response({"error": str(exc)}, 400)
+
+    per_page = request.args.get(
+        'per_page', current_app.config['CAFES_PER_PAGE'], type=int)
+    if not 0 < per_page <= MAX_API_PER_PAGE:
+        return json_response({
+            "error": f"per_page must be 1 to {MAX_API_PER_PAGE}"
+            }, 400)
+
+    sort = 'popular' if request.args.get('sort') == 'popular' else 'name'
+
+    try:
+        page = Cafe.get_api_page(
+            fields,
+            include,
+            per_page,
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            sort=sort,
+        )
+    except ValueError as exc:
+        return json_response({"error": str(exc)}, 400)
+
+    return json_response({
+        "cafes": [cafe_row_json(row, fields, include) for row in page],
+        "next": page.next_cursor,
+        "prev": page.prev_cursor,
+        })
+
+
+@bp.route('/api/cafes/<int:cafe_id>')
+def cafe_json(cafe_id):
+    """returns JSON {"cafe": {...}}, with optional fields= and include= as
+    for /api/cafes"""
+
+    try:
+        fields, include = cafe_api_params()
+    except ValueError as exc:
+        return json_response({"error": str(exc)}, 400)
+
+    row = Cafe.api_query(fields, include).filter(Cafe.id == cafe_id).first()
+    if row is None:
+        return json_response({"error": "No such cafe"}, 404)
+
+    return json_response({
+        "cafe": cafe_row_json(row, fields, include),
+        })
+
+
+NEARBY_RADIUS_KM = 2
+MAX_NEARBY_RADIUS_KM = 50
+NEARBY_LIMIT = 10
+MAX_NEARBY_LIMIT = 100
+
+
+@bp.route('/api/cafes/nearby')
+def nearby_cafes():
+    """expects query with lat and lng (and optionally radius in km and
+    limit), returns JSON {"cafes": [{id, name, ..., distance_km}, ...]},
+    nearest first."""
+
+    try:
+        lat = float(request.args["lat"])
+        lng = float(request.args["lng"])
+        radius = float(request.args.get("radius", NEARBY_RADIUS_KM))
+        limit = int(request.args.get("limit", NEARBY_LIMIT))
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lng must be numbers"}), 400
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({"error": "lat or lng out of range"}), 400
+
+    if not 0 < radius <= MAX_NEARBY_RADIUS_KM:
+        return jsonify({
+            "error": f"radius must be up to {MAX_NEARBY_RADIUS_KM} km"
+            }), 400
+
+    if not 0 < limit <= MAX_NEARBY_LIMIT:
+        return jsonify({
+            "error": f"limit must be 1 to {MAX_NEARBY_LIMIT}"
+            }), 400
+
+    cafes = Cafe.nearby(lat, lng, radius, limit)
+
+    return jsonify({
+        "cafes": [
+            dict(cafe._asdict(), distance_km=round(cafe.distance_km, 3))
+            for cafe in cafes
+        ],
+        })
+
+
+TRENDING_LIMIT = 10
+MAX_TRENDING_LIMIT = 100
+
+
+@bp.route('/api/cafes/trending')
+def trending_cafes():
+    """expects query with window, "24h" (the default) or "7d", and
+    optionally limit; returns JSON {"window": window, "cafes": [{id, name,
+    likes}, ...]}, most new likes in the window first."""
+
+    window = request.args.get("window", "24h")
+    if window not in CafeLikeRollup.WINDOWS:
+        return jsonify({
+            "error": f"window must be one of "
+                     f"{', '.join(CafeLikeRollup.WINDOWS)}"
+            }), 400
+
+    try:
+        limit = int(request.args.get("limit", TRENDING_LIMIT))
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+
+    if not 0 < limit <= MAX_TRENDING_LIMIT:
+        return jsonify({
+            "error": f"limit must be 1 to {MAX_TRENDING_LIMIT}"
+            }), 400
+
+    cafes = CafeLikeRollup.trending(window, limit)
+
+    return json_response({
+        "window": window,
+        "cafes": [cafe._asdict() for cafe in cafes],
+        })
+
+
 #######################################
 # Signup, login, and logout
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup_user():
     """Handle form for signing up users. On successful submit,
     adds user, logs them in, and redirects them to cafe list
@@ -174,18 +759,24 @@ def signup_user():
             flash(f"{username} is already taken.")
             return render_template("/auth/signup-form.html", form=form)
 
-        user = User.register(
-            username=form.username.data,
-            first_name=form.first_name.data,
-            last_name=form.last_name.data,
-            description=form.description.data,
-            email=form.email.data,
-            image_url=form.image_url.data,
-            password=form.password.data
-        )
+        try:
+            user = User.register(
+                username=form.username.data,
+                first_name=form.first_name.data,
+                last_name=form.last_name.data,
+                description=form.description.data,
+                email=form.email.data,
+                image_url=form.image_url.data,
+                password=form.password.data
+            )
+        except PasswordPoolBusy:
+            flash(BUSY_MSG, "danger")
+            return render_template("/auth/signup-form.html", form=form), 503
 
         db.session.add(user)
         db.session.commit()
+        forget_user(user.id)
+        make_thumbnails(user)
 
         do_login(user)
         flash(f"You are signed up and logged in.", "success")
@@ -195,7 +786,7 @@ def signup_user():
         return render_template("/auth/signup-form.html", form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login_user():
     """Handle form for logging in users. On successful submit,
     logs user in, and redirects them to cafe list
@@ -208,9 +799,15 @@ def login_user():
         username = form.username.data
         password = form.password.data
 
-        user = User.authenticate(username, password)
+        try:
+            user = User.authenticate(username, password)
+        except PasswordPoolBusy:
+            flash(BUSY_MSG, "danger")
+            return render_template("/auth/login-form.html", form=form), 503
 
         if user:
+            # saves a rehashed password, if authenticate made one
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.get_full_name()}!")
             return redirect("/cafes")
@@ -220,7 +817,7 @@ def login_user():
     return render_template("/auth/login-form.html", form=form)
 
 
-@app.route('/logout', methods=["POST"])
+@bp.route('/logout', methods=["POST"])
 def logout():
     """logs out user and redirects them to homepage with flashed message"""
 
@@ -232,7 +829,7 @@ def logout():
 #######################################
 # profiles
 
-@app.route('/profile')
+@bp.route('/profile')
 def user_details():
     """send user to login page if not logged in. show profile page"""
 
@@ -240,10 +837,23 @@ def user_details():
         flash(NOT_LOGGED_IN_MSG)
         return redirect('/login')
 
-    return render_template('/profile/detail.html', user=g.user)
+    user = User.query.options(db.defer(User.hashed_password)).get(g.user.id)
+    liked = Like.get_liked_page(
+        user.id, current_app.config['LIKED_CAFES_PER_PAGE'])
 
+    suggested = co_likes.suggest(
+        user.id, current_app.config['RECOMMENDATIONS_COUNT'])
 
-@app.route('/profile/edit', methods=["GET", "POST"])
+    return render_template(
+        '/profile/detail.html',
+        user=user,
+        liked=liked,
+        liked_count=Like.count_for(user.id),
+        suggested=Cafe.get_names(suggested),
+    )
+
+
+@bp.route('/profile/edit', methods=["GET", "POST"])
 def edit_user():
     """Process profile edit. On successful submit, redirects to
     profile page with flashed message. Or shows form."""
@@ -252,7 +862,7 @@ def edit_user():
         flash(NOT_LOGGED_IN_MSG)
         return redirect('/login')
 
-    user = User.query.get(session[CURR_USER_KEY])
+    user = User.query.get(g.user.id)
 
     form = ProfileEditForm(obj=user)
 
@@ -264,6 +874,8 @@ def edit_user():
         user.image_url = form.image_url.data
 
         db.session.commit()
+        forget_user(user.id)
+        make_thumbnails(user)
         flash("Profile edited.", "success")
         return redirect("/profile")
 
@@ -274,47 +886,200 @@ def edit_user():
 #######################################
 # likes API
 
-@app.route('/api/likes')
+MAX_LIKES_BATCH = 100
+
+
+@bp.route('/api/likes')
 def user_likes_cafe():
     """expects query with cafe_id, returns JSON {"likes": True/False} depending
-    on whether the user has liked the cafe"""
+    on whether the user has liked the cafe.
+
+    Or expects cafe_ids as a comma-separated list (up to MAX_LIKES_BATCH),
+    returns JSON {"likes": {cafe_id: True/False, ...}} from one query."""
+
+    if "cafe_ids" in request.args:
+        try:
+            cafe_ids = {
+                int(cafe_id)
+                for cafe_id in request.args["cafe_ids"].split(",")
+                if cafe_id
+            }
+        except ValueError:
+            return jsonify({"error": "cafe_ids must be integers"}), 400
+
+        if len(cafe_ids) > MAX_LIKES_BATCH:
+            return jsonify({
+                "error": f"At most {MAX_LIKES_BATCH} cafe_ids per request"
+                }), 400
+
+        if not g.user:
+            return jsonify({"error": "Not logged in"})
+
+        likes = g.user.likes_cafes(cafe_ids)
+        likes.update(
+            (cafe_id, liked)
+            for cafe_id, liked in pending_likes(g.user.id).items()
+            if cafe_id in cafe_ids
+        )
+        return jsonify({
+            "likes": likes,
+            })
 
     cafe_id = int(request.args["cafe_id"])
 
     if not g.user:
         return jsonify({"error": "Not logged in"})
 
+    pending = pending_likes(g.user.id)
+    if cafe_id in pending:
+        return jsonify({"likes": pending[cafe_id]})
+
     return jsonify({
         "likes": g.user.likes_cafe(cafe_id),
         })
 
 
-@app.route('/api/like', methods=["POST"])
+@bp.route('/api/profile/likes')
+def more_liked_cafes():
+    """expects query with "after", the cursor from the profile page or the
+    previous call; returns JSON {"cafes": [{id, name, liked_at}, ...],
+    "next": cursor} for the next page of cafes the user likes."""
+
+    if not g.user:
+        return json_response({"error": "Not logged in"})
+
+    try:
+        page = Like.get_liked_page(
+            g.user.id,
+            current_app.config['LIKED_CAFES_PER_PAGE'],
+            after=request.args.get('after'),
+        )
+    except ValueError as exc:
+        return json_response({"error": str(exc)}, 400)
+
+    return json_response({
+        "cafes": [
+            {"id": cafe_id, "name": name, "liked_at": created_at}
+            for cafe_id, name, created_at in page
+        ],
+        "next": page.next_cursor,
+        })
+
+
+def remember_like(user_id, cafe_id, state):
+    """Update recommendations after a committed like write."""
+
+    if state.changed and state.liked:
+        co_likes.add(user_id, cafe_id)
+    elif state.changed:
+        co_likes.remove(user_id, cafe_id)
+
+
+def pending_likes(user_id):
+    """Return {cafe_id: liked} for user's likes and unlikes still waiting
+    in the like buffer, if there is one."""
+
+    buffer = current_app.extensions.get('like_buffer')
+    if buffer is None:
+        return {}
+    return buffer.pending_for(user_id)
+
+
+def write_like(user_id, cafe_id, op):
+    """Like, unlike or toggle (op 'add', 'remove' or 'toggle') cafe for
+    user; returns a LikeState, or None if there's no such cafe.
+
+    With a like buffer (see likebuffer.py) the write is logged for the
+    next flush, and the LikeState counts it, rather than committed now.
+    """
+
+    buffer = current_app.extensions.get('like_buffer')
+
+    if buffer is None:
+        state = getattr(Like, op)(user_id, cafe_id)
+        if state is not None:
+            db.session.commit()
+            remember_like(user_id, cafe_id, state)
+        return state
+
+    stored = None
+
+    def read_stored():
+        nonlocal stored
+        stored = Like.get_state(user_id, cafe_id)
+        return None if stored is None else stored.liked
+
+    outcome = buffer.record(user_id, cafe_id, op, read_stored)
+    if outcome is None:
+        return None
+
+    liked, changed = outcome
+    return LikeState(
+        liked, stored.like_count - stored.liked + liked, changed)
+
+
+def write_buffered_likes(operations):
+    """Commit a batch of likes and unlikes from the like buffer."""
+
+    for user_id, cafe_id, state in Like.write_batch(operations):
+        remember_like(user_id, cafe_id, state)
+
+
+def _like_state_json(state, **extra):
+    return jsonify({
+        **extra,
+        "likes": state.liked,
+        "like_count": state.like_count,
+        })
+
+
+@bp.route('/api/like', methods=["POST"])
 def like_cafe():
-    """adds like with current user id and posted cafe id
+    """adds like with current user id and posted cafe id, if there isn't
+    one already; returns JSON {"liked": cafe_id, "likes": True,
+    "like_count": n}
     """
     cafe_id = int(request.json["cafe_id"])
 
     if not g.user:
         return jsonify({"error": "Not logged in"})
 
-    like = Like(user_id=g.user.id, cafe_id=cafe_id)
+    state = write_like(g.user.id, cafe_id, 'add')
+    if state is None:
+        return jsonify({"error": "No such cafe"}), 404
 
-    db.session.add(like)
-    db.session.commit()
+    return _like_state_json(state, liked=cafe_id)
 
-    return jsonify({"liked": cafe_id})
 
-
-@app.route('/api/unlike', methods=["POST"])
+@bp.route('/api/unlike', methods=["POST"])
 def unlike_cafe():
-    """removes like with current user id and posted cafe id"""
+    """removes like with current user id and posted cafe id, if there is
+    one; returns JSON {"unliked": cafe_id, "likes": False, "like_count": n}
+    """
     cafe_id = int(request.json["cafe_id"])
 
     if not g.user:
         return jsonify({"error": "Not logged in"})
-    like = Like.query.filter_by(user_id=g.user.id, cafe_id=cafe_id).first()
-    db.session.delete(like)
-    db.session.commit()
 
-    return jsonify({"unliked": cafe_id})
+    state = write_like(g.user.id, cafe_id, 'remove')
+    if state is None:
+        return jsonify({"error": "No such cafe"}), 404
+
+    return _like_state_json(state, unliked=cafe_id)
+
+
+@bp.route('/api/like/toggle', methods=["POST"])
+def toggle_like_cafe():
+    """likes posted cafe for current user if they don't, else unlikes it;
+    returns JSON {"likes": True/False, "like_count": n}
+    """
+    cafe_id = int(request.json["cafe_id"])
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"})
+
+    state = write_like(g.user.id, cafe_id, 'toggle')
+    if state is None:
+        return jsonify({"error": "No such cafe"}), 404
+
+    return _like_state_json(state)
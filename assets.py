@@ -0,0 +1,208 @@
+"""Static asset build for Flask Cafe.
+
+    python assets.py vendor   # download the pinned VENDOR files
+    python assets.py build    # fingerprint and compress static/
+
+vendor downloads the third-party CSS and JS the pages use, at pinned
+versions, into static/vendor/, to be committed. build copies every file in
+static/ to static/dist/ with a hash of its content in its name
+(app.js -> app.3f9a0c1b2d4e.js), writes gzip and (if the brotli package is
+installed) brotli copies of the text ones, and records the names in
+static/dist/manifest.json.
+
+Templates link assets with asset_url('js/app.js'). With a manifest (see
+ASSET_MANIFEST) that's the fingerprinted copy, served precompressed for
+the client's Accept-Encoding and cached for good; a changed file gets a
+new name. Without one it's the file in static/, as in development. A
+VENDOR file that hasn't been downloaded is linked from its pinned CDN URL.
+"""
+
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import urllib.request
+
+from flask import request, send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+# static path: pinned source
+VENDOR = {
+    'vendor/bootswatch-journal-4.5.3.min.css':
+        'https://unpkg.com/bootswatch@4.5.3/dist/journal/bootstrap.min.css',
+    'vendor/jquery-3.5.1.min.js':
+        'https://unpkg.com/jquery@3.5.1/dist/jquery.min.js',
+    'vendor/bootstrap-4.5.3.bundle.min.js':
+        'https://unpkg.com/bootstrap@4.5.3/dist/js/bootstrap.bundle.min.js',
+    'vendor/axios-0.21.1.min.js':
+        'https://unpkg.com/axios@0.21.1/dist/axios.min.js',
+}
+
+# worth compressing; images already are
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.map'}
+
+# extension: Content-Encoding, best first
+ENCODINGS = [('.br', 'br'), ('.gz', 'gzip')]
+
+
+def vendor(static_dir=STATIC_DIR):
+    """Download each VENDOR file that isn't in static_dir yet."""
+
+    for path, url in VENDOR.items():
+        dest = os.path.join(static_dir, path)
+        if os.path.exists(dest):
+            continue
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        with open(dest, 'wb') as f:
+            f.write(data)
+        print(f'{path}: {len(data)} bytes from {url}')
+
+
+def fingerprint(path, data):
+    """Return path with a hash of data before its extension."""
+
+    root, ext = os.path.splitext(path)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build(static_dir=STATIC_DIR):
+    """Fingerprint and compress every file in static_dir into its dist/
+    folder, and write the manifest there. Returns the manifest, as
+    {static path: fingerprinted path}."""
+
+    dist_dir = os.path.join(static_dir, DIST)
+    manifest = {}
+
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        if dirpath == static_dir:
+            dirnames[:] = [name for name in dirnames if name != DIST]
+
+        for filename in sorted(filenames):
+            source = os.path.join(dirpath, filename)
+            path = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            built = fingerprint(path, data)
+            manifest[path] = built
+            dest = os.path.join(dist_dir, built)
+            if os.path.exists(dest):
+                continue
+
+            if os.path.splitext(path)[1] in COMPRESSIBLE:
+                # mtime=0 keeps rebuilds byte-identical
+                _write(f'{dest}.gz', gzip.compress(data, 9, mtime=0))
+                if brotli is not None:
+                    _write(f'{dest}.br', brotli.compress(data))
+            _write(dest, data)
+
+    _write(
+        os.path.join(dist_dir, MANIFEST),
+        json.dumps(manifest, indent=2, sort_keys=True).encode('utf8'),
+    )
+    return manifest
+
+
+def load_manifest(path):
+    """Return the manifest at path, or {} if it hasn't been built."""
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def init_app(app):
+    """Load app's asset manifest, from ASSET_MANIFEST (a path relative to
+    the app's folder; None to serve files from static/ as they are)."""
+
+    app.config.setdefault('ASSET_MANIFEST', None)
+
+    manifest = {}
+    if app.config['ASSET_MANIFEST']:
+        manifest = load_manifest(
+            os.path.join(app.root_path, app.config['ASSET_MANIFEST']))
+
+    # vendor files not downloaded yet come from their pinned CDN URLs
+    fallbacks = {
+        path: url for path, url in VENDOR.items()
+        if not os.path.exists(os.path.join(app.static_folder, path))
+    }
+
+    app.extensions['assets'] = (manifest, fallbacks)
+
+
+def send_asset(dist_dir, filename, max_age):
+    """Return a response with the fingerprinted file filename from
+    dist_dir, precompressed for the request's Accept-Encoding if possible,
+    to be cached for max_age seconds without revalidating."""
+
+    path = safe_join(dist_dir, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for ext, name in ENCODINGS:
+        if request.accept_encodings[name] and os.path.isfile(path + ext):
+            path += ext
+            encoding = name
+            break
+
+    response = send_file(
+        path, mimetype=mimetype, conditional=True, cache_timeout=max_age)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def main(argv=None):
+    """Run a build step from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('step', choices=['vendor', 'build'])
+    parser.add_argument('--static', default=STATIC_DIR)
+    args = parser.parse_args(argv)
+
+    if args.step == 'vendor':
+        vendor(args.static)
+    else:
+        manifest = build(args.static)
+        if brotli is None:
+            print('brotli not installed; wrote gzip only', file=sys.stderr)
+        print(f'Built {len(manifest)} assets.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""In-process caches for Flask Cafe."""
+
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe mapping that evicts its least recently used entries.
+
+    Holds at most maxsize entries and, if maxbytes is given, at most that
+    many bytes of values as measured by sizeof. If ttl (seconds) is given,
+    entries older than that are treated as missing. Keeps hit/miss counts
+    in stats().
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if missing or expired."""
+
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store value under key, evicting old entries if full."""
+
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        size = self.sizeof(value) if self.maxbytes else 0
+
+        if self.maxbytes and size > self.maxbytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expires)
+            self._bytes += size
+
+            while len(self._data) > self.maxsize or (
+                    self.maxbytes and self._bytes > self.maxbytes):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        """Remove key, if present; caller holds the lock."""
+
+        try:
+            value, _ = self._data.pop(key)
+        except KeyError:
+            return None
+
+        if self.maxbytes:
+            self._bytes -= self.sizeof(value)
+        return value
+
+    def pop(self, key, default=None):
+        """Remove key and return its value (or default)."""
+
+        with self._lock:
+            value = self._remove(key)
+            return default if value is None else value
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def configure(self, maxsize=1024, ttl=None, maxbytes=None):
+        """Set new limits, as for __init__, and drop every entry."""
+
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.maxbytes = maxbytes
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return a dict of size, bytes, hit and miss counts."""
+
+        return {
+            "size": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class VersionedCache:
+    """Holds one value built by loader(), rebuilt after invalidate().
+
+    Each invalidate() bumps version; the value is rebuilt lazily on the next
+    get(). If ttl (seconds) is given, the value is also rebuilt once it's
+    that old, to pick up changes made by other processes.
+    """
+
+    def __init__(self, loader, ttl=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = 0
+        self._value = None
+        self._loaded_version = None
+        self._expires = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the cached value, loading it if stale."""
+
+        with self._lock:
+            stale = (
+                self._loaded_version != self.version
+                or (self._expires is not None
+                    and self._expires < time.monotonic())
+            )
+            if stale:
+                version = self.version
+                self._value = self.loader()
+                self._loaded_version = version
+                if self.ttl:
+                    self._expires = time.monotonic() + self.ttl
+            return self._value
+
+    def invalidate(self):
+        """Mark the cached value stale."""
+
+        with self._lock:
+            self.version += 1
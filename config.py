@@ -0,0 +1,120 @@
+"""Settings profiles for Flask Cafe; see create_app in app.py.
+
+Pick one with the FLASK_CONFIG environment variable ("development",
+"testing" or "production"; default "development"). Production takes its
+secrets from the environment: DATABASE_URL and FLASK_SECRET_KEY.
+"""
+
+
+import os
+
+
+def _local_secret_key():
+    """Return FLASK_SECRET_KEY from the untracked secrets.py, if there is
+    one."""
+
+    try:
+        from secrets import FLASK_SECRET_KEY
+    except ImportError:
+        return None
+    return FLASK_SECRET_KEY
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'postgres:///flaskcafe')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SECRET_KEY = os.environ.get('FLASK_SECRET_KEY')
+
+    # flask-debugtoolbar is only imported if this is on
+    DEBUG_TOOLBAR = False
+
+    CAFES_PER_PAGE = 24
+    LIKED_CAFES_PER_PAGE = 20
+    RECOMMENDATIONS_COUNT = 5
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60
+    BCRYPT_LOG_ROUNDS = 12
+    PASSWORD_POOL_SIZE = 2
+    PASSWORD_QUEUE_DEPTH = 16
+    # change to make clients refetch pages after a deploy changes templates
+    ETAG_SALT = ''
+    CARD_CACHE_SIZE = 10000
+    CARD_CACHE_BYTES = 16 * 1024 * 1024
+    # if set, like writes go to a log file here and are committed in
+    # batches; see likebuffer.py
+    LIKE_BUFFER_PATH = os.environ.get('LIKE_BUFFER_PATH')
+    LIKE_BUFFER_FLUSH_SECONDS = 1.0
+    LIKE_BUFFER_FLUSH_SIZE = 500
+    # see thumbnails.py; None makes no thumbnails
+    THUMBNAIL_FETCHER = 'url'
+    THUMBNAIL_DIR = os.environ.get('THUMBNAIL_DIR')
+    THUMBNAIL_POOL_SIZE = 2
+    THUMBNAIL_QUEUE_DEPTH = 32
+    THUMBNAIL_MAX_SOURCE_BYTES = 20 * 1024 * 1024
+    # written by `python assets.py build`; None serves static/ as is
+    ASSET_MANIFEST = 'static/dist/manifest.json'
+    # endpoint: {'ip' or 'username': (burst, tokens a second)}; see
+    # ratelimit.py
+    RATE_LIMITS = {
+        'main.login_user': {'ip': (20, 20 / 60), 'username': (5, 1 / 60)},
+        'main.signup_user': {'ip': (5, 1 / 720)},
+    }
+    # a file path shares buckets between processes; None keeps them in each
+    RATE_LIMIT_STORAGE = os.environ.get('RATE_LIMIT_STORAGE')
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar, and every request's SQL logged."""
+
+    # a fixed key is fine for local sessions; never use this profile to
+    # serve real users
+    SECRET_KEY = Config.SECRET_KEY or _local_secret_key() or 'development'
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+    SQL_STATS_SAMPLE_RATE = 1.0
+    # edits to static files show up without a rebuild
+    ASSET_MANIFEST = None
+
+
+class TestingConfig(Config):
+    """tests.py: a separate database, no CSRF and cheap password hashes."""
+
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///flaskcafe-test'
+    SECRET_KEY = 'testing'
+    # Make Flask errors be real errors, rather than HTML pages with error info
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    LIKE_BUFFER_PATH = None
+    # tests that want thumbnails use a LocalFileFetcher
+    THUMBNAIL_FETCHER = None
+    THUMBNAIL_POOL_SIZE = 0
+    ASSET_MANIFEST = None
+    RATE_LIMIT_ENABLED = False
+
+
+class ProductionConfig(Config):
+    """Serving real users, from wsgi.py."""
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def get_config(config=None):
+    """Return the config class for config: a profile name, or a class
+    (returned as is). By default, the profile named by FLASK_CONFIG."""
+
+    if config is None:
+        config = os.environ.get('FLASK_CONFIG', 'development')
+
+    if isinstance(config, str):
+        return PROFILES[config]
+
+    return config
@@ -0,0 +1,47 @@
+"""Compact JSON responses for Flask Cafe's read API.
+
+Uses orjson, which is several times faster than the json module, if it's
+installed; otherwise json with compact separators. Either way datetimes
+come out in ISO 8601.
+"""
+
+
+import json
+from datetime import date
+
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(obj):
+    """Return obj as JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(
+        obj,
+        separators=(',', ':'),
+        ensure_ascii=False,
+        default=_default,
+    ).encode('utf8')
+
+
+def json_response(obj, status=200):
+    """Return a response with obj as its JSON body."""
+
+    return current_app.response_class(
+        dumps(obj),
+        status=status,
+        mimetype='application/json',
+    )
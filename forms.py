@@ -1,7 +1,22 @@
 """Forms for Flask Cafe."""
 from flask_wtf import FlaskForm
 from wtforms import StringField, SelectField, TextAreaField, PasswordField
+from wtforms import FloatField
 from wtforms.validators import InputRequired, Optional, URL, Email, Length
+from wtforms.validators import NumberRange, ValidationError
+
+from passwords import MAX_PASSWORD_BYTES
+
+
+def max_bytes(limit):
+    """Validator: field's data is at most limit bytes as UTF-8."""
+
+    def _max_bytes(form, field):
+        if field.data and len(field.data.encode('utf8')) > limit:
+            raise ValidationError(
+                f'Field cannot be longer than {limit} bytes.')
+
+    return _max_bytes
 
 
 class AddOrEditCafe(FlaskForm):
@@ -30,6 +45,14 @@ class AddOrEditCafe(FlaskForm):
         "Image URL",
         validators=[Optional(), URL()]
     )
+    latitude = FloatField(
+        "Latitude",
+        validators=[Optional(), NumberRange(min=-90, max=90)]
+    )
+    longitude = FloatField(
+        "Longitude",
+        validators=[Optional(), NumberRange(min=-180, max=180)]
+    )
 
 
 class SignupForm(FlaskForm):
@@ -61,7 +84,8 @@ class SignupForm(FlaskForm):
     )
     password = PasswordField(
         "Password",
-        validators=[InputRequired(), Length(min=6)]
+        validators=[
+            InputRequired(), Length(min=6), max_bytes(MAX_PASSWORD_BYTES)]
     )
 
 
@@ -74,7 +98,7 @@ class LogInForm(FlaskForm):
     )
     password = PasswordField(
         "Password",
-        validators=[InputRequired()]
+        validators=[InputRequired(), max_bytes(MAX_PASSWORD_BYTES)]
     )
 
 
@@ -0,0 +1,123 @@
+"""Full-text search over cafes.
+
+On Postgres, cafes get a generated tsvector column with a GIN index; on
+SQLite, an external-content FTS5 table kept in step by triggers. Either
+way a search is an index probe, not a scan of cafes.
+"""
+
+
+import re
+
+from sqlalchemy import DDL, event, text
+
+
+POSTGRES_DDL = [
+    """ALTER TABLE cafes ADD COLUMN IF NOT EXISTS search_vector tsvector
+       GENERATED ALWAYS AS (
+           setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+           setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+           setweight(to_tsvector('english', coalesce(address, '')), 'C')
+       ) STORED""",
+    """CREATE INDEX IF NOT EXISTS ix_cafes_search_vector
+       ON cafes USING gin (search_vector)""",
+]
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS cafes_fts USING fts5(
+           name, description, address, content='cafes', content_rowid='id'
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS cafes_fts_ai AFTER INSERT ON cafes BEGIN
+           INSERT INTO cafes_fts (rowid, name, description, address)
+           VALUES (new.id, new.name, new.description, new.address);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS cafes_fts_ad AFTER DELETE ON cafes BEGIN
+           INSERT INTO cafes_fts (cafes_fts, rowid, name, description, address)
+           VALUES ('delete', old.id, old.name, old.description, old.address);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS cafes_fts_au AFTER UPDATE ON cafes BEGIN
+           INSERT INTO cafes_fts (cafes_fts, rowid, name, description, address)
+           VALUES ('delete', old.id, old.name, old.description, old.address);
+           INSERT INTO cafes_fts (rowid, name, description, address)
+           VALUES (new.id, new.name, new.description, new.address);
+       END""",
+]
+
+SQLITE_DROP_DDL = [
+    "DROP TABLE IF EXISTS cafes_fts",
+]
+
+# ranked matches, best first; :limit and :offset page through them
+POSTGRES_MATCH = """
+    SELECT cafes.*
+    FROM cafes, websearch_to_tsquery('english', :q) AS query
+    WHERE cafes.search_vector @@ query
+    ORDER BY ts_rank(cafes.search_vector, query) DESC, cafes.id
+    LIMIT :limit OFFSET :offset
+"""
+
+SQLITE_MATCH = """
+    SELECT cafes.*
+    FROM cafes_fts JOIN cafes ON cafes.id = cafes_fts.rowid
+    WHERE cafes_fts MATCH :q
+    ORDER BY bm25(cafes_fts, 10.0, 5.0, 1.0), cafes.id
+    LIMIT :limit OFFSET :offset
+"""
+
+
+def attach(table):
+    """Create (and drop) the search index along with the cafes table."""
+
+    for statement in POSTGRES_DDL:
+        event.listen(
+            table,
+            'after_create',
+            DDL(statement).execute_if(dialect='postgresql'),
+        )
+
+    for statement in SQLITE_DDL:
+        event.listen(
+            table,
+            'after_create',
+            DDL(statement).execute_if(dialect='sqlite'),
+        )
+
+    for statement in SQLITE_DROP_DDL:
+        event.listen(
+            table,
+            'before_drop',
+            DDL(statement).execute_if(dialect='sqlite'),
+        )
+
+
+def install(connection):
+    """Add the search index to an existing database and fill it in."""
+
+    dialect = connection.dialect.name
+
+    if dialect == 'postgresql':
+        for statement in POSTGRES_DDL:
+            connection.execute(text(statement))
+
+    elif dialect == 'sqlite':
+        for statement in SQLITE_DDL:
+            connection.execute(text(statement))
+        connection.execute(
+            text("INSERT INTO cafes_fts (cafes_fts) VALUES ('rebuild')"))
+
+
+def match_query(q, dialect):
+    """Return (sql, search string) for q on dialect, or None if q has
+    nothing to search for."""
+
+    if dialect == 'postgresql':
+        q = q.strip()
+        return (POSTGRES_MATCH, q) if q else None
+
+    if dialect == 'sqlite':
+        # quote each word so FTS5 doesn't read user input as query syntax
+        words = re.findall(r'\w+', q)
+        if not words:
+            return None
+        return SQLITE_MATCH, ' '.join(f'"{word}"' for word in words)
+
+    raise NotImplementedError(f'no cafe search for {dialect}')
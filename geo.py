@@ -0,0 +1,106 @@
+"""Geohashes and distances, for finding cafes near a point.
+
+A geohash names a cell of a grid over the earth; each extra character
+splits the cell into 32, and a cell's hash is a prefix of the hashes of
+every point inside it. So "cafes in cell abc" is the indexed prefix query
+geohash LIKE 'abc%', and the cafes within r km of a point are among those
+in the 3x3 block of cells around it, at a precision whose cells are at
+least r km across. covering_cells finds that block; distance_km then
+weeds out the cafes in its corners.
+"""
+
+
+from math import asin, cos, radians, sin, sqrt
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# stored precision: cells of about 5m x 5m
+PRECISION = 9
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+
+def encode(lat, lng, precision=PRECISION):
+    """Return the geohash of lat/lng, precision characters long."""
+
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    n_bits = 0
+    use_lng = True
+
+    while len(chars) < precision:
+        if use_lng:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                bits = bits * 2 + 1
+                lng_lo = mid
+            else:
+                bits = bits * 2
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                bits = bits * 2 + 1
+                lat_lo = mid
+            else:
+                bits = bits * 2
+                lat_hi = mid
+
+        use_lng = not use_lng
+        n_bits += 1
+        if n_bits == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            n_bits = 0
+
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """Return (degrees of latitude, degrees of longitude) spanned by a
+    cell of precision characters."""
+
+    n_bits = precision * 5
+    lat_bits = n_bits // 2
+    lng_bits = n_bits - lat_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def covering_cells(lat, lng, radius_km):
+    """Return the geohash prefixes of a block of cells that holds every
+    point within radius_km of lat/lng: the point's own cell and its
+    neighbours, at the finest precision that's wide enough."""
+
+    # longitude degrees shrink towards the poles
+    lng_km = KM_PER_DEGREE * max(cos(radians(lat)), 0.01)
+
+    precision = 1
+    for p in range(PRECISION, 0, -1):
+        lat_span, lng_span = cell_size(p)
+        if lat_span * KM_PER_DEGREE >= radius_km and \
+                lng_span * lng_km >= radius_km:
+            precision = p
+            break
+
+    lat_span, lng_span = cell_size(precision)
+    cells = set()
+    for dlat in (-lat_span, 0, lat_span):
+        for dlng in (-lng_span, 0, lng_span):
+            cell_lat = min(max(lat + dlat, -90.0), 90.0)
+            cell_lng = (lng + dlng + 180.0) % 360.0 - 180.0
+            cells.add(encode(cell_lat, cell_lng, precision))
+
+    return sorted(cells)
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Return the great-circle distance between two points, in km."""
+
+    lat1, lng1, lat2, lng2 = map(radians, (lat1, lng1, lat2, lng2))
+    h = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(h)))
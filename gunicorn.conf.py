@@ -0,0 +1,46 @@
+"""gunicorn settings for Flask Cafe.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded once in the master (preload_app) and its objects are
+frozen out of the garbage collector before each fork, so collections in
+the workers don't touch, and copy, the pages they share with the master.
+"""
+
+import gc
+import multiprocessing
+import os
+import time
+
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+
+
+def when_ready(server):
+    import wsgi
+
+    server.log.info(
+        'app preloaded in %.0f ms', wsgi.boot_seconds * 1000)
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+    worker.forked_at = time.monotonic()
+
+
+def post_fork(server, worker):
+    import wsgi
+
+    wsgi.after_fork(wsgi.app)
+
+
+def post_worker_init(worker):
+    worker.log.info(
+        'worker %s ready %.0f ms after fork',
+        worker.pid,
+        (time.monotonic() - worker.forked_at) * 1000,
+    )
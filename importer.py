@@ -0,0 +1,442 @@
+"""Bulk import of cities, cafes and users from CSV or NDJSON.
+
+Unlike seed.py, this keeps the existing data. Input is streamed, so memory
+use doesn't grow with file size. Rows are validated with the same rules as
+the web forms, then written a chunk at a time: with COPY on Postgres and
+executemany elsewhere. Each chunk commits along with a checkpoint, so
+rerunning after a failure picks up where the last good chunk left off.
+
+    python importer.py cities cities.csv
+    python importer.py cafes cafes.ndjson --chunk-size 5000
+
+The "locations" kind instead backfills the coordinates of existing cafes
+from records of id, latitude and longitude:
+
+    python importer.py locations cafe-locations.csv
+"""
+
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+from werkzeug.datastructures import MultiDict
+
+from app import create_app
+from forms import AddOrEditCafe, SignupForm
+from models import (
+    db, passwords, City, Cafe, User, ImportCheckpoint,
+    city_table,
+)
+
+
+DEFAULT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 20
+
+DEFAULT_CAFE_IMAGE = Cafe.__table__.c.image_url.default.arg
+DEFAULT_USER_IMAGE = User.__table__.c.image_url.default.arg
+
+
+#######################################
+# reading
+
+
+def read_records(path, fmt=None):
+    """Yield each record in path as a dict of strings.
+
+    fmt is "csv" or "ndjson"; by default it's guessed from the extension.
+    """
+
+    if fmt is None:
+        fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    with open(path, newline='', encoding='utf8') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+#######################################
+# validating
+
+
+def _form_errors(form):
+    return '; '.join(
+        f'{name}: {", ".join(errors)}' for name, errors in form.errors.items()
+    )
+
+
+def _formdata(record):
+    return MultiDict({
+        key: '' if value is None else str(value)
+        for key, value in record.items()
+    })
+
+
+def validate_city(record):
+    """Return row for cities table, or raise ValueError."""
+
+    code = (record.get('code') or '').strip()
+    name = (record.get('name') or '').strip()
+    state = (record.get('state') or '').strip()
+
+    if not code or not name or len(state) != 2:
+        raise ValueError('code and name are required; state is 2 letters')
+
+    return {'code': code, 'name': name, 'state': state.upper()}
+
+
+def validate_cafe(record):
+    """Return row for cafes table, or raise ValueError.
+
+    Uses the rules of AddOrEditCafe.
+    """
+
+    form = AddOrEditCafe(formdata=_formdata(record), meta={'csrf': False})
+    form.city_code.choices = City.cities()
+
+    if not form.validate():
+        raise ValueError(_form_errors(form))
+
+    return {
+        'name': form.name.data,
+        'description': form.description.data or '',
+        'url': form.url.data or '',
+        'address': form.address.data,
+        'city_code': form.city_code.data,
+        'image_url': form.image_url.data or DEFAULT_CAFE_IMAGE,
+        'latitude': form.latitude.data,
+        'longitude': form.longitude.data,
+        'geohash': Cafe.geohash_for(form.latitude.data, form.longitude.data),
+    }
+
+
+def validate_user(record):
+    """Return row for users table, or raise ValueError.
+
+    Uses the rules of SignupForm, except that a record may give a bcrypt
+    hashed_password instead of a password. A password is kept as given, for
+    _hash_passwords to hash with the rest of its chunk.
+    """
+
+    form = SignupForm(formdata=_formdata(record), meta={'csrf': False})
+    hashed = record.get('hashed_password')
+
+    if hashed:
+        del form.password
+
+    if not form.validate():
+        raise ValueError(_form_errors(form))
+
+    return {
+        'username': form.username.data,
+        'first_name': form.first_name.data,
+        'last_name': form.last_name.data,
+        'description': form.description.data or '',
+        'email': form.email.data,
+        'image_url': form.image_url.data or DEFAULT_USER_IMAGE,
+        'hashed_password': hashed or None,
+        'password': None if hashed else form.password.data,
+        'admin': False,
+    }
+
+
+def validate_location(record):
+    """Return (cafe_id, latitude, longitude), or raise ValueError."""
+
+    try:
+        location = (
+            int(record['id']),
+            float(record['latitude']),
+            float(record['longitude']),
+        )
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('id, latitude and longitude must be numbers')
+
+    if not (-90 <= location[1] <= 90 and -180 <= location[2] <= 180):
+        raise ValueError('latitude or longitude out of range')
+
+    return location
+
+
+def _existing_usernames(rows):
+    usernames = [row['username'] for row in rows]
+    return {
+        username for (username,) in db.session.query(User.username)
+        .filter(User.username.in_(usernames))
+    }
+
+
+def _hash_passwords(rows):
+    """Set the hashed_password of user rows given a password, hashing them
+    all at once, and drop their password keys."""
+
+    unhashed = [row for row in rows if row['hashed_password'] is None]
+    hashes = passwords.hash_many([row['password'] for row in unhashed])
+    for row, hashed in zip(unhashed, hashes):
+        row['hashed_password'] = hashed
+    for row in rows:
+        del row['password']
+
+
+KINDS = {
+    'cities': (City.__table__, validate_city),
+    'cafes': (Cafe.__table__, validate_cafe),
+    'users': (User.__table__, validate_user),
+}
+
+
+#######################################
+# writing
+
+
+def _copy_value(value):
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return value
+
+
+def write_rows(table, rows):
+    """Insert rows (dicts with the same keys) into table, in the session's
+    transaction, with COPY on Postgres and executemany otherwise."""
+
+    connection = db.session.connection()
+
+    if connection.dialect.name != 'postgresql':
+        connection.execute(table.insert(), rows)
+        return
+
+    # COPY skips the Python-side column defaults that insert() would apply
+    defaults = {}
+    for column in table.columns:
+        default = column.default
+        if column.key not in rows[0] and default is not None:
+            if default.is_callable:
+                defaults[column.key] = default.arg(None)
+            elif default.is_scalar:
+                defaults[column.key] = default.arg
+
+    columns = list(rows[0]) + list(defaults)
+    rows = [{**row, **defaults} for row in rows]
+    nullable = [
+        col for col in columns if any(row[col] is None for row in rows)
+    ]
+    buffer = io.StringIO()
+    # quote everything, so empty strings aren't read as NULLs
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    for row in rows:
+        writer.writerow([_copy_value(row[col]) for col in columns])
+    buffer.seek(0)
+
+    # ...and read the empty strings written for Nones as NULLs after all
+    options = 'FORMAT csv'
+    if nullable:
+        options += f', FORCE_NULL ({", ".join(nullable)})'
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f'COPY {table.name} ({", ".join(columns)}) FROM STDIN ({options})',
+        buffer,
+    )
+
+
+#######################################
+# importing
+
+
+class ImportStats:
+    """Counts for one run of import_file."""
+
+    def __init__(self, skipped=0):
+        self.skipped = skipped
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+        self.started = time.monotonic()
+
+    @property
+    def rate(self):
+        """Rows read per second so far."""
+
+        elapsed = time.monotonic() - self.started
+        read = self.inserted + self.rejected
+        return read / elapsed if elapsed else 0.0
+
+    def __repr__(self):
+        return (
+            f'<ImportStats inserted={self.inserted} rejected={self.rejected}'
+            f' skipped={self.skipped}>'
+        )
+
+
+def import_file(kind, path, fmt=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                source=None, report=None):
+    """Import every record in path as kind ("cities", "cafes" or "users").
+
+    Rows before the checkpoint for source (default: kind and absolute
+    path) are skipped. report, if given, is called with the ImportStats
+    after each chunk. Returns the ImportStats.
+    """
+
+    table, validate = KINDS[kind]
+    source = source or f'{kind}:{os.path.abspath(path)}'
+
+    checkpoint = ImportCheckpoint.query.get(source)
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(source=source, rows_done=0)
+        db.session.add(checkpoint)
+    done = checkpoint.rows_done
+
+    stats = ImportStats(skipped=done)
+    chunk = []
+
+    def reject(line, error):
+        stats.rejected += 1
+        if len(stats.errors) < MAX_REPORTED_ERRORS:
+            stats.errors.append(f'row {line}: {error}')
+
+    def flush(rows_done):
+        rows = [row for line, row in chunk]
+
+        if kind == 'users' and rows:
+            taken = _existing_usernames(rows)
+            rows = []
+            for line, row in chunk:
+                if row['username'] in taken:
+                    reject(line, f'username {row["username"]} is taken')
+                else:
+                    taken.add(row['username'])
+                    rows.append(row)
+            _hash_passwords(rows)
+
+        if rows:
+            write_rows(table, rows)
+        checkpoint.rows_done = rows_done
+        db.session.commit()
+
+        stats.inserted += len(rows)
+        chunk.clear()
+
+        if kind == 'cities':
+            # COPY doesn't go through the ORM events that would do this
+            city_table.invalidate()
+        if report:
+            report(stats)
+
+    line = 0
+    for line, record in enumerate(read_records(path, fmt), start=1):
+        if line <= done:
+            continue
+
+        try:
+            chunk.append((line, validate(record)))
+        except ValueError as exc:
+            reject(line, exc)
+
+        if len(chunk) >= chunk_size:
+            flush(line)
+
+    if chunk or line > checkpoint.rows_done:
+        flush(line)
+
+    return stats
+
+
+def import_locations(path, fmt=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                     report=None):
+    """Set the latitude/longitude of existing cafes from the records in
+    path, which have id, latitude and longitude.
+
+    Updates are safe to repeat, so there's no checkpoint. report is as for
+    import_file. Returns the ImportStats; inserted counts cafes updated.
+    """
+
+    stats = ImportStats()
+    chunk = []
+
+    def flush():
+        Cafe.set_locations(chunk)
+        db.session.commit()
+        stats.inserted += len(chunk)
+        chunk.clear()
+        if report:
+            report(stats)
+
+    for line, record in enumerate(read_records(path, fmt), start=1):
+        try:
+            chunk.append(validate_location(record))
+        except ValueError as exc:
+            stats.rejected += 1
+            if len(stats.errors) < MAX_REPORTED_ERRORS:
+                stats.errors.append(f'row {line}: {exc}')
+
+        if len(chunk) >= chunk_size:
+            flush()
+
+    if chunk:
+        flush()
+
+    return stats
+
+
+def main(argv=None):
+    """Run the importer from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('kind', choices=sorted([*KINDS, 'locations']))
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=['csv', 'ndjson'])
+    parser.add_argument(
+        '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument(
+        '--database', help="default: the FLASK_CONFIG profile's database")
+    args = parser.parse_args(argv)
+
+    settings = {}
+    if args.database:
+        settings['SQLALCHEMY_DATABASE_URI'] = args.database
+    app = create_app(**settings)
+
+    def report(stats):
+        print(
+            f'{stats.inserted} inserted, {stats.rejected} rejected '
+            f'({stats.rate:.0f} rows/s)',
+            file=sys.stderr,
+        )
+
+    with app.app_context():
+        db.create_all()
+        if args.kind == 'locations':
+            stats = import_locations(
+                args.path,
+                fmt=args.format,
+                chunk_size=args.chunk_size,
+                report=report,
+            )
+        else:
+            stats = import_file(
+                args.kind,
+                args.path,
+                fmt=args.format,
+                chunk_size=args.chunk_size,
+                report=report,
+            )
+
+    for error in stats.errors:
+        print(error, file=sys.stderr)
+    print(
+        f'Done: {stats.inserted} inserted, {stats.rejected} rejected, '
+        f'{stats.skipped} already imported ({stats.rate:.0f} rows/s).'
+    )
+
+
+if __name__ == '__main__':
+    main()
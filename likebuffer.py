@@ -0,0 +1,344 @@
+"""Write-behind buffer for likes, for Flask Cafe.
+
+When LIKE_BUFFER_PATH is set, like and unlike clicks don't each commit a
+transaction. Instead they're appended to a log file at that path, and
+fsync'd before the response. A background thread in each process flushes
+the log into the likes table every LIKE_BUFFER_FLUSH_SECONDS, or sooner
+once LIKE_BUFFER_FLUSH_SIZE operations are waiting, in one transaction.
+Only the final state of each (user, cafe) pair is written.
+
+The log is shared by every process on the host, under flock of a separate
+".lock" file. A flush holds that lock only to rename the log to a
+".flushing" segment and start a new one; the database write happens
+after, so likes keep being logged meanwhile. The segment is deleted once
+its write commits, and until then its operations are still pending: a
+segment left behind by a crash, restart or failed write is written first
+by the next flush. Pending operations are visible through pending_for, so
+a user's own likes show up at once.
+
+Log format: a header line "flaskcafe-likes <epoch>", then one
+"<user_id> <cafe_id> <1|0>" line per operation. Every log starts a new
+epoch, so every process knows to drop what it had read.
+"""
+
+
+import fcntl
+import logging
+import os
+import threading
+import uuid
+
+
+logger = logging.getLogger('flaskcafe.likebuffer')
+
+HEADER = b'flaskcafe-likes'
+
+
+def parse(data, into):
+    """Add the operations in log lines data to into, as {(user_id,
+    cafe_id): liked}."""
+
+    for line in data.splitlines():
+        try:
+            user_id, cafe_id, liked = map(int, line.split())
+        except ValueError:
+            logger.warning('skipping bad like log line %r', line)
+            continue
+        into[(user_id, cafe_id)] = bool(liked)
+
+
+class LikeBuffer:
+    """Durable, coalescing log of like operations waiting to be written."""
+
+    def __init__(self, path, flush_size=500):
+        self.path = path
+        self.segment_path = f'{path}.flushing'
+        self.flush_size = flush_size
+        self.wake = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._lock_file = None
+        self._flush_lock_file = None
+        self._file = None
+        self._header = None
+        self._offset = 0
+        # {(user_id, cafe_id): liked}, as read from the log
+        self._pending = {}
+        # the same for the segment being flushed, and its header
+        self._flushing = {}
+        self._segment_header = None
+
+    def _open(self):
+        """Open the lock files for this process (not shared with a
+        parent)."""
+
+        if self._pid != os.getpid():
+            self._lock_file = open(f'{self.path}.lock', 'a+b')
+            self._flush_lock_file = open(f'{self.path}.flushlock', 'a+b')
+            self._file = None
+            self._pid = os.getpid()
+
+    def _open_log(self):
+        """(Re)open the log, if a flush has replaced it since; caller holds
+        the locks."""
+
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+
+        if self._file is not None and \
+                os.fstat(self._file.fileno()).st_ino != inode:
+            self._file.close()
+            self._file = None
+
+        if self._file is None:
+            self._file = open(self.path, 'a+b')
+            self._header = None
+
+    def _read_new(self):
+        """Read operations appended since last time, starting over if the
+        log was flushed, and the segment being flushed, if it's changed;
+        caller holds the locks."""
+
+        self._open_log()
+        self._file.seek(0)
+        header = self._file.readline()
+
+        if header != self._header:
+            self._header = header
+            self._offset = len(header)
+            self._pending = {}
+
+        self._file.seek(self._offset)
+        data = self._file.read()
+        # a crash can leave a partial last line; it's ignored
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        parse(data, self._pending)
+
+        try:
+            with open(self.segment_path, 'rb') as segment:
+                # segments are never appended to, so one header is one set
+                # of operations
+                header = segment.readline()
+                if header != self._segment_header:
+                    data = segment.read()
+                    self._segment_header = header
+                    self._flushing = {}
+                    parse(data[:data.rfind(b'\n') + 1], self._flushing)
+        except FileNotFoundError:
+            self._segment_header = None
+            self._flushing = {}
+
+    def _locked(self, operation):
+        """Context manager holding this process's lock and flock."""
+
+        buffer = self
+
+        class Locked:
+            def __enter__(self):
+                buffer._lock.acquire()
+                buffer._open()
+                fcntl.flock(buffer._lock_file, operation)
+
+            def __exit__(self, *exc_info):
+                fcntl.flock(buffer._lock_file, fcntl.LOCK_UN)
+                buffer._lock.release()
+
+        return Locked()
+
+    def record(self, user_id, cafe_id, op, read_stored):
+        """Durably log like write op ('add', 'remove' or 'toggle') for user
+        and cafe.
+
+        read_stored() returns whether the likes table has user liking cafe,
+        or None if there's no such cafe. It's called with the log locked,
+        so no flush can commit, and stop counting as pending, between that
+        read and this op being logged.
+
+        Returns (liked, changed): whether user now likes cafe, counting
+        pending operations, and whether this op changed that; or None,
+        logging nothing, if read_stored() returned None.
+        """
+
+        with self._locked(fcntl.LOCK_EX):
+            self._read_new()
+
+            stored_liked = read_stored()
+            if stored_liked is None:
+                return None
+
+            key = (user_id, cafe_id)
+            was_liked = self._pending.get(
+                key, self._flushing.get(key, stored_liked))
+            if op == 'toggle':
+                liked = not was_liked
+            else:
+                liked = op == 'add'
+            if liked == was_liked:
+                return liked, False
+
+            line = f'{user_id} {cafe_id} {int(liked)}\n'.encode('ascii')
+            if not self._header.endswith(b'\n'):
+                # a new log, or a crash while starting one
+                self._file.truncate(0)
+                self._header = self._new_header()
+                line = self._header + line
+                self._offset = len(self._header)
+            elif self._offset < self._file.seek(0, os.SEEK_END):
+                # end the partial line a crash left behind
+                line = b'\n' + line
+
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            self._offset = self._file.tell()
+            self._pending[(user_id, cafe_id)] = liked
+            waiting = len(self._pending)
+
+        if waiting >= self.flush_size:
+            self.wake.set()
+
+        return liked, True
+
+    def pending_for(self, user_id):
+        """Return {cafe_id: liked} for user's operations not yet written."""
+
+        with self._locked(fcntl.LOCK_SH):
+            self._read_new()
+            return {
+                cafe_id: liked
+                for pending in [self._flushing, self._pending]
+                for (pending_user_id, cafe_id), liked in pending.items()
+                if pending_user_id == user_id
+            }
+
+    def flush(self, write):
+        """Pass every pending operation, as {(user_id, cafe_id): liked}, to
+        write, then forget them. If write raises, they're kept for the next
+        try. Only one flush, in any process, runs at a time; others return
+        at once.
+
+        Returns the number of operations written.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                self._open()
+            try:
+                fcntl.flock(
+                    self._flush_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+
+            try:
+                # a segment left by an earlier flush goes first, in order
+                written = self._flush_segment(write, rotate=False)
+                return written + self._flush_segment(write, rotate=True)
+            finally:
+                fcntl.flock(self._flush_lock_file, fcntl.LOCK_UN)
+
+    def _flush_segment(self, write, rotate):
+        """Write the segment being flushed, after first making the log it
+        if rotate; caller holds the flush locks."""
+
+        with self._locked(fcntl.LOCK_EX):
+            self._read_new()
+            if rotate and self._pending and self._segment_header is None:
+                self._rotate()
+            operations = dict(self._flushing)
+
+        if not operations:
+            return 0
+
+        # the log's lock isn't held, so likes are logged meanwhile
+        write(operations)
+
+        with self._locked(fcntl.LOCK_EX):
+            os.unlink(self.segment_path)
+            self._fsync_dir()
+            self._segment_header = None
+            self._flushing = {}
+
+        return len(operations)
+
+    def _rotate(self):
+        """Make the log the segment to flush, and start a new log; caller
+        holds the locks."""
+
+        os.rename(self.path, self.segment_path)
+        self._segment_header = self._header
+        self._flushing = self._pending
+
+        self._file.close()
+        self._file = open(self.path, 'a+b')
+        self._header = self._new_header()
+        self._file.write(self._header)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._fsync_dir()
+        self._offset = len(self._header)
+        self._pending = {}
+
+    def _fsync_dir(self):
+        """Make renames and deletes in the log's folder durable."""
+
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _new_header():
+        return HEADER + b' ' + uuid.uuid4().hex.encode('ascii') + b'\n'
+
+
+def start_flusher(app, buffer, write):
+    """Start a daemon thread that flushes buffer with write, in an app
+    context, on app's timer or when woken."""
+
+    interval = app.config['LIKE_BUFFER_FLUSH_SECONDS']
+
+    def run():
+        while True:
+            buffer.wake.wait(interval)
+            buffer.wake.clear()
+            try:
+                with app.app_context():
+                    buffer.flush(write)
+            except Exception:
+                logger.exception('flushing likes failed; will retry')
+
+    thread = threading.Thread(target=run, name='like-flusher', daemon=True)
+    thread.start()
+    return thread
+
+
+def init_app(app, write):
+    """Buffer app's like writes if LIKE_BUFFER_PATH is set; write is
+    called with each batch of operations and must commit them."""
+
+    app.config.setdefault('LIKE_BUFFER_PATH', None)
+    app.config.setdefault('LIKE_BUFFER_FLUSH_SECONDS', 1.0)
+    app.config.setdefault('LIKE_BUFFER_FLUSH_SIZE', 500)
+
+    if not app.config['LIKE_BUFFER_PATH']:
+        return
+
+    buffer = LikeBuffer(
+        app.config['LIKE_BUFFER_PATH'],
+        flush_size=app.config['LIKE_BUFFER_FLUSH_SIZE'],
+    )
+    app.extensions['like_buffer'] = buffer
+    flushers = {}
+
+    @app.before_request
+    def ensure_like_flusher():
+        """Start this process's flusher (threads don't survive a fork)."""
+
+        if os.getpid() not in flushers:
+            flushers[os.getpid()] = start_flusher(app, buffer, write)
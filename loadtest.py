@@ -0,0 +1,477 @@
+"""Load test for Flask Cafe's main user journeys.
+
+Generates a reproducible dataset, starts the app in a separate process
+against it, then has concurrent virtual users run the journeys described
+in a scenario file (see loadtest.json) for a while. Reports requests/s,
+latency percentiles and DB queries per request for each endpoint, as JSON
+so runs can be compared.
+
+    python loadtest.py run --output before.json
+    python loadtest.py run --no-generate --duration 60 --output after.json
+
+The database named by --database is dropped and rebuilt unless
+--no-generate is given, so don't point it at real data.
+"""
+
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import requests
+
+
+DEFAULT_DATABASE = 'postgresql:///flaskcafe-loadtest'
+DEFAULT_SCENARIO = 'loadtest.json'
+DEFAULT_PORT = 5099
+
+PASSWORD = 'loadtest'
+QUERY_COUNT_HEADER = 'X-DB-Queries'  # set by sqlstats
+
+WORDS = [
+    'bean', 'roast', 'brew', 'crema', 'latte', 'mocha', 'drip', 'pour',
+    'steam', 'grind', 'corner', 'harbor', 'sunny', 'little', 'blue',
+    'golden', 'quiet', 'market', 'garden', 'velvet',
+]
+STATES = ['CA', 'NY', 'OR', 'WA', 'TX', 'IL', 'MA', 'CO']
+
+
+#######################################
+# dataset
+
+
+def _words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def generate_dataset(spec, seed, chunk_size=1000):
+    """Drop and rebuild every table, filled with a dataset of spec's size.
+
+    The same spec and seed always give the same data.
+    """
+
+    from importer import write_rows
+    from models import db, passwords, City, Cafe, User, Like
+    from models import CafeLikeRollup
+
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    def insert(table, rows):
+        for i in range(0, len(rows), chunk_size):
+            write_rows(table, rows[i:i + chunk_size])
+            db.session.commit()
+
+    cities = [
+        {
+            'code': f'city{i}',
+            'name': f'{_words(rng, 1).title()} City {i}',
+            'state': rng.choice(STATES),
+        }
+        for i in range(spec['cities'])
+    ]
+    insert(City.__table__, cities)
+
+    # somewhere in the continental US, for each city
+    centres = {
+        city['code']: (rng.uniform(30, 47), rng.uniform(-122, -75))
+        for city in cities
+    }
+
+    def cafe(i):
+        city_code = rng.choice(cities)['code']
+        lat, lng = centres[city_code]
+        lat += rng.uniform(-0.1, 0.1)
+        lng += rng.uniform(-0.1, 0.1)
+        return {
+            'name': f'{_words(rng, 2).title()} {i}',
+            'description': _words(rng, 12),
+            'url': f'https://cafe{i}.example.com/',
+            'address': f'{rng.randint(1, 9999)} {_words(rng, 1).title()} St',
+            'city_code': city_code,
+            'image_url': '/static/images/default-cafe.jpg',
+            'latitude': lat,
+            'longitude': lng,
+            'geohash': Cafe.geohash_for(lat, lng),
+        }
+
+    insert(Cafe.__table__, [cafe(i) for i in range(spec['cafes'])])
+
+    # one cheap hash shared by every user keeps generation fast
+    hashed = passwords.hash(PASSWORD)
+    insert(User.__table__, [
+        {
+            'username': f'loaduser{i}',
+            'admin': False,
+            'email': f'loaduser{i}@example.com',
+            'first_name': 'Load',
+            'last_name': f'User{i}',
+            'description': _words(rng, 8),
+            'image_url': '/static/images/default-pic.png',
+            'hashed_password': hashed,
+        }
+        for i in range(spec['users'])
+    ])
+
+    cafe_ids = [id for (id,) in db.session.query(Cafe.id).order_by(Cafe.id)]
+    user_ids = [id for (id,) in db.session.query(User.id).order_by(User.id)]
+    per_user = min(spec['likes_per_user'], len(cafe_ids))
+
+    insert(Like.__table__, [
+        {'user_id': user_id, 'cafe_id': cafe_id}
+        for user_id in user_ids
+        for cafe_id in rng.sample(cafe_ids, per_user)
+    ])
+
+    Cafe.reconcile_like_counts()
+    CafeLikeRollup.rebuild()
+    db.session.commit()
+
+
+def dataset_summary():
+    """Return what the virtual users need to know about the dataset."""
+
+    from models import db, Cafe, User
+
+    return {
+        'cafe_ids': [id for (id,) in db.session.query(Cafe.id)],
+        'usernames': [name for (name,) in db.session.query(User.username)],
+        'locations': [
+            list(location) for location in
+            db.session.query(Cafe.latitude, Cafe.longitude)
+            .filter(Cafe.latitude.isnot(None))
+            .limit(1000)
+        ],
+    }
+
+
+#######################################
+# server
+
+
+def make_app(database, **settings):
+    """Return the app as load tested: the production profile, against
+    database; settings override single values in it."""
+
+    from app import create_app
+
+    return create_app(
+        'production',
+        SQLALCHEMY_DATABASE_URI=database,
+        SECRET_KEY='loadtest',
+        WTF_CSRF_ENABLED=False,
+        **settings,
+    )
+
+
+def serve(database, port):
+    """Run the app on port against database, until killed."""
+
+    # every virtual user logs in from 127.0.0.1, as one of a few hundred
+    # users; throttled, most logins would fail and the journeys after
+    # them would measure "Not logged in"
+    app = make_app(database, RATE_LIMIT_ENABLED=False)
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app.run(port=port, threaded=True, use_reloader=False, debug=False)
+
+
+def start_server(database, port):
+    """Start serve() in a child process; return it once it's answering.
+
+    The server gets its own process group, so stop_server can take down
+    any processes it starts too.
+    """
+
+    server = subprocess.Popen(
+        [
+            sys.executable, __file__, 'serve',
+            '--database', database,
+            '--port', str(port),
+        ],
+        start_new_session=True,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+
+    for _ in range(100):
+        try:
+            requests.get(base_url + '/', timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    stop_server(server)
+    raise RuntimeError('load test server did not start')
+
+
+def stop_server(server):
+    """Stop a server from start_server, and its children."""
+
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+
+
+#######################################
+# virtual users
+
+
+def _step(name, rng, data, cafe_id):
+    """Return (endpoint label, method, path, request kwargs) for a step.
+
+    Steps about one cafe are about cafe_id.
+    """
+
+    if name == 'list':
+        return 'GET /cafes', 'GET', '/cafes', {}
+    if name == 'list_popular':
+        return 'GET /cafes?sort=popular', 'GET', '/cafes?sort=popular', {}
+    if name == 'search':
+        return 'GET /cafes?q=', 'GET', '/cafes', {
+            'params': {'q': _words(rng, 1)}}
+    if name == 'nearby':
+        lat, lng = rng.choice(data['locations'])
+        return 'GET /api/cafes/nearby', 'GET', '/api/cafes/nearby', {
+            'params': {'lat': lat, 'lng': lng}}
+    if name == 'detail':
+        return 'GET /cafes/<id>', 'GET', f'/cafes/{cafe_id}', {}
+    if name == 'likes_status':
+        return 'GET /api/likes', 'GET', '/api/likes', {
+            'params': {'cafe_id': cafe_id}}
+    if name == 'like':
+        return 'POST /api/like', 'POST', '/api/like', {
+            'json': {'cafe_id': cafe_id}}
+    if name == 'unlike':
+        return 'POST /api/unlike', 'POST', '/api/unlike', {
+            'json': {'cafe_id': cafe_id}}
+    if name == 'login':
+        return 'POST /login', 'POST', '/login', {'data': {
+            'username': rng.choice(data['usernames']),
+            'password': PASSWORD,
+        }}
+    if name == 'profile':
+        return 'GET /profile', 'GET', '/profile', {}
+    if name == 'edit_profile':
+        return 'POST /profile/edit', 'POST', '/profile/edit', {'data': {
+            'first_name': 'Load',
+            'last_name': _words(rng, 1).title(),
+            'description': _words(rng, 8),
+            'email': 'edited@example.com',
+            'image_url': '',
+        }}
+
+    raise ValueError(f'unknown step {name!r}')
+
+
+def virtual_user(base_url, scenario, data, seed, record_after, stop_at,
+                 samples):
+    """Run weighted random journeys until stop_at, appending
+    (label, status, seconds, queries) to samples for requests started after
+    record_after."""
+
+    rng = random.Random(seed)
+    session = requests.Session()
+    journeys = scenario['journeys']
+    weights = [journey.get('weight', 1) for journey in journeys]
+    logged_in = False
+
+    while time.monotonic() < stop_at:
+        journey = rng.choices(journeys, weights)[0]
+        steps = list(journey['steps'])
+        cafe_id = rng.choice(data['cafe_ids'])
+
+        if journey.get('login') and not logged_in:
+            steps.insert(0, 'login')
+
+        for name in steps:
+            label, method, path, kwargs = _step(name, rng, data, cafe_id)
+            started = time.monotonic()
+
+            try:
+                resp = session.request(
+                    method, base_url + path,
+                    allow_redirects=False,
+                    timeout=30,
+                    **kwargs,
+                )
+                status = resp.status_code
+                queries = resp.headers.get(QUERY_COUNT_HEADER)
+                queries = int(queries) if queries is not None else None
+            except requests.RequestException:
+                status, queries = None, None
+
+            if name == 'login':
+                logged_in = status == 302
+
+            if started >= record_after:
+                samples.append(
+                    (label, status, time.monotonic() - started, queries))
+
+
+#######################################
+# reporting
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values (nearest rank)."""
+
+    if not values:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def summarize(samples, seconds):
+    """Return per-endpoint and total stats for samples over seconds."""
+
+    by_label = defaultdict(list)
+    for sample in samples:
+        by_label[sample[0]].append(sample)
+
+    def stats(rows):
+        times = sorted(row[2] * 1000 for row in rows)
+        queries = [row[3] for row in rows if row[3] is not None]
+        errors = sum(1 for row in rows if row[1] is None or row[1] >= 400)
+
+        return {
+            'requests': len(rows),
+            'errors': errors,
+            'rps': round(len(rows) / seconds, 2),
+            'mean_ms': round(sum(times) / len(times), 2),
+            'p50_ms': round(percentile(times, 50), 2),
+            'p95_ms': round(percentile(times, 95), 2),
+            'p99_ms': round(percentile(times, 99), 2),
+            'max_ms': round(times[-1], 2),
+            'queries_per_request':
+                round(sum(queries) / len(queries), 2) if queries else None,
+        }
+
+    return {
+        'totals': stats(samples) if samples else None,
+        'endpoints': {
+            label: stats(rows) for label, rows in sorted(by_label.items())
+        },
+    }
+
+
+def run(scenario_path, database, port, generate=True, duration=None,
+        concurrency=None):
+    """Run the load test in scenario_path; return the results dict."""
+
+    with open(scenario_path) as f:
+        scenario = json.load(f)
+
+    seed = scenario.get('seed', 0)
+    duration = duration or scenario.get('duration', 30)
+    warmup = scenario.get('warmup', 0)
+    concurrency = concurrency or scenario.get('concurrency', 4)
+
+    from models import db
+
+    # the dataset's passwords are hashed here, inline
+    app = make_app(database, PASSWORD_POOL_SIZE=0)
+
+    with app.app_context():
+        if generate:
+            generate_dataset(scenario['dataset'], seed)
+        data = dataset_summary()
+        db.session.remove()
+
+    server = start_server(database, port)
+    samples = []
+    started_at = datetime.now(timezone.utc)
+
+    try:
+        now = time.monotonic()
+        record_after = now + warmup
+        stop_at = record_after + duration
+
+        users = [
+            threading.Thread(target=virtual_user, args=(
+                f'http://127.0.0.1:{port}', scenario, data, seed + i,
+                record_after, stop_at, samples,
+            ))
+            for i in range(concurrency)
+        ]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+
+    finally:
+        stop_server(server)
+
+    return {
+        'scenario': scenario_path,
+        'started_at': started_at.isoformat(),
+        'seed': seed,
+        'duration': duration,
+        'concurrency': concurrency,
+        'dataset': scenario['dataset'],
+        **summarize(samples, duration),
+    }
+
+
+def main(argv=None):
+    """Run the load test from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run a load test')
+    run_parser.add_argument('--scenario', default=DEFAULT_SCENARIO)
+    run_parser.add_argument('--database', default=DEFAULT_DATABASE)
+    run_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    run_parser.add_argument('--duration', type=int)
+    run_parser.add_argument('--concurrency', type=int)
+    run_parser.add_argument('--no-generate', action='store_true')
+    run_parser.add_argument('--output', help='write JSON results here')
+
+    serve_parser = commands.add_parser('serve', help=argparse.SUPPRESS)
+    serve_parser.add_argument('--database', default=DEFAULT_DATABASE)
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve(args.database, args.port)
+        return
+
+    results = run(
+        args.scenario,
+        args.database,
+        args.port,
+        generate=not args.no_generate,
+        duration=args.duration,
+        concurrency=args.concurrency,
+    )
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    for label, stats in results['endpoints'].items():
+        print(
+            f'{label:28} {stats["rps"]:8.1f} req/s  '
+            f'p50 {stats["p50_ms"]:7.1f}ms  p95 {stats["p95_ms"]:7.1f}ms  '
+            f'p99 {stats["p99_ms"]:7.1f}ms  '
+            f'queries {stats["queries_per_request"]}',
+            file=sys.stderr,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,27 @@
 """Data models for Flask Cafe"""
 
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+import heapq
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from operator import attrgetter
 
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import fulltext
+import geo
+from caches import VersionedCache
+from pagination import Page, keyset_page
+from passwords import PasswordHasher
+from recommendations import CoLikeIndex
+from replicas import RoutingSQLAlchemy
+
+
+passwords = PasswordHasher()
+db = RoutingSQLAlchemy()
 
 
 class City(db.Model):
@@ -32,10 +47,79 @@ class City(db.Model):
         nullable=False,
     )
 
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
     @classmethod
     def cities(cls):
         """returns a list of tuples of every city in database"""
-        return [(c.code, c.name) for c in City.query.all()]
+        return [(code, c.name) for code, c in cls.lookup().items()]
+
+    @classmethod
+    def lookup(cls):
+        """returns {code: CityInfo(name, state)} for every city, from the
+        in-process city table"""
+        return city_table.get()
+
+
+CityInfo = namedtuple('CityInfo', ['name', 'state'])
+
+CafeDetail = namedtuple('CafeDetail', ['cafe', 'last_modified', 'liked'])
+
+NearbyCafe = namedtuple('NearbyCafe', [
+    'id', 'name', 'address', 'city_code', 'latitude', 'longitude',
+    'distance_km',
+])
+
+
+def _load_city_table():
+    """Read every city into a dict for city_table."""
+
+    rows = db.session.query(City.code, City.name, City.state) \
+        .order_by(City.name)
+    return {code: CityInfo(name, state) for code, name, state in rows}
+
+
+# cities change rarely, so keep them in memory; the TTL is a backstop for
+# changes committed by other processes
+city_table = VersionedCache(_load_city_table, ttl=300)
+
+
+@db.event.listens_for(City, 'after_insert')
+@db.event.listens_for(City, 'after_update')
+@db.event.listens_for(City, 'after_delete')
+def _city_changed(mapper, connection, target):
+    """Note that this session changed a city."""
+
+    db.object_session(target).info['cities_changed'] = True
+
+
+@db.event.listens_for(Session, 'after_bulk_update')
+@db.event.listens_for(Session, 'after_bulk_delete')
+def _cities_bulk_changed(context):
+    """Note bulk query updates/deletes of cities."""
+
+    if context.mapper.class_ is City:
+        context.session.info['cities_changed'] = True
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _invalidate_city_table(session):
+    """Once city changes are committed, drop the in-process city table."""
+
+    if session.info.pop('cities_changed', False):
+        city_table.invalidate()
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _forget_city_changes(session):
+    """Rolled-back city changes don't need an invalidation."""
+
+    session.info.pop('cities_changed', None)
 
 
 class Cafe(db.Model):
@@ -43,6 +127,10 @@ class Cafe(db.Model):
 
     __tablename__ = 'cafes'
 
+    __table_args__ = (
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -80,6 +168,54 @@ class Cafe(db.Model):
         default="/static/images/default-cafe.jpg",
     )
 
+    latitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    longitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    # names this image_url's thumbnails, once they're made; see thumbnails
+    thumbnail = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    # geohash of latitude/longitude, kept in step on save; see geo
+    geohash = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    # denormalized count of likes; see reconcile_like_counts
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped by every change to the row except to like_count, which no
+    # card or name-ordered list shows
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        index=True,
+    )
+
+    # bumped by every change to like_count
+    like_count_updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
     city = db.relationship("City", backref='cafes')
 
     liking_users = db.relationship(
@@ -93,9 +229,309 @@ class Cafe(db.Model):
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = City.lookup().get(self.city_code) or self.city
         return f'{city.name}, {city.state}'
 
+    @classmethod
+    def set_thumbnail(cls, cafe_id, image_url, thumbnail):
+        """Record thumbnail as made for cafe, if its image_url hasn't
+        changed since. The caller should commit."""
+
+        cls.query.filter_by(id=cafe_id, image_url=image_url).update(
+            {cls.thumbnail: thumbnail, cls.updated_at: datetime.utcnow()},
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def get_detail(cls, cafe_id, user_id=None):
+        """Return a CafeDetail for cafe's page, from one query, or None if
+        there's no such cafe.
+
+        Its last_modified is when cafe (its like count included) or its
+        city last changed; liked is whether user_id likes cafe (False if
+        user_id is None).
+        """
+
+        if user_id is None:
+            liked = db.literal(False)
+        else:
+            liked = db.exists().where(
+                (Like.user_id == user_id) & (Like.cafe_id == cls.id))
+
+        row = db.session.query(cls, City.updated_at, liked) \
+            .join(cls.city) \
+            .filter(cls.id == cafe_id) \
+            .first()
+        if row is None:
+            return None
+
+        cafe, city_updated_at, liked = row
+        last_modified = max(
+            cafe.updated_at, cafe.like_count_updated_at, city_updated_at)
+        return CafeDetail(cafe, last_modified, bool(liked))
+
+    @classmethod
+    def get_names(cls, cafe_ids):
+        """Return [(id, name)] for cafe_ids, in the same order."""
+
+        if not cafe_ids:
+            return []
+
+        names = dict(
+            db.session.query(cls.id, cls.name).filter(cls.id.in_(cafe_ids)))
+        return [
+            (cafe_id, names[cafe_id]) for cafe_id in cafe_ids
+            if cafe_id in names
+        ]
+
+    @classmethod
+    def get_list_version(cls, sort='name'):
+        """Return when any cafe or city last changed (None if there are
+        none). Cafes are never deleted, so this covers every change that
+        can move a cafe into or out of a list.
+
+        Like counts only count for sort 'popular', the one list they
+        order; otherwise likes don't change the version.
+        """
+
+        latest = [
+            db.session.query(db.func.max(cls.updated_at)).as_scalar(),
+            db.session.query(db.func.max(City.updated_at)).as_scalar(),
+        ]
+        if sort == 'popular':
+            latest.append(db.session.query(
+                db.func.max(cls.like_count_updated_at)).as_scalar())
+
+        latest = db.session.query(*latest).one()
+        return max((t for t in latest if t is not None), default=None)
+
+    @classmethod
+    def get_page(cls, per_page, after=None, before=None, sort='name'):
+        """Return a Page of cafes ordered by name, or most liked first if
+        sort is 'popular'.
+
+        after/before are cursors from a previous page; see keyset_page.
+        """
+
+        return keyset_page(
+            cls.query,
+            cls._page_order(sort),
+            per_page,
+            after=after,
+            before=before,
+        )
+
+    @classmethod
+    def _page_order(cls, sort):
+        if sort == 'popular':
+            return [(cls.like_count, True), (cls.id, False)]
+        return [(cls.name, False), (cls.id, False)]
+
+    # columns the JSON API can select; see api_query
+    API_FIELDS = (
+        'id', 'name', 'description', 'url', 'address', 'city_code',
+        'image_url', 'latitude', 'longitude', 'updated_at',
+    )
+    API_INCLUDES = ('city', 'like_count')
+
+    @classmethod
+    def api_query(cls, fields, include=()):
+        """Return a query for row tuples of just fields (from API_FIELDS),
+        plus like_count and/or city_name and city_state if include has
+        'like_count' or 'city'. No Cafe objects are built."""
+
+        columns = [getattr(cls, name) for name in fields]
+        if 'like_count' in include:
+            columns.append(cls.like_count)
+
+        query = db.session.query(*columns)
+
+        if 'city' in include:
+            query = query.join(City, City.code == cls.city_code).add_columns(
+                City.name.label('city_name'),
+                City.state.label('city_state'),
+            )
+
+        return query
+
+    @classmethod
+    def get_api_page(cls, fields, include=(), per_page=24, after=None,
+                     before=None, sort='name'):
+        """Return a Page of api_query row tuples, ordered as by get_page.
+
+        Rows also have the sort columns, whether or not they were asked
+        for.
+        """
+
+        order = cls._page_order(sort)
+        query = cls.api_query(fields, include)
+
+        selected = {column['name'] for column in query.column_descriptions}
+        query = query.add_columns(
+            *[col for col, _ in order if col.key not in selected])
+
+        return keyset_page(query, order, per_page, after=after, before=before)
+
+    @classmethod
+    def adjust_like_count(cls, cafe_id, delta):
+        """Add delta to cafe's like_count in the database, atomically.
+
+        The count never drops below 0; if it has drifted low, unliking
+        leaves it at 0 until reconcile_like_counts fixes it.
+        """
+
+        adjusted = cls.like_count + delta
+        cls.query.filter_by(id=cafe_id).update(
+            cls._like_count_values(
+                db.case([(adjusted < 0, 0)], else_=adjusted)),
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Rebuild like_count of every cafe from the likes table.
+
+        Returns the number of cafes whose count was wrong.
+        """
+
+        actual = db.select([db.func.count()]) \
+            .where(Like.cafe_id == cls.id) \
+            .as_scalar()
+
+        return cls.query.filter(cls.like_count != actual).update(
+            cls._like_count_values(actual),
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def _like_count_values(cls, like_count):
+        """Return UPDATE values setting like_count, and bumping
+        like_count_updated_at rather than updated_at."""
+
+        return {
+            cls.like_count: like_count,
+            cls.like_count_updated_at: datetime.utcnow(),
+            # setting it to itself keeps its onupdate from firing
+            cls.updated_at: cls.updated_at,
+        }
+
+    @staticmethod
+    def geohash_for(latitude, longitude):
+        """Return the geohash for a cafe at latitude/longitude, or None if
+        either is missing."""
+
+        if latitude is None or longitude is None:
+            return None
+        return geo.encode(latitude, longitude)
+
+    @classmethod
+    def nearby(cls, latitude, longitude, radius_km, limit):
+        """Return up to limit NearbyCafes within radius_km of latitude/
+        longitude, nearest first.
+
+        Only cafes in the geohash cells around the point are read (an
+        indexed prefix match); their exact distances then decide.
+        """
+
+        cells = geo.covering_cells(latitude, longitude, radius_km)
+        candidates = db.session.query(
+            cls.id,
+            cls.name,
+            cls.address,
+            cls.city_code,
+            cls.latitude,
+            cls.longitude,
+        ).filter(db.or_(*[cls.geohash.like(f'{cell}%') for cell in cells]))
+
+        found = []
+        for row in candidates:
+            distance = geo.distance_km(
+                latitude, longitude, row.latitude, row.longitude)
+            if distance <= radius_km:
+                found.append(NearbyCafe(*row, distance))
+
+        return heapq.nsmallest(limit, found, key=attrgetter('distance_km'))
+
+    @classmethod
+    def set_locations(cls, locations):
+        """Set latitude/longitude (and geohash) of many cafes in one
+        executemany. locations is a list of (cafe_id, latitude, longitude).
+
+        The caller should commit.
+        """
+
+        if not locations:
+            return
+
+        table = cls.__table__
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('cafe_id')),
+            [
+                {
+                    'cafe_id': cafe_id,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'geohash': cls.geohash_for(latitude, longitude),
+                }
+                for cafe_id, latitude, longitude in locations
+            ],
+        )
+
+    @classmethod
+    def search(cls, q, per_page, page=1):
+        """Return a Page of cafes matching q, best match first.
+
+        Ranked results have no stable sort key to seek on, so this pages by
+        number: the cursors are page numbers.
+        """
+
+        dialect = db.session.get_bind(cls.__mapper__).dialect.name
+        match = fulltext.match_query(q, dialect)
+        if match is None:
+            return Page([])
+
+        sql, q = match
+        cafes = cls.query.from_statement(text(sql)).params(
+            q=q,
+            limit=per_page + 1,
+            offset=(page - 1) * per_page,
+        ).all()
+
+        return Page(
+            cafes[:per_page],
+            next_cursor=str(page + 1) if len(cafes) > per_page else None,
+            prev_cursor=str(page - 1) if page > 1 else None,
+        )
+
+
+db.Index('ix_cafes_like_count_id', Cafe.like_count.desc(), Cafe.id)
+
+# text_pattern_ops lets Postgres use the index for LIKE 'prefix%'
+db.Index(
+    'ix_cafes_geohash',
+    Cafe.geohash,
+    postgresql_ops={'geohash': 'text_pattern_ops'},
+)
+
+
+@db.event.listens_for(Cafe, 'before_insert')
+@db.event.listens_for(Cafe, 'before_update')
+def _set_geohash(mapper, connection, target):
+    """Keep cafe's geohash in step with its latitude/longitude."""
+
+    target.geohash = Cafe.geohash_for(target.latitude, target.longitude)
+
+
+@db.event.listens_for(Cafe.image_url, 'set')
+def _forget_cafe_thumbnail(target, value, oldvalue, initiator):
+    """A new image needs new thumbnails."""
+
+    if value != oldvalue:
+        target.thumbnail = None
+
+
+fulltext.attach(Cafe.__table__)
+
 
 class User(db.Model):
     """User model"""
@@ -144,6 +580,12 @@ class User(db.Model):
         default="/static/images/default-pic.png",
     )
 
+    # names this image_url's thumbnails, once they're made; see thumbnails
+    thumbnail = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
     hashed_password = db.Column(
         db.Text,
         nullable=False,
@@ -160,11 +602,21 @@ class User(db.Model):
 
     def likes_cafe(self, cafe_id):
         """returns T/F if user likes/doesn't like the cafe"""
-        for cafe in self.liked_cafes:
-            if cafe.id == cafe_id:
-                return True
-        return False
-        # return any(cafe.id == cafe_id for cafe in self.liked_cafes:)
+        return Like.exists_for(self.id, cafe_id)
+
+    def likes_cafes(self, cafe_ids):
+        """returns {cafe_id: T/F} for each of cafe_ids, in one query"""
+        return Like.liked_by(self.id, cafe_ids)
+
+    @classmethod
+    def set_thumbnail(cls, user_id, image_url, thumbnail):
+        """Record thumbnail as made for user, if their image_url hasn't
+        changed since. The caller should commit."""
+
+        cls.query.filter_by(id=user_id, image_url=image_url).update(
+            {cls.thumbnail: thumbnail},
+            synchronize_session=False,
+        )
 
     @classmethod
     def register(
@@ -180,8 +632,7 @@ class User(db.Model):
     ):
         """return user with hashed password"""
 
-        hashed = bcrypt.generate_password_hash(password)
-        hashed_utf8 = hashed.decode("utf8")
+        hashed_utf8 = passwords.hash(password)
         return cls(
             username=username,
             hashed_password=hashed_utf8,
@@ -195,16 +646,164 @@ class User(db.Model):
 
     @classmethod
     def authenticate(cls, username, pwd):
-        """return user if valid user, else return False"""
+        """return user if valid user, else return False
+
+        If the password was hashed at an old cost, rehashes it at the
+        current one; the caller should commit.
+        """
 
         u = User.query.filter_by(username=username).first()
 
-        if u and bcrypt.check_password_hash(u.hashed_password, pwd):
+        if u and passwords.check(u.hashed_password, pwd):
+            if passwords.needs_rehash(u.hashed_password):
+                u.hashed_password = passwords.hash(pwd)
             return u
         else:
             return False
 
 
+@db.event.listens_for(User.image_url, 'set')
+def _forget_user_thumbnail(target, value, oldvalue, initiator):
+    """A new image needs new thumbnails."""
+
+    if value != oldvalue:
+        target.thumbnail = None
+
+
+class UserSnapshot:
+    """Read-only copy of the User fields that most pages need.
+
+    Safe to cache between requests: it is not attached to a session and
+    doesn't carry the password hash or description.
+    """
+
+    FIELDS = (
+        'id',
+        'username',
+        'admin',
+        'email',
+        'first_name',
+        'last_name',
+        'image_url',
+    )
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields[name])
+
+    def __repr__(self):
+        return f'<UserSnapshot id={self.id} username="{self.username}">'
+
+    @classmethod
+    def load(cls, user_id):
+        """return snapshot of user with user_id, or None if there's none"""
+
+        columns = [getattr(User, name) for name in cls.FIELDS]
+        row = db.session.query(*columns).filter(User.id == user_id).first()
+        return cls(**row._asdict()) if row else None
+
+    def get_full_name(self):
+        """returns 'first_name last_name'"""
+        return f"{self.first_name} {self.last_name}"
+
+    def likes_cafe(self, cafe_id):
+        """returns T/F if user likes/doesn't like the cafe"""
+        return Like.exists_for(self.id, cafe_id)
+
+    def likes_cafes(self, cafe_ids):
+        """returns {cafe_id: T/F} for each of cafe_ids, in one query"""
+        return Like.liked_by(self.id, cafe_ids)
+
+
+LikeState = namedtuple('LikeState', ['liked', 'like_count', 'changed'])
+
+
+def _rollup_sql(changed):
+    """Return a statement adding the like changes selected by changed, as
+    (cafe_id, created_at, delta) rows, to the hour and day of each like."""
+
+    return f"""
+        INSERT INTO cafe_like_rollups (granularity, bucket, cafe_id, likes)
+        SELECT period, date_trunc(period, created_at), cafe_id, sum(delta)
+        FROM ({changed}) AS changed (cafe_id, created_at, delta)
+        CROSS JOIN (VALUES ('hour'), ('day')) AS periods (period)
+        GROUP BY 1, 2, 3
+        ON CONFLICT (granularity, bucket, cafe_id)
+        DO UPDATE SET likes = cafe_like_rollups.likes + excluded.likes
+    """
+
+
+# On Postgres each like write is one statement: change likes, adjust the
+# cafe's like_count and trending rollups if a row changed, and return the
+# outcome.
+LIKE_SQL = f"""
+    WITH ins AS (
+        INSERT INTO likes (user_id, cafe_id, created_at)
+        VALUES (:user_id, :cafe_id, :now)
+        ON CONFLICT DO NOTHING
+        RETURNING cafe_id, created_at
+    ), roll AS ({_rollup_sql("SELECT cafe_id, created_at, 1 FROM ins")}
+    ), upd AS (
+        UPDATE cafes
+        SET like_count = like_count + 1, like_count_updated_at = :now
+        WHERE id IN (SELECT cafe_id FROM ins)
+        RETURNING like_count
+    )
+    SELECT true AS liked,
+           coalesce((SELECT like_count FROM upd),
+                    (SELECT like_count FROM cafes WHERE id = :cafe_id))
+               AS like_count,
+           EXISTS (SELECT 1 FROM ins) AS changed
+"""
+
+UNLIKE_SQL = f"""
+    WITH del AS (
+        DELETE FROM likes WHERE user_id = :user_id AND cafe_id = :cafe_id
+        RETURNING cafe_id, created_at
+    ), roll AS ({_rollup_sql("SELECT cafe_id, created_at, -1 FROM del")}
+    ), upd AS (
+        UPDATE cafes
+        SET like_count = greatest(like_count - 1, 0),
+            like_count_updated_at = :now
+        WHERE id IN (SELECT cafe_id FROM del)
+        RETURNING like_count
+    )
+    SELECT false AS liked,
+           coalesce((SELECT like_count FROM upd),
+                    (SELECT like_count FROM cafes WHERE id = :cafe_id))
+               AS like_count,
+           EXISTS (SELECT 1 FROM del) AS changed
+"""
+
+TOGGLE_SQL = f"""
+    WITH del AS (
+        DELETE FROM likes WHERE user_id = :user_id AND cafe_id = :cafe_id
+        RETURNING cafe_id, created_at
+    ), ins AS (
+        INSERT INTO likes (user_id, cafe_id, created_at)
+        SELECT :user_id, :cafe_id, :now WHERE NOT EXISTS (SELECT 1 FROM del)
+        ON CONFLICT DO NOTHING
+        RETURNING cafe_id, created_at
+    ), roll AS ({_rollup_sql(
+        "SELECT cafe_id, created_at, 1 FROM ins"
+        " UNION ALL SELECT cafe_id, created_at, -1 FROM del")}
+    ), upd AS (
+        UPDATE cafes SET
+            like_count = greatest(like_count
+                + (SELECT count(*) FROM ins) - (SELECT count(*) FROM del), 0),
+            like_count_updated_at = :now
+        WHERE id = :cafe_id
+            AND EXISTS (SELECT 1 FROM ins UNION ALL SELECT 1 FROM del)
+        RETURNING like_count
+    )
+    SELECT EXISTS (SELECT 1 FROM ins) AS liked,
+           coalesce((SELECT like_count FROM upd),
+                    (SELECT like_count FROM cafes WHERE id = :cafe_id))
+               AS like_count,
+           EXISTS (SELECT 1 FROM ins UNION ALL SELECT 1 FROM del) AS changed
+"""
+
+
 class Like(db.Model):
     """middle table linking liker User to liked Cafe"""
 
@@ -222,6 +821,402 @@ class Like(db.Model):
         primary_key=True
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def count_for(cls, user_id):
+        """returns how many cafes user_id likes"""
+
+        return db.session.query(db.func.count(cls.cafe_id)) \
+            .filter(cls.user_id == user_id) \
+            .scalar()
+
+    @classmethod
+    def get_liked_page(cls, user_id, per_page, after=None):
+        """Return a Page of (cafe_id, name, created_at) rows for the cafes
+        user_id likes, most recently liked first.
+
+        after is the next_cursor of the previous page. Each page is one
+        seek on ix_likes_user_id_created_at, joined to just those cafes.
+        """
+
+        query = db.session.query(cls.cafe_id, Cafe.name, cls.created_at) \
+            .join(Cafe, Cafe.id == cls.cafe_id) \
+            .filter(cls.user_id == user_id)
+
+        return keyset_page(
+            query,
+            [(cls.created_at, True), (cls.cafe_id, True)],
+            per_page,
+            after=after,
+        )
+
+    @classmethod
+    def exists_for(cls, user_id, cafe_id):
+        """returns T/F if there's a like from user_id for cafe_id"""
+
+        q = cls.query.filter_by(user_id=user_id, cafe_id=cafe_id)
+        return db.session.query(q.exists()).scalar()
+
+    @classmethod
+    def liked_by(cls, user_id, cafe_ids):
+        """returns {cafe_id: T/F} for each of cafe_ids, in one query"""
+
+        cafe_ids = set(cafe_ids)
+        if not cafe_ids:
+            return {}
+
+        liked = {
+            cafe_id for (cafe_id,) in db.session.query(cls.cafe_id).filter(
+                cls.user_id == user_id,
+                cls.cafe_id.in_(cafe_ids),
+            )
+        }
+        return {cafe_id: cafe_id in liked for cafe_id in cafe_ids}
+
+    @classmethod
+    def get_state(cls, user_id, cafe_id):
+        """Return a LikeState for user and cafe as stored (changed is
+        False), from one query, or None if there's no such cafe."""
+
+        liked = db.exists().where(
+            (cls.user_id == user_id) & (cls.cafe_id == Cafe.id))
+
+        row = db.session.query(liked, Cafe.like_count) \
+            .filter(Cafe.id == cafe_id) \
+            .first()
+        if row is None:
+            return None
+
+        return LikeState(bool(row[0]), row[1], False)
+
+    @classmethod
+    def write_batch(cls, operations):
+        """Like or unlike, from {(user_id, cafe_id): liked}, in one
+        transaction, and commit it.
+
+        Each write is in its own savepoint, so one for a since-deleted cafe
+        or user is skipped rather than losing the rest. Returns
+        [(user_id, cafe_id, LikeState)] for the writes that were made.
+        """
+
+        written = []
+        for (user_id, cafe_id), liked in operations.items():
+            db.session.begin_nested()
+            if liked:
+                state = cls.add(user_id, cafe_id)
+            else:
+                state = cls.remove(user_id, cafe_id)
+
+            # a failed write has already rolled back its savepoint
+            if state is not None:
+                db.session.commit()
+                written.append((user_id, cafe_id, state))
+
+        db.session.commit()
+        return written
+
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """Like cafe for user, if they don't already. Safe to repeat.
+
+        Returns a LikeState, or None if there's no such cafe. The caller
+        should commit.
+        """
+        return cls._write(LIKE_SQL, user_id, cafe_id, 'add')
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """Unlike cafe for user, if they like it. Safe to repeat.
+
+        Returns a LikeState, or None if there's no such cafe. The caller
+        should commit.
+        """
+        return cls._write(UNLIKE_SQL, user_id, cafe_id, 'remove')
+
+    @classmethod
+    def toggle(cls, user_id, cafe_id):
+        """Like cafe for user if they don't, else unlike it.
+
+        Returns a LikeState, or None if there's no such cafe. The caller
+        should commit.
+        """
+        return cls._write(TOGGLE_SQL, user_id, cafe_id, 'toggle')
+
+    @classmethod
+    def _write(cls, sql, user_id, cafe_id, op):
+        """Run like write op, as one statement on Postgres."""
+
+        params = dict(user_id=user_id, cafe_id=cafe_id)
+
+        try:
+            if db.session.get_bind(cls.__mapper__).dialect.name == \
+                    'postgresql':
+                row = db.session.execute(
+                    text(sql), dict(params, now=datetime.utcnow())).first()
+                state = LikeState(*row)
+            else:
+                state = cls._write_portably(user_id, cafe_id, op)
+
+        except IntegrityError:
+            # the foreign key on likes: no such user or cafe
+            db.session.rollback()
+            return None
+
+        if state.like_count is None:
+            db.session.rollback()
+            return None
+
+        return state
+
+    @classmethod
+    def _write_portably(cls, user_id, cafe_id, op):
+        """Run like write op in a few plain statements, for databases
+        without data-modifying CTEs."""
+
+        where = (cls.user_id == user_id) & (cls.cafe_id == cafe_id)
+        liked = False
+        deleted = 0
+
+        if op in ('remove', 'toggle'):
+            created_at = db.session.query(cls.created_at) \
+                .filter(where) \
+                .scalar()
+            deleted = db.session.execute(
+                cls.__table__.delete().where(where)).rowcount
+            delta = -deleted
+
+        if op == 'add' or (op == 'toggle' and not deleted):
+            created_at = datetime.utcnow()
+            inserted = db.session.execute(
+                cls.__table__.insert().prefix_with('OR IGNORE'),
+                dict(user_id=user_id, cafe_id=cafe_id, created_at=created_at),
+            ).rowcount
+            liked = True
+            delta = inserted
+
+        if delta:
+            Cafe.adjust_like_count(cafe_id, delta)
+            CafeLikeRollup.add(cafe_id, created_at, delta)
+
+        like_count = db.session.query(Cafe.like_count) \
+            .filter(Cafe.id == cafe_id) \
+            .scalar()
+        return LikeState(liked, like_count, bool(delta))
+
+
+db.Index(
+    'ix_likes_user_id_created_at',
+    Like.user_id,
+    Like.created_at.desc(),
+    Like.cafe_id.desc(),
+)
+
+
+ROLLUP_UPSERT_SQL = """
+    INSERT INTO cafe_like_rollups (granularity, bucket, cafe_id, likes)
+    VALUES (:granularity, :bucket, :cafe_id, :delta)
+    ON CONFLICT (granularity, bucket, cafe_id)
+    DO UPDATE SET likes = cafe_like_rollups.likes + excluded.likes
+"""
+
+ROLLUP_REBUILD_SQL = """
+    INSERT INTO cafe_like_rollups (granularity, bucket, cafe_id, likes)
+    SELECT period, date_trunc(period, created_at), cafe_id, count(*)
+    FROM likes
+    CROSS JOIN (VALUES ('hour'), ('day')) AS periods (period)
+    GROUP BY 1, 2, 3
+"""
+
+TrendingCafe = namedtuple('TrendingCafe', ['id', 'name', 'likes'])
+
+
+class CafeLikeRollup(db.Model):
+    """Net new likes per cafe per hour and per day, for trending cafes.
+
+    Each like write adds to (or, for an unlike, takes from) the hour and
+    day buckets of when the like was made, so a bucket counts that period's
+    likes that still stand. Trending queries sum a window of buckets and
+    never touch likes.
+    """
+
+    __tablename__ = 'cafe_like_rollups'
+
+    # trending windows: name -> (bucket granularity, buckets summed)
+    WINDOWS = {
+        '24h': ('hour', 24),
+        '7d': ('day', 7),
+    }
+
+    # how long buckets are kept, by granularity; see prune
+    RETENTION = {
+        'hour': timedelta(days=2),
+        'day': timedelta(days=90),
+    }
+
+    granularity = db.Column(
+        db.String(4),
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    @staticmethod
+    def bucket_for(when, granularity):
+        """Return the start of the hour or day (granularity) when is in."""
+
+        when = when.replace(minute=0, second=0, microsecond=0)
+        if granularity == 'day':
+            when = when.replace(hour=0)
+        return when
+
+    @classmethod
+    def add(cls, cafe_id, created_at, delta):
+        """Add delta likes, made at created_at, to cafe's buckets. The
+        like write statements on Postgres do this themselves."""
+
+        # typed, so bucket is stored as the ORM stores it (on SQLite, a
+        # string that has to match exactly)
+        upsert = text(ROLLUP_UPSERT_SQL).bindparams(
+            db.bindparam('bucket', type_=db.DateTime))
+        db.session.execute(upsert, [
+            dict(
+                granularity=granularity,
+                bucket=cls.bucket_for(created_at, granularity),
+                cafe_id=cafe_id,
+                delta=delta,
+            )
+            for granularity in cls.RETENTION
+        ])
+
+    @classmethod
+    def trending(cls, window, limit, now=None):
+        """Return up to limit TrendingCafes, with the most new likes in
+        window (a key of WINDOWS) first.
+
+        Windows are whole buckets, including the current one: '24h' is
+        this hour and the 23 before it.
+        """
+
+        granularity, buckets = cls.WINDOWS[window]
+        latest = cls.bucket_for(now or datetime.utcnow(), granularity)
+        step = timedelta(hours=1) if granularity == 'hour' else timedelta(1)
+
+        likes = db.func.sum(cls.likes).label('likes')
+        top = db.session.query(cls.cafe_id, likes) \
+            .filter(
+                cls.granularity == granularity,
+                cls.bucket > latest - buckets * step,
+            ) \
+            .group_by(cls.cafe_id) \
+            .having(likes > 0) \
+            .order_by(likes.desc(), cls.cafe_id) \
+            .limit(limit) \
+            .subquery()
+
+        rows = db.session.query(Cafe.id, Cafe.name, top.c.likes) \
+            .join(top, top.c.cafe_id == Cafe.id) \
+            .order_by(top.c.likes.desc(), Cafe.id)
+        return [TrendingCafe(*row) for row in rows]
+
+    @classmethod
+    def prune(cls, now=None):
+        """Delete buckets past their RETENTION, and empty ones. Returns
+        the number deleted."""
+
+        now = now or datetime.utcnow()
+        expired = db.or_(*[
+            (cls.granularity == granularity) & (cls.bucket < now - kept)
+            for granularity, kept in cls.RETENTION.items()
+        ])
+
+        return cls.query.filter(expired | (cls.likes == 0)).delete(
+            synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls):
+        """Recount every bucket from the likes table, for likes loaded in
+        bulk. Returns the number of buckets."""
+
+        cls.query.delete(synchronize_session=False)
+
+        if db.session.get_bind(cls.__mapper__).dialect.name == 'postgresql':
+            return db.session.execute(text(ROLLUP_REBUILD_SQL)).rowcount
+        return cls._rebuild_portably()
+
+    @classmethod
+    def _rebuild_portably(cls):
+        """Recount every bucket in Python, with bucket_for, for databases
+        without date_trunc."""
+
+        counts = Counter()
+        likes = db.session.query(Like.cafe_id, Like.created_at) \
+            .yield_per(10000)
+        for cafe_id, created_at in likes:
+            for granularity in cls.RETENTION:
+                bucket = cls.bucket_for(created_at, granularity)
+                counts[(granularity, bucket, cafe_id)] += 1
+
+        if counts:
+            db.session.execute(cls.__table__.insert(), [
+                dict(granularity=granularity, bucket=bucket, cafe_id=cafe_id,
+                     likes=likes)
+                for (granularity, bucket, cafe_id), likes in counts.items()
+            ])
+        return len(counts)
+
+
+def _load_likes():
+    """Read every (user_id, cafe_id) like for co_likes."""
+
+    return db.session.query(Like.user_id, Like.cafe_id).all()
+
+
+def _likes_context():
+    """Return an app context for reloading co_likes in another thread."""
+
+    return current_app._get_current_object().app_context()
+
+
+# kept in step with this process's like writes; the TTL picks up the
+# other processes'
+co_likes = CoLikeIndex(_load_likes, ttl=600, context=_likes_context)
+
+
+class ImportCheckpoint(db.Model):
+    """How far the bulk importer got through each input; see importer.py"""
+
+    __tablename__ = "import_checkpoints"
+
+    source = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    rows_done = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -231,3 +1226,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    passwords.init_app(app)
@@ -0,0 +1,126 @@
+"""Keyset (cursor) pagination helpers for Flask Cafe."""
+
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_, tuple_
+
+
+class Page:
+    """One page of results plus the cursors for its neighbours."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return f'<Page items={len(self.items)} next={self.next_cursor!r}>'
+
+
+def encode_cursor(values):
+    """Return an opaque, URL-safe cursor for a list of sort key values."""
+
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Return the sort key values in cursor, coerced to the column types.
+
+    Raises ValueError if the cursor is malformed, or a value isn't of its
+    column's type (the sort columns aren't nullable, so None isn't either).
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError) as exc:
+        raise ValueError(f'bad cursor: {cursor!r}') from exc
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError(f'bad cursor: {cursor!r}')
+
+    coerced = []
+    for value, (column, _) in zip(values, columns):
+        python_type = column.type.python_type
+        if isinstance(value, str) and python_type is datetime:
+            value = datetime.fromisoformat(value)
+        # JSON true/false decode to bools, which are also ints
+        if not isinstance(value, python_type) or \
+                isinstance(value, bool) and python_type is not bool:
+            raise ValueError(f'bad cursor: {cursor!r}')
+        coerced.append(value)
+    return coerced
+
+
+def _seek(columns, values, forward):
+    """Return a filter for rows strictly after (or before) values."""
+
+    if len({desc for _, desc in columns}) == 1:
+        # single direction: use a row comparison, which the index can seek
+        desc = columns[0][1]
+        key = tuple_(*[col for col, _ in columns])
+        return key < tuple_(*values) if desc == forward else \
+            key > tuple_(*values)
+
+    clauses = []
+    for i, (col, desc) in enumerate(columns):
+        equal = [c == v for (c, _), v in zip(columns[:i], values[:i])]
+        step = col < values[i] if desc == forward else col > values[i]
+        clauses.append(and_(*equal, step))
+
+    # mixed directions can't use a row comparison; the redundant bound on
+    # the leading column still gives the index somewhere to start
+    col, desc = columns[0]
+    start = col <= values[0] if desc == forward else col >= values[0]
+    return and_(start, or_(*clauses))
+
+
+def keyset_page(query, columns, per_page, after=None, before=None):
+    """Return a Page of query results ordered by columns.
+
+    columns is a list of (column, descending) pairs whose values uniquely
+    identify a row; the last one should be the primary key. Pass the
+    next_cursor of one page as after, or its prev_cursor as before, to move
+    between pages. Each page costs one index seek of per_page + 1 rows.
+    """
+
+    forward = before is None
+    cursor = after if forward else before
+
+    if cursor:
+        query = query.filter(
+            _seek(columns, decode_cursor(cursor, columns), forward))
+
+    order = []
+    for col, desc in columns:
+        order.append(col.desc() if desc == forward else col.asc())
+
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if not forward:
+        rows.reverse()
+
+    def cursor_for(row):
+        return encode_cursor([getattr(row, col.key) for col, _ in columns])
+
+    has_next = more if forward else bool(cursor)
+    has_prev = bool(cursor) if forward else more
+
+    return Page(
+        rows,
+        next_cursor=cursor_for(rows[-1]) if rows and has_next else None,
+        prev_cursor=cursor_for(rows[0]) if rows and has_prev else None,
+    )
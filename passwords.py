@@ -0,0 +1,147 @@
+"""Password hashing for Flask Cafe, off the request thread.
+
+bcrypt is deliberately slow, so hashing and checking run in a small process
+pool: a burst of logins then queues there instead of pinning every web
+worker. Settings come from the current app's config:
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes (default 12)
+- PASSWORD_POOL_SIZE: worker processes; 0 hashes inline (default 2)
+- PASSWORD_QUEUE_DEPTH: most hashes running or waiting in this process
+  before PasswordPoolBusy is raised (default 16)
+"""
+
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app, has_app_context
+
+
+# Pool processes come from a clean server process rather than forking the
+# worker, which by then has other threads (gunicorn's, the like flusher,
+# the thumbnail pool); a fork taken while one of them holds a lock can
+# leave the child deadlocked on it.
+START_METHOD = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+# bcrypt only uses this many bytes of a password; 5.x raises ValueError
+# for longer ones
+MAX_PASSWORD_BYTES = 72
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many password hashes are already waiting."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf8')
+
+
+def _check(password, hashed):
+    if len(password) > MAX_PASSWORD_BYTES:
+        # no hash was made from it, so it can't match
+        return False
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """Hashes and checks passwords with bcrypt in a bounded process pool."""
+
+    def __init__(self, app=None):
+        self.app = app
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Use app's config when there's no app context."""
+
+        self.app = app
+
+    def _setting(self, name, default):
+        app = current_app if has_app_context() else self.app
+        return app.config.get(name, default)
+
+    def _get_pool(self):
+        """Return (pool, slots) for this process, starting it if needed.
+
+        The pool is started lazily and again after a fork, so a preloading
+        server doesn't share one between workers.
+        """
+
+        with self._lock:
+            if self._pid != os.getpid():
+                size = self._setting('PASSWORD_POOL_SIZE', 2)
+                depth = self._setting('PASSWORD_QUEUE_DEPTH', 16)
+                self._pool = ProcessPoolExecutor(
+                    size,
+                    mp_context=multiprocessing.get_context(START_METHOD),
+                ) if size else None
+                self._slots = threading.BoundedSemaphore(depth)
+                self._pid = os.getpid()
+            return self._pool, self._slots
+
+    def _run(self, fn, *args):
+        pool, slots = self._get_pool()
+
+        if not slots.acquire(blocking=False):
+            raise PasswordPoolBusy("Too many password checks waiting.")
+
+        try:
+            if pool is None:
+                return fn(*args)
+            return pool.submit(fn, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        """Return bcrypt hash (as str) of password, at the configured cost."""
+
+        rounds = self._setting('BCRYPT_LOG_ROUNDS', 12)
+        return self._run(_hash, password.encode('utf8'), rounds)
+
+    def hash_many(self, passwords):
+        """Return bcrypt hashes (as str) of passwords, in order, hashed
+        side by side in the pool.
+
+        For batch jobs: the batch doesn't count against
+        PASSWORD_QUEUE_DEPTH.
+        """
+
+        rounds = self._setting('BCRYPT_LOG_ROUNDS', 12)
+        encoded = [password.encode('utf8') for password in passwords]
+        pool, _ = self._get_pool()
+
+        if pool is None:
+            return [_hash(password, rounds) for password in encoded]
+        return list(pool.map(_hash, encoded, [rounds] * len(encoded)))
+
+    def check(self, hashed, password):
+        """Return T/F if password matches hashed."""
+
+        return self._run(
+            _check, password.encode('utf8'), hashed.encode('utf8'))
+
+    def needs_rehash(self, hashed):
+        """Return T/F if hashed was made at a cost other than the current
+        BCRYPT_LOG_ROUNDS."""
+
+        rounds = self._setting('BCRYPT_LOG_ROUNDS', 12)
+        try:
+            return int(hashed.split('$')[2]) != rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        """Stop this process's pool, if it has one."""
+
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+            self._pid = None
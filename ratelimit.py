@@ -0,0 +1,196 @@
+"""Token-bucket throttling of login and signup attempts, for Flask Cafe.
+
+Each of those POSTs runs bcrypt, which is slow on purpose, so one client
+trying passwords could keep every worker's CPU busy. Each attempt takes a
+token from the client IP's bucket and, for logins, the username's; a
+bucket holds up to `burst` tokens and refills at `rate` a second. When one
+is empty the request gets a plain 429, with Retry-After, before any
+database or bcrypt work.
+
+Settings come from the app's config:
+
+- RATE_LIMITS: {endpoint: {'ip' or 'username': (burst, rate)}}
+- RATE_LIMIT_ENABLED: default True
+- RATE_LIMIT_STORAGE: None keeps buckets in this process (MemoryBuckets);
+  a file path shares them between processes on the host (SQLiteBuckets)
+- RATE_LIMIT_MAX_KEYS: most buckets kept in memory (default 100000)
+"""
+
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+
+
+# usernames are cut to this, so keys stay small
+MAX_KEY_LENGTH = 64
+
+
+def refill(tokens, stamp, burst, rate, now):
+    """Return how many tokens a bucket that had tokens at stamp has now."""
+
+    return min(burst, tokens + (now - stamp) * rate)
+
+
+def take_from(state, burst, rate, now):
+    """Take a token from a bucket in state (tokens, stamp), or None for a
+    full one. Returns (new state, seconds to wait: 0 if a token was
+    taken)."""
+
+    tokens = burst if state is None else refill(*state, burst, rate, now)
+
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    """Buckets in this process: (tokens, stamp) by key, least recently used
+    dropped (that is, refilled) past maxsize."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        """Take a token from key's bucket; return seconds to wait, or 0 if
+        one was taken."""
+
+        now = time.monotonic()
+        with self._lock:
+            state, wait = take_from(
+                self._buckets.get(key), burst, rate, now)
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBuckets:
+    """Buckets in a SQLite file, shared by every process that opens it: a
+    local stand-in for a shared store like Redis. Each take is one short
+    write transaction."""
+
+    # buckets idle this long (seconds) are full again, so they're deleted
+    IDLE = 3600
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+
+    def _connect(self):
+        """Return this thread's connection, made after any fork."""
+
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS buckets ('
+                ' key TEXT PRIMARY KEY, tokens REAL, stamp REAL'
+                ') WITHOUT ROWID')
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+    def take(self, key, burst, rate):
+        """Take a token from key's bucket; return seconds to wait, or 0 if
+        one was taken."""
+
+        db = self._connect()
+        now = time.time()
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            state = db.execute(
+                'SELECT tokens, stamp FROM buckets WHERE key = ?', (key,)
+            ).fetchone()
+            state, wait = take_from(state, burst, rate, now)
+            db.execute(
+                'INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                (key, *state))
+
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                db.execute(
+                    'DELETE FROM buckets WHERE stamp < ?', (now - self.IDLE,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return wait
+
+    def clear(self):
+        self._connect().execute('DELETE FROM buckets')
+
+
+def client_key(kind):
+    """Return this request's key for a kind of limit, or None."""
+
+    if kind == 'ip':
+        return f'ip:{request.remote_addr}'
+
+    if kind == 'username':
+        username = request.form.get('username', '').strip().lower()
+        if username:
+            return f'user:{username[:MAX_KEY_LENGTH]}'
+
+    return None
+
+
+def init_app(app):
+    """Throttle POSTs to app's RATE_LIMITS endpoints. Call before
+    registering anything else that runs before requests."""
+
+    app.config.setdefault('RATE_LIMITS', {})
+    app.config.setdefault('RATE_LIMIT_ENABLED', True)
+    app.config.setdefault('RATE_LIMIT_STORAGE', None)
+    app.config.setdefault('RATE_LIMIT_MAX_KEYS', 100000)
+
+    if app.config['RATE_LIMIT_STORAGE']:
+        buckets = SQLiteBuckets(app.config['RATE_LIMIT_STORAGE'])
+    else:
+        buckets = MemoryBuckets(app.config['RATE_LIMIT_MAX_KEYS'])
+    app.extensions['rate_limit'] = buckets
+
+    @app.before_request
+    def throttle():
+        """Refuse an attempt, cheaply, if any of its buckets is empty."""
+
+        if request.method != 'POST' or \
+                not app.config['RATE_LIMIT_ENABLED']:
+            return None
+
+        limits = app.config['RATE_LIMITS'].get(request.endpoint)
+        if not limits:
+            return None
+
+        for kind, (burst, rate) in limits.items():
+            key = client_key(kind)
+            if key is None:
+                continue
+
+            wait = buckets.take(f'{request.endpoint}:{key}', burst, rate)
+            if wait:
+                return app.response_class(
+                    'Too many attempts. Please try again later.\n',
+                    status=429,
+                    headers={'Retry-After': str(math.ceil(wait))},
+                    mimetype='text/plain',
+                )
+
+        return None
@@ -0,0 +1,293 @@
+"""Co-like recommendations for Flask Cafe.
+
+Two cafes are similar when the same people like them: CoLikeIndex keeps,
+in memory, a sparse cafe-by-cafe matrix of how many users like both, and
+scores pairs by cosine similarity, co-likers / sqrt(likers of a * likers
+of b). It's built in bulk from (user_id, cafe_id) like pairs (as the
+sparse matrix product X.T @ X if SciPy is installed, else in Python),
+then kept up to date one like at a time.
+"""
+
+
+import contextlib
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from math import sqrt
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+
+logger = logging.getLogger('flaskcafe.recommendations')
+
+# most similar cafes kept per cafe; suggestions are drawn from these
+POOL_SIZE = 50
+
+
+def co_like_counts(likes):
+    """Return ({cafe_id: likers}, {cafe_id: {other_id: co-likers}}) for a
+    list of (user_id, cafe_id) pairs, without duplicates."""
+
+    if sparse is not None and likes:
+        return _co_like_counts_sparse(likes)
+    return _co_like_counts_python(likes)
+
+
+def _co_like_counts_sparse(likes):
+    pairs = numpy.array(likes, dtype=numpy.int64)
+    users, user_rows = numpy.unique(pairs[:, 0], return_inverse=True)
+    cafes, cafe_cols = numpy.unique(pairs[:, 1], return_inverse=True)
+
+    # users x cafes, 1 where the user likes the cafe
+    liked = sparse.csr_matrix(
+        (numpy.ones(len(pairs), dtype=numpy.int32), (user_rows, cafe_cols)),
+        shape=(len(users), len(cafes)),
+    )
+    co_liked = (liked.T @ liked).tocsr()
+
+    cafe_ids = cafes.tolist()
+    counts = dict(zip(cafe_ids, co_liked.diagonal().tolist()))
+
+    co_liked.setdiag(0)
+    co_liked.eliminate_zeros()
+
+    rows = {}
+    indptr, indices, data = co_liked.indptr, co_liked.indices, co_liked.data
+    for i, cafe_id in enumerate(cafe_ids):
+        start, end = indptr[i], indptr[i + 1]
+        if start < end:
+            rows[cafe_id] = dict(zip(
+                cafes[indices[start:end]].tolist(),
+                data[start:end].tolist(),
+            ))
+
+    return counts, rows
+
+
+def _co_like_counts_python(likes):
+    by_user = defaultdict(list)
+    for user_id, cafe_id in likes:
+        by_user[user_id].append(cafe_id)
+
+    counts = defaultdict(int)
+    rows = defaultdict(lambda: defaultdict(int))
+    for cafe_ids in by_user.values():
+        for cafe_id in cafe_ids:
+            counts[cafe_id] += 1
+            row = rows[cafe_id]
+            for other_id in cafe_ids:
+                if other_id != cafe_id:
+                    row[other_id] += 1
+
+    return dict(counts), {cafe_id: dict(row) for cafe_id, row in rows.items()}
+
+
+class CoLikeIndex:
+    """In-memory co-like matrix, loaded from loader() on first use.
+
+    loader returns every (user_id, cafe_id) like. add() and remove() keep
+    the index in step with this process's writes; if ttl (seconds) is
+    given, it's reloaded once that old, to pick up other processes'.
+
+    That reload runs in a background thread, inside the context manager
+    context() returns (say, an app context), while the old matrix keeps
+    answering; only the first load makes its caller wait.
+    """
+
+    def __init__(self, loader, ttl=None, context=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.context = context
+        self._lock = threading.RLock()
+        self._expires = None
+        self._loaded = False
+        self._likes = {}
+        self._counts = {}
+        self._rows = {}
+        # {cafe_id: [most similar cafe ids]}, filled in as asked for
+        self._similar = {}
+        # bumped by invalidate, so a reload started before it is dropped
+        self._generation = 0
+        # pid of the process reloading in the background, and the add and
+        # remove calls made since it started, to replay on its result
+        self._reloading = None
+        self._changes = []
+
+    def invalidate(self):
+        """Reload from loader() on next use."""
+
+        with self._lock:
+            self._loaded = False
+            self._generation += 1
+
+    def _load(self):
+        """Return (counts, rows, likes by user) from loader()."""
+
+        likes = list(self.loader())
+        counts, rows = co_like_counts(likes)
+        by_user = defaultdict(set)
+        for user_id, cafe_id in likes:
+            by_user[user_id].add(cafe_id)
+        return counts, rows, by_user
+
+    def _use(self, loaded):
+        """Answer from loaded, a _load() result; caller holds the
+        lock."""
+
+        self._counts, self._rows, self._likes = loaded
+        self._similar = {}
+        self._loaded = True
+        if self.ttl:
+            self._expires = time.monotonic() + self.ttl
+
+    def _ensure_loaded(self):
+        """Load if needed, or start reloading if expired; caller holds
+        the lock."""
+
+        if not self._loaded:
+            self._use(self._load())
+
+        elif self._expires is not None and \
+                self._expires < time.monotonic() and \
+                self._reloading != os.getpid():
+            self._reload_in_background()
+
+    def _reload_in_background(self):
+        """Start a thread that reloads, then swaps the result in; caller
+        holds the lock."""
+
+        generation = self._generation
+        context = self.context() if self.context else contextlib.nullcontext()
+        self._reloading = os.getpid()
+        self._changes = []
+
+        def run():
+            try:
+                with context:
+                    loaded = self._load()
+            except Exception:
+                logger.exception('reloading co-likes failed; will retry')
+                loaded = None
+
+            with self._lock:
+                self._reloading = None
+                changes, self._changes = self._changes, []
+
+                if loaded is None:
+                    # keep the old matrix for another ttl
+                    self._expires = time.monotonic() + self.ttl
+                elif generation == self._generation:
+                    self._use(loaded)
+                    # writes made while loading may not be in it; both
+                    # calls are no-ops for those that are
+                    for liked, user_id, cafe_id in changes:
+                        if liked:
+                            self.add(user_id, cafe_id)
+                        else:
+                            self.remove(user_id, cafe_id)
+
+        threading.Thread(
+            target=run, name='co-likes-reload', daemon=True).start()
+
+    def add(self, user_id, cafe_id):
+        """Note that user now likes cafe."""
+
+        with self._lock:
+            if self._reloading == os.getpid():
+                self._changes.append((True, user_id, cafe_id))
+            if not self._loaded:
+                return
+
+            liked = self._likes.setdefault(user_id, set())
+            if cafe_id in liked:
+                return
+
+            for other_id in liked:
+                self._bump(cafe_id, other_id, 1)
+            liked.add(cafe_id)
+            self._counts[cafe_id] = self._counts.get(cafe_id, 0) + 1
+            self._forget_similar(cafe_id)
+
+    def remove(self, user_id, cafe_id):
+        """Note that user no longer likes cafe."""
+
+        with self._lock:
+            if self._reloading == os.getpid():
+                self._changes.append((False, user_id, cafe_id))
+            if not self._loaded:
+                return
+
+            liked = self._likes.get(user_id, set())
+            if cafe_id not in liked:
+                return
+
+            liked.discard(cafe_id)
+            for other_id in liked:
+                self._bump(cafe_id, other_id, -1)
+            self._counts[cafe_id] -= 1
+            self._forget_similar(cafe_id)
+
+    def _bump(self, cafe_id, other_id, delta):
+        for a, b in [(cafe_id, other_id), (other_id, cafe_id)]:
+            row = self._rows.setdefault(a, {})
+            row[b] = row.get(b, 0) + delta
+            if not row[b]:
+                del row[b]
+            self._similar.pop(a, None)
+
+    def _forget_similar(self, cafe_id):
+        # cafe's like count is in the score of each of its neighbours
+        self._similar.pop(cafe_id, None)
+        for other_id in self._rows.get(cafe_id, ()):
+            self._similar.pop(other_id, None)
+
+    def _pool(self, cafe_id):
+        """Return the ids of up to POOL_SIZE cafes most like cafe_id, best
+        first, with their scores; caller holds the lock."""
+
+        pool = self._similar.get(cafe_id)
+        if pool is None:
+            likers = self._counts.get(cafe_id, 0)
+            scored = [
+                (co / sqrt(likers * self._counts[other_id]), -other_id)
+                for other_id, co in self._rows.get(cafe_id, {}).items()
+            ]
+            pool = [
+                (-neg_id, score)
+                for score, neg_id in heapq.nlargest(POOL_SIZE, scored)
+            ]
+            self._similar[cafe_id] = pool
+        return pool
+
+    def similar(self, cafe_id, k):
+        """Return the ids of the k cafes most often liked by the people who
+        like cafe_id, best first."""
+
+        with self._lock:
+            self._ensure_loaded()
+            return [other_id for other_id, _ in self._pool(cafe_id)[:k]]
+
+    def suggest(self, user_id, k):
+        """Return the ids of k cafes user doesn't like yet, best first:
+        those most similar, in total, to the cafes they do like."""
+
+        with self._lock:
+            self._ensure_loaded()
+            liked = self._likes.get(user_id, set())
+
+            scores = defaultdict(float)
+            for cafe_id in liked:
+                for other_id, score in self._pool(cafe_id):
+                    if other_id not in liked:
+                        scores[other_id] += score
+
+        best = heapq.nlargest(
+            k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [cafe_id for cafe_id, _ in best]
@@ -0,0 +1,213 @@
+"""Read-replica routing for Flask Cafe.
+
+GET and HEAD requests read from the replica binds named in READ_REPLICAS
+(keys of SQLALCHEMY_BINDS), taking turns between the healthy ones.
+Everything else uses the primary database:
+
+- requests with other methods, and anything outside a request
+- anything but an ORM SELECT: connection(), text() and Core statements
+- a session's flushes and bulk writes, and its reads after them
+- the next PRIMARY_STICKY_SECONDS of a client's requests after it
+  committed a change, so it sees its own writes (the redirect after
+  editing a cafe, say) whatever the replicas' lag
+
+Each replica is checked with "SELECT 1" at most every
+READ_REPLICA_CHECK_INTERVAL seconds, and taken out of turn when a check
+or a query finds it unreachable. With no healthy replicas, reads go to
+the primary.
+
+Settings, from app config:
+
+- READ_REPLICAS: bind keys of the replicas (default none)
+- READ_REPLICA_CHECK_INTERVAL: seconds between health checks (default 10)
+- PRIMARY_STICKY_SECONDS: primary-only window after a write (default 5)
+"""
+
+
+import itertools
+import logging
+import threading
+import time
+from functools import partial
+
+from flask import g, has_request_context, request
+from flask import session as client_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import Select
+
+
+logger = logging.getLogger('flaskcafe.replicas')
+
+READ_METHODS = ('GET', 'HEAD')
+STICKY_KEY = 'primary_until'
+
+_listening = False
+
+
+class ReplicaRouter:
+    """Picks a healthy replica bind for each session that can use one."""
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+        self._engines = {}
+        # {bind key: (healthy, time of next check)}
+        self._health = {}
+
+    def pick(self):
+        """Return the bind key of the next healthy replica, or None."""
+
+        keys = self.app.config['READ_REPLICAS']
+        if not keys:
+            return None
+
+        start = next(self._turns)
+        for i in range(len(keys)):
+            key = keys[(start + i) % len(keys)]
+            if self.is_healthy(key):
+                return key
+
+        return None
+
+    def engine(self, key):
+        """Return the engine for replica key."""
+
+        engine = self.db.get_engine(self.app, bind=key)
+        if self._engines.get(key) is not engine:
+            event.listen(engine, 'handle_error', partial(self._failed, key))
+            self._engines[key] = engine
+        return engine
+
+    def is_healthy(self, key):
+        """Return whether replica key is up, checking if a check is due."""
+
+        now = time.monotonic()
+        with self._lock:
+            healthy, next_check = self._health.get(key, (None, 0))
+            due = now >= next_check
+            if due:
+                # other threads use the last result while this one checks
+                interval = self.app.config['READ_REPLICA_CHECK_INTERVAL']
+                self._health[key] = (healthy, now + interval)
+
+        if not due:
+            return bool(healthy)
+
+        healthy = self._check(key)
+        with self._lock:
+            self._health[key] = (healthy, self._health[key][1])
+        return healthy
+
+    def mark_down(self, key):
+        """Take replica key out of turn until its next check."""
+
+        interval = self.app.config['READ_REPLICA_CHECK_INTERVAL']
+        with self._lock:
+            self._health[key] = (False, time.monotonic() + interval)
+
+    def _check(self, key):
+        try:
+            with self.engine(key).connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except SQLAlchemyError as exc:
+            logger.warning('replica %s is down: %s', key, exc)
+            return False
+        return True
+
+    def _failed(self, key, context):
+        if context.is_disconnect:
+            self.mark_down(key)
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from a replica when its app's router allows."""
+
+    def get_bind(self, mapper=None, clause=None):
+        """Return the engine for mapper/clause: a replica, if this is a
+        read in a read-only request, else the primary (or model's bind)."""
+
+        router = self.app.extensions.get('replicas')
+
+        if router is not None and self._may_use_replica(mapper, clause):
+            key = self.info.get('replica')
+            if key is None:
+                key = self.info['replica'] = router.pick() or False
+            if key:
+                return router.engine(key)
+
+        return super().get_bind(mapper, clause)
+
+    def _may_use_replica(self, mapper, clause):
+        if self._flushing or isinstance(clause, UpdateBase):
+            # reads after this session's writes must see them
+            self.info['primary'] = True
+
+        if self.info.get('primary') or not has_request_context():
+            return False
+
+        # a bare connection() or a text() statement could be a write
+        if not isinstance(clause, Select) and \
+                (mapper is None or clause is not None):
+            return False
+
+        if mapper is not None and \
+                mapper.persist_selectable.info.get('bind_key') is not None:
+            return False
+
+        if request.method not in READ_METHODS:
+            return False
+
+        return client_session.get(STICKY_KEY, 0) < time.time()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions can read from replicas; see init_app."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _note_commit(db_session):
+    if has_request_context() and request.method not in READ_METHODS:
+        g.committed_to_primary = True
+
+
+def init_app(app, db):
+    """Route app's read-only requests to its replicas, if it has any."""
+
+    global _listening
+
+    app.config.setdefault('READ_REPLICAS', [])
+    app.config.setdefault('READ_REPLICA_CHECK_INTERVAL', 10)
+    app.config.setdefault('PRIMARY_STICKY_SECONDS', 5)
+
+    app.extensions['replicas'] = ReplicaRouter(db, app)
+
+    if not _listening:
+        event.listen(Session, 'after_commit', _note_commit)
+        _listening = True
+
+    @app.before_request
+    def start_routing():
+        """Let this request pick its own replica, whatever the session did
+        before it."""
+
+        db.session.info.pop('primary', None)
+        db.session.info.pop('replica', None)
+
+    @app.after_request
+    def stick_to_primary(response):
+        """After a write, send this client's reads to the primary for a
+        while, so it sees its own changes."""
+
+        if g.get('committed_to_primary') and app.config['READ_REPLICAS']:
+            client_session[STICKY_KEY] = \
+                time.time() + app.config['PRIMARY_STICKY_SECONDS']
+
+        return response
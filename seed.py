@@ -1,98 +1,111 @@
-"""Initial data."""
+"""Initial data.
 
-from models import City, Cafe, User, db, connect_db
-from flask import Flask
+    python seed.py
 
-app = Flask(__name__)
+Drops and recreates every table in the FLASK_CONFIG profile's database.
+"""
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///flaskcafe'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+from models import City, Cafe, Like, User, db
+from app import create_app
 
-connect_db(app)
 
-db.drop_all()
-db.create_all()
+def seed():
+    """Replace the database's contents with the initial data."""
 
+    db.drop_all()
+    db.create_all()
 
-#######################################
-# add cities
 
-sf = City(code='sf', name='San Francisco', state='CA')
-berk = City(code='berk', name='Berkeley', state='CA')
-oak = City(code='oak', name='Oakland', state='CA')
+    #######################################
+    # add cities
 
-db.session.add_all([sf, berk, oak])
-db.session.commit()
+    sf = City(code='sf', name='San Francisco', state='CA')
+    berk = City(code='berk', name='Berkeley', state='CA')
+    oak = City(code='oak', name='Oakland', state='CA')
 
+    db.session.add_all([sf, berk, oak])
+    db.session.commit()
 
-#######################################
-# add cafes
 
-c1 = Cafe(
-    name="Bernie's Cafe",
-    description='Serving locals in Noe Valley. A great place to sit and write'
-        ' and write Rithm exercises.',
-    address="3966 24th St",
-    city_code='sf',
-    url='https://www.yelp.com/biz/bernies-san-francisco',
-    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg'
-)
+    #######################################
+    # add cafes
 
-c2 = Cafe(
-    name='Perch Coffee',
-    description='Hip and sleek place to get cardamom lattés when biking'
-        ' around Oakland.',
-    address='440 Grand Ave',
-    city_code='oak',
-    url='https://perchoffee.com',
-    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
-)
+    c1 = Cafe(
+        name="Bernie's Cafe",
+        description='Serving locals in Noe Valley. A great place to sit and write'
+            ' and write Rithm exercises.',
+        address="3966 24th St",
+        city_code='sf',
+        url='https://www.yelp.com/biz/bernies-san-francisco',
+        latitude=37.7516,
+        longitude=-122.4286,
+        image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg'
+    )
 
-db.session.add_all([c1, c2])
-db.session.commit()
+    c2 = Cafe(
+        name='Perch Coffee',
+        description='Hip and sleek place to get cardamom lattés when biking'
+            ' around Oakland.',
+        address='440 Grand Ave',
+        city_code='oak',
+        url='https://perchoffee.com',
+        latitude=37.8117,
+        longitude=-122.2476,
+        image_url='https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
+    )
 
+    db.session.add_all([c1, c2])
+    db.session.commit()
 
-#######################################
-# add users
 
-ua = User.register(
-    username="admin",
-    first_name="Addie",
-    last_name="MacAdmin",
-    description="I am the very model of the modern model administrator.",
-    email="admin@test.com",
-    password="secret",
-    admin=True,
-)
+    #######################################
+    # add users
 
-u1 = User.register(
-    username="test",
-    first_name="Testy",
-    last_name="MacTest",
-    description="I am the ultimate representative user.",
-    email="test@test.com",
-    password="secret",
-)
+    ua = User.register(
+        username="admin",
+        first_name="Addie",
+        last_name="MacAdmin",
+        description="I am the very model of the modern model administrator.",
+        email="admin@test.com",
+        password="secret",
+        admin=True,
+    )
 
-db.session.add_all([u1])
-db.session.commit()
+    u1 = User.register(
+        username="test",
+        first_name="Testy",
+        last_name="MacTest",
+        description="I am the ultimate representative user.",
+        email="test@test.com",
+        password="secret",
+    )
 
+    db.session.add_all([ua, u1])
+    db.session.commit()
 
-#######################################
-# add likes
 
-u1.liked_cafes.append(c1)
-u1.liked_cafes.append(c2)
-ua.liked_cafes.append(c1)
+    #######################################
+    # add likes
 
-db.session.commit()
+    # through Like.add, so cafe like counts and trending rollups agree
+    Like.add(u1.id, c1.id)
+    Like.add(u1.id, c2.id)
+    Like.add(ua.id, c1.id)
 
+    db.session.commit()
 
-#######################################
-# cafe maps
 
-# c1.save_map()
-# c2.save_map()
-#
-#db.session.commit()
+    #######################################
+    # cafe maps
+
+    # c1.save_map()
+    # c2.save_map()
+    #
+    #db.session.commit()
+
+
+if __name__ == '__main__':
+    # hash the few seed passwords here, rather than starting the password
+    # process pool for them
+    app = create_app(SQLALCHEMY_ECHO=True, PASSWORD_POOL_SIZE=0)
+    seed()
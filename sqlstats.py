@@ -0,0 +1,150 @@
+"""Per-request SQL statistics for Flask Cafe.
+
+Counts the statements each request runs and the time spent in them, and
+reports both in X-DB-Queries / X-DB-Time (and Server-Timing) response
+headers. A sample of requests also keeps the slowest statements and looks
+for the same statement run over and over (usually an N+1 loop in a view or
+template); those are written as one JSON line to the "flaskcafe.sql" log.
+
+Settings, from app config:
+
+- SQL_STATS_SAMPLE_RATE: share of requests analysed in detail (default 0.05)
+- SQL_STATS_SLOWEST: slowest statements kept per request (default 3)
+- SQL_STATS_REPEAT_THRESHOLD: runs of one statement that count as
+  repeated (default 5)
+"""
+
+
+import heapq
+import json
+import logging
+import random
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger('flaskcafe.sql')
+
+_listening = False
+
+
+class QueryStats:
+    """SQL statements run during one request."""
+
+    def __init__(self, sampled=False, keep_slowest=3):
+        self.count = 0
+        self.seconds = 0.0
+        self.sampled = sampled
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+        self.statements = Counter()
+
+    def record(self, statement, seconds):
+        """Note that statement ran and took seconds."""
+
+        self.count += 1
+        self.seconds += seconds
+
+        if self.sampled:
+            self.statements[statement] += 1
+            item = (seconds, statement)
+            if len(self.slowest) < self.keep_slowest:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def repeated(self, threshold):
+        """Return {statement: runs} for statements run threshold+ times."""
+
+        return {
+            statement: runs
+            for statement, runs in self.statements.most_common()
+            if runs >= threshold
+        }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context.sqlstats_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = getattr(context, 'sqlstats_started', None)
+
+    if started is not None and has_request_context():
+        stats = g.get('sql_stats')
+        if stats is not None:
+            stats.record(statement, time.perf_counter() - started)
+
+
+def init_app(app):
+    """Collect SQL statistics for each request to app."""
+
+    global _listening
+
+    app.config.setdefault('SQL_STATS_SAMPLE_RATE', 0.05)
+    app.config.setdefault('SQL_STATS_SLOWEST', 3)
+    app.config.setdefault('SQL_STATS_REPEAT_THRESHOLD', 5)
+
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+    @app.before_request
+    def start_sql_stats():
+        """Start counting this request's SQL."""
+
+        g.sql_stats = QueryStats(
+            sampled=random.random() < app.config['SQL_STATS_SAMPLE_RATE'],
+            keep_slowest=app.config['SQL_STATS_SLOWEST'],
+        )
+
+    @app.after_request
+    def report_sql_stats(response):
+        """Add SQL headers to response; log details if sampled."""
+
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+
+        db_ms = stats.seconds * 1000
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['X-DB-Time'] = f'{db_ms:.2f}'
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={db_ms:.2f};desc="{stats.count} queries"',
+        )
+
+        if stats.sampled:
+            threshold = app.config['SQL_STATS_REPEAT_THRESHOLD']
+            repeated = stats.repeated(threshold)
+            line = json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'queries': stats.count,
+                'db_ms': round(db_ms, 2),
+                'slowest': [
+                    {'ms': round(seconds * 1000, 2), 'sql': statement}
+                    for seconds, statement in sorted(stats.slowest,
+                                                     reverse=True)
+                ],
+                'repeated': [
+                    {'runs': runs, 'sql': statement}
+                    for statement, runs in repeated.items()
+                ],
+            })
+            if repeated:
+                logger.warning(line)
+            else:
+                logger.info(line)
+
+        return response
@@ -1,22 +1,11 @@
 $(document).ready(async function() {
 
+  // the page arrives showing the right button and count; these only change
+  // when the user clicks
+
   const $likeBtn = $("#like")
   const $unlikeBtn = $("#unlike")
-
-  async function checkLike(){
-    // returns True if current user likes cafe, else False
-    let response = await axios.get("/api/likes", {
-      params: {"cafe_id": cafe_id}
-    });
-    return response.data.likes;
-  }
-
-  async function displayProperButtons(){
-    hideBtn($likeBtn);
-    hideBtn($unlikeBtn);
-    await checkLike() ? showBtn($unlikeBtn) : showBtn($likeBtn);
-    return;
-  }
+  const $likeCount = $("#like-count")
 
   function hideBtn($btn){
     $btn.addClass("d-none");
@@ -32,6 +21,7 @@ $(document).ready(async function() {
     response = await axios.post("/api/like", {
       "cafe_id": cafe_id
     });
+    $likeCount.text(response.data.like_count);
     hideBtn($likeBtn);
     showBtn($unlikeBtn);
   });
@@ -42,9 +32,32 @@ $(document).ready(async function() {
     response = await axios.post("/api/unlike", {
       "cafe_id": cafe_id
     })
+    $likeCount.text(response.data.like_count);
     hideBtn($unlikeBtn);
     showBtn($likeBtn);
     });
 
-  displayProperButtons()
-})
\ No newline at end of file
+  // profile page: fetch the next page of liked cafes
+
+  const $moreLikedBtn = $("#more-liked")
+  const $likedList = $("#liked-cafes-list")
+
+  $moreLikedBtn.on("click", async function(evt){
+    evt.preventDefault();
+
+    let response = await axios.get("/api/profile/likes", {
+      params: {"after": $moreLikedBtn.data("after")}
+    });
+
+    for (let cafe of response.data.cafes) {
+      let $link = $("<a>").attr("href", `/cafes/${cafe.id}`).text(cafe.name);
+      $likedList.append($("<li>").append($link));
+    }
+
+    if (response.data.next) {
+      $moreLikedBtn.data("after", response.data.next);
+    } else {
+      hideBtn($moreLikedBtn);
+    }
+  });
+})
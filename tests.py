@@ -1,26 +1,46 @@
 """Tests for Flask Cafe."""
 
 
+import fcntl
+import gzip
+import http.server
+import io
+import ipaddress
+import os
 import re
-from unittest import TestCase
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
 
 from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, User, Like
+from PIL import Image
+from sqlalchemy import text
+from app import create_app, CURR_USER_KEY, user_cache, card_cache
+from app import write_buffered_likes
+from caches import LRUCache
+from models import db, Cafe, City, User, Like, city_table, passwords
+from models import co_likes
+from models import ImportCheckpoint, CafeLikeRollup
+import assets
+import geo
+import importer
+import likebuffer
+import loadtest
+import ratelimit
+import recommendations
+import thumbnails
+from pagination import encode_cursor
+from passwords import PasswordPoolBusy
 import json
 
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///flaskcafe-test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+# Use test database, without CSRF and with cheap password hashes; see
+# TestingConfig
+app = create_app('testing')
 
 db.drop_all()
 db.create_all()
@@ -124,6 +144,78 @@ class HomepageTestCase(TestCase):
             self.assertIn(b'Where Coffee Dreams Come True', resp.data)
 
 
+class AssetsTestCase(TestCase):
+    """Tests for fingerprinted, precompressed static assets."""
+
+    def setUp(self):
+        """Build a small static folder, and serve it."""
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.static = f"{self.tmpdir.name}/static"
+        os.makedirs(f"{self.static}/js")
+        with open(f"{self.static}/js/app.js", "w") as f:
+            f.write("console.log('hello');\n" * 100)
+        with open(f"{self.static}/styles.css", "w") as f:
+            f.write("body { color: black; }\n")
+
+        self.manifest = assets.build(self.static)
+
+        self.static_folder = app.static_folder
+        app.static_folder = self.static
+        app.config['ASSET_MANIFEST'] = f"{self.static}/dist/manifest.json"
+        assets.init_app(app)
+
+    def tearDown(self):
+        """Go back to serving static/ as is."""
+
+        app.static_folder = self.static_folder
+        app.config['ASSET_MANIFEST'] = None
+        assets.init_app(app)
+        self.tmpdir.cleanup()
+
+    def test_build(self):
+        self.assertRegex(
+            self.manifest["js/app.js"], r'^js/app\.[0-9a-f]{12}\.js$')
+        self.assertEqual(assets.build(self.static), self.manifest)
+
+        built = f"{self.static}/dist/{self.manifest['js/app.js']}"
+        with open(built, "rb") as original, open(f"{built}.gz", "rb") as gz:
+            self.assertEqual(gzip.decompress(gz.read()), original.read())
+
+    def test_pages_link_built_assets(self):
+        with app.test_client() as client:
+            html = client.get("/").data.decode('utf8')
+
+        self.assertIn(f'src="/assets/{self.manifest["js/app.js"]}"', html)
+        self.assertIn(f'href="/assets/{self.manifest["styles.css"]}"', html)
+        # not vendored in this static folder
+        self.assertIn('src="https://unpkg.com/jquery@3.5.1/', html)
+
+    def test_serves_precompressed(self):
+        url = f"/assets/{self.manifest['js/app.js']}"
+
+        with app.test_client() as client:
+            resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("javascript", resp.mimetype)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+            self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+            self.assertIn(b"hello", gzip.decompress(resp.data))
+
+            resp = client.get(url)
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn(b"hello", resp.data)
+
+            if assets.brotli is not None:
+                resp = client.get(
+                    url, headers={"Accept-Encoding": "gzip, deflate, br"})
+                self.assertEqual(resp.headers["Content-Encoding"], "br")
+
+            resp = client.get("/assets/js/app.js")
+            self.assertEqual(resp.status_code, 404)
+
+
 #######################################
 # cities
 
@@ -157,6 +249,47 @@ class CityModelTestCase(TestCase):
     # depending on how you solve exercise, you may have things to test on
     # the City model, so here's a good place to put that stuff.
 
+    def test_cities(self):
+        self.assertEqual(City.cities(), [("sf", "San Francisco")])
+
+    def test_lookup_invalidated_on_change(self):
+        version = city_table.version
+        self.assertEqual(City.lookup()["sf"].state, "CA")
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+        self.assertGreater(city_table.version, version)
+        self.assertEqual(City.lookup()["oak"].name, "Oakland")
+
+        City.query.get("sf").name = "San Fran"
+        db.session.commit()
+        self.assertEqual(City.lookup()["sf"].name, "San Fran")
+
+        City.query.filter_by(code="oak").delete()
+        db.session.commit()
+        self.assertNotIn("oak", City.lookup())
+
+
+class CacheTestCase(TestCase):
+    """Tests for in-process caches."""
+
+    def test_lru_cache_byte_bound(self):
+        cache = LRUCache(maxsize=10, maxbytes=10)
+        cache.set("a", "12345")
+        cache.set("b", "12345")
+        self.assertEqual(cache.get("a"), "12345")
+
+        # "b" is least recently used now, so it goes first
+        cache.set("c", "123")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["bytes"], 8)
+
+        # values bigger than the whole cache aren't kept
+        cache.set("d", "x" * 11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.pop("a"), "12345")
+        self.assertEqual(cache.stats()["bytes"], 3)
+
 
 #######################################
 # cafes
@@ -224,6 +357,225 @@ class CafeViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
 
+    def test_list_pagination(self):
+        db.session.add(Cafe(**dict(CAFE_DATA, name="Another Cafe")))
+        db.session.commit()
+
+        per_page = app.config['CAFES_PER_PAGE']
+        app.config['CAFES_PER_PAGE'] = 1
+
+        try:
+            page = Cafe.get_page(1)
+            self.assertEqual([c.name for c in page], ["Another Cafe"])
+            self.assertIsNone(page.prev_cursor)
+
+            with app.test_client() as client:
+                resp = client.get(f"/cafes?after={page.next_cursor}")
+                self.assertIn(b"Test Cafe", resp.data)
+                self.assertNotIn(b"Another Cafe", resp.data)
+                self.assertIn(b"Previous", resp.data)
+                self.assertNotIn(b"Next", resp.data)
+
+                prev_cursor = Cafe.get_page(1, after=page.next_cursor) \
+                    .prev_cursor
+                resp = client.get(f"/cafes?before={prev_cursor}")
+                self.assertIn(b"Another Cafe", resp.data)
+
+                resp = client.get("/cafes?after=garbage")
+                self.assertEqual(resp.status_code, 400)
+
+                # well-formed, but not (name, id) values
+                for values in ([[1], 2], ["Cafe", "2"], ["Cafe", True]):
+                    tampered = encode_cursor(values)
+                    resp = client.get(f"/cafes?after={tampered}")
+                    self.assertEqual(resp.status_code, 400)
+                    resp = client.get(f"/api/cafes?before={tampered}")
+                    self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['CAFES_PER_PAGE'] = per_page
+
+    def test_detail_conditional_get(self):
+        with app.test_client() as client:
+            first = client.get(f"/cafes/{self.cafe_id}")
+            etag = first.headers['ETag']
+            last_modified = first.headers['Last-Modified']
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+            # werkzeug drops Last-Modified from 304s itself
+            for header in ['ETag', 'Cache-Control', 'Vary']:
+                self.assertEqual(
+                    resp.headers.get(header), first.headers[header])
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}",
+                headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+            Cafe.query.get(self.cafe_id).name = "Renamed Cafe"
+            db.session.commit()
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Renamed Cafe", resp.data)
+
+            resp = client.get("/cafes/0", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_list_conditional_get(self):
+        with app.test_client() as client:
+            etag = client.get("/cafes").headers['ETag']
+
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # other pages of the list have their own tags
+            resp = client.get(
+                "/cafes?sort=popular", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            db.session.add(Cafe(**dict(CAFE_DATA, name="Newer Cafe")))
+            db.session.commit()
+
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Newer Cafe", resp.data)
+
+    def test_card_cache(self):
+        card_cache.clear()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers['X-Card-Cache'], "0 hit, 1 miss")
+
+            resp = client.get("/cafes?sort=popular")
+            self.assertEqual(resp.headers['X-Card-Cache'], "1 hit, 0 miss")
+
+            client.post(
+                f"/cafes/{self.cafe_id}/edit",
+                data=CAFE_DATA_EDIT,
+            )
+            self.assertNotIn(self.cafe_id, card_cache)
+
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers['X-Card-Cache'], "0 hit, 1 miss")
+            self.assertIn(b"new-name", resp.data)
+
+    def test_sql_stats(self):
+        sample_rate = app.config['SQL_STATS_SAMPLE_RATE']
+        app.config['SQL_STATS_SAMPLE_RATE'] = 1
+        app.config['SQL_STATS_REPEAT_THRESHOLD'] = 1
+
+        try:
+            with app.test_client() as client:
+                with self.assertLogs('flaskcafe.sql', 'WARNING') as logs:
+                    resp = client.get(f"/cafes/{self.cafe_id}")
+
+            self.assertGreaterEqual(int(resp.headers['X-DB-Queries']), 1)
+            self.assertIn('db;dur=', resp.headers['Server-Timing'])
+
+            line = json.loads(logs.records[0].getMessage())
+            self.assertEqual(line['endpoint'], 'main.cafe_detail')
+            self.assertIn('FROM cafes', line['repeated'][0]['sql'])
+        finally:
+            app.config['SQL_STATS_SAMPLE_RATE'] = sample_rate
+            app.config['SQL_STATS_REPEAT_THRESHOLD'] = 5
+
+    def test_cafes_api(self):
+        db.session.add(Cafe(**dict(CAFE_DATA, name="Another Cafe")))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/api/cafes?fields=name&per_page=1")
+            self.assertEqual(resp.headers['X-DB-Queries'], '1')
+            self.assertEqual(list(resp.json["cafes"][0]), ["id", "name"])
+            self.assertEqual(resp.json["cafes"][0]["name"], "Another Cafe")
+            self.assertIsNone(resp.json["prev"])
+
+            resp = client.get(
+                "/api/cafes?fields=url&include=city,like_count&per_page=1"
+                f"&after={resp.json['next']}")
+            self.assertEqual(resp.json["cafes"], [{
+                "id": self.cafe_id,
+                "url": CAFE_DATA["url"],
+                "like_count": 0,
+                "city": {"name": "San Francisco", "state": "CA"},
+            }])
+            self.assertIsNone(resp.json["next"])
+
+            resp = client.get(f"/api/cafes/{self.cafe_id}")
+            self.assertEqual(
+                set(resp.json["cafe"]), set(Cafe.API_FIELDS))
+            self.assertEqual(resp.json["cafe"]["name"], "Test Cafe")
+
+            resp = client.get(f"/api/cafes/{self.cafe_id}?fields=secret")
+            self.assertEqual(resp.status_code, 400)
+            resp = client.get(f"/api/cafes/{self.cafe_id + 1000}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_nearby(self):
+        Cafe.query.get(self.cafe_id).latitude = 37.7749
+        Cafe.query.get(self.cafe_id).longitude = -122.4194
+        db.session.add_all([
+            Cafe(**dict(CAFE_DATA, name="Close Cafe",
+                        latitude=37.7790, longitude=-122.4140)),
+            Cafe(**dict(CAFE_DATA, name="Oakland Cafe",
+                        latitude=37.8044, longitude=-122.2712)),
+            Cafe(**dict(CAFE_DATA, name="Unplaced Cafe")),
+        ])
+        db.session.commit()
+
+        self.assertEqual(
+            Cafe.query.get(self.cafe_id).geohash, geo.encode(37.7749, -122.4194))
+
+        with app.test_client() as client:
+            resp = client.get(
+                "/api/cafes/nearby?lat=37.7750&lng=-122.4190&radius=5")
+            cafes = resp.json["cafes"]
+            self.assertEqual(
+                [c["name"] for c in cafes], ["Test Cafe", "Close Cafe"])
+            self.assertLess(cafes[0]["distance_km"], cafes[1]["distance_km"])
+
+            resp = client.get(
+                "/api/cafes/nearby?lat=37.7750&lng=-122.4190"
+                "&radius=20&limit=1")
+            self.assertEqual(
+                [c["name"] for c in resp.json["cafes"]], ["Test Cafe"])
+
+            resp = client.get(
+                "/api/cafes/nearby?lat=37.7750&lng=-122.4190&radius=20")
+            self.assertEqual(len(resp.json["cafes"]), 3)
+
+            resp = client.get("/api/cafes/nearby?lat=north&lng=-122.4")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_search(self):
+        db.session.add(Cafe(**dict(
+            CAFE_DATA,
+            name="Espresso Bar",
+            description="Best espresso on Sansome",
+            address="1 Market St",
+        )))
+        db.session.commit()
+
+        page = Cafe.search("sansome", 10)
+        self.assertEqual(
+            [c.name for c in page], ["Espresso Bar", "Test Cafe"])
+
+        page = Cafe.search("espresso", 10)
+        self.assertEqual([c.name for c in page], ["Espresso Bar"])
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?q=espresso")
+            self.assertIn(b"Espresso Bar", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            resp = client.get("/cafes?q=tea")
+            self.assertIn(b'No cafes match "tea".', resp.data)
+
     def test_detail(self):
         with app.test_client() as client:
             resp = client.get(f"/cafes/{self.cafe_id}")
@@ -299,6 +651,262 @@ class CafeAdminViewsTestCase(TestCase):
             self.assertIn(b'edited', resp.data)
 
 
+class ThumbnailTestCase(TestCase):
+    """Tests for cafe and profile image thumbnails."""
+
+    def setUp(self):
+        """Add a city and cafe, and an image for a LocalFileFetcher to
+        fetch."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+        self.cafe_id = cafe.id
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.makedirs(f"{self.tmpdir.name}/source/photos")
+        Image.new('RGB', (1600, 800), 'teal').save(
+            f"{self.tmpdir.name}/source/photos/big.jpg")
+
+        app.config['THUMBNAIL_FETCHER'] = \
+            thumbnails.LocalFileFetcher(f"{self.tmpdir.name}/source")
+        app.config['THUMBNAIL_DIR'] = f"{self.tmpdir.name}/thumbs"
+
+    def tearDown(self):
+        """Stop making thumbnails, and remove test data."""
+
+        app.config['THUMBNAIL_FETCHER'] = None
+        app.config['THUMBNAIL_DIR'] = None
+        self.tmpdir.cleanup()
+
+        Cafe.query.delete()
+        User.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_cafe_thumbnails(self):
+        with app.test_client() as client:
+            resp = client.post(
+                f"/cafes/{self.cafe_id}/edit",
+                data=dict(
+                    CAFE_DATA_EDIT,
+                    image_url="https://images.example.com/photos/big.jpg",
+                ),
+            )
+            self.assertEqual(resp.status_code, 302)
+
+            thumbnail = Cafe.query.get(self.cafe_id).thumbnail
+            self.assertTrue(thumbnail)
+
+            html = client.get("/cafes").data.decode('utf8')
+            webp = f"/thumbnails/{thumbnail}-card.webp"
+            self.assertIn(f'srcset="{webp}"', html)
+            self.assertIn(f'src="/thumbnails/{thumbnail}-card.jpg"', html)
+
+            resp = client.get(webp)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "image/webp")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertEqual(
+                Image.open(io.BytesIO(resp.data)).size, (400, 300))
+
+            resp = client.get(f"/thumbnails/{thumbnail}-page.jpg")
+            self.assertEqual(
+                Image.open(io.BytesIO(resp.data)).size, (600, 300))
+
+            resp = client.get("/thumbnails/..%2Fsource%2Fphotos%2Fbig.jpg")
+            self.assertEqual(resp.status_code, 404)
+
+        # a new image shows as itself until its thumbnails are made
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.image_url = "https://images.example.com/photos/missing.jpg"
+        db.session.commit()
+        self.assertIsNone(cafe.thumbnail)
+
+        with app.test_client() as client:
+            html = client.get(f"/cafes/{self.cafe_id}").data.decode('utf8')
+            self.assertIn(
+                'src="https://images.example.com/photos/missing.jpg"', html)
+
+    def test_profile_thumbnails(self):
+        with app.test_client() as client:
+            client.post("/signup", data=dict(
+                TEST_USER_DATA_NEW,
+                image_url="https://images.example.com/photos/big.jpg",
+            ))
+            user = User.query.filter_by(username="new-username").one()
+            self.assertTrue(user.thumbnail)
+
+            html = client.get("/profile").data.decode('utf8')
+            self.assertIn(f'src="/thumbnails/{user.thumbnail}-page.jpg"', html)
+
+    def test_fetch_refuses_internal_addresses(self):
+        for url in [
+            "http://169.254.169.254/latest/meta-data/",
+            "http://127.0.0.1:5432/",
+            "http://10.0.0.5/admin",
+            "http://[::ffff:192.168.0.1]/",
+            "http://localhost/photo.jpg",
+            "file:///etc/passwd",
+            "ftp://images.example.com/photo.jpg",
+        ]:
+            with self.assertRaises(thumbnails.ThumbnailError, msg=url):
+                thumbnails.fetch_url(url, 1024)
+
+    def test_fetch_checks_redirects(self):
+        """A public image server can't redirect the fetch inside, either."""
+
+        class Redirect(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(302)
+                self.send_header("Location", "http://10.0.0.5/admin")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Redirect)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+        public_address = thumbnails.public_address
+
+        def pretend_public(name, port):
+            if name == host:
+                return ipaddress.ip_address(host)
+            return public_address(name, port)
+
+        try:
+            with mock.patch.object(
+                    thumbnails, 'public_address', pretend_public):
+                with self.assertRaisesRegex(
+                        thumbnails.ThumbnailError, "not a public address"):
+                    thumbnails.fetch_url(f"http://{host}:{port}/a.jpg", 1024)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class ImporterTestCase(TestCase):
+    """Tests for the bulk importer."""
+
+    def setUp(self):
+        """Before each test, add sample city and an input file."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        ImportCheckpoint.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "cafes.ndjson")
+
+        with open(self.path, "w") as f:
+            f.write(json.dumps(CAFE_DATA) + "\n")
+            f.write(json.dumps(dict(CAFE_DATA, city_code="nowhere")) + "\n")
+            f.write(json.dumps(dict(
+                CAFE_DATA, name="Third Cafe", latitude=37.79, longitude=-122.4
+                )) + "\n")
+
+    def tearDown(self):
+        """After each test, remove cafes, cities and checkpoints."""
+
+        self.tmp.cleanup()
+        Cafe.query.delete()
+        City.query.delete()
+        ImportCheckpoint.query.delete()
+        db.session.commit()
+
+    def test_import(self):
+        with app.test_request_context():
+            stats = importer.import_file("cafes", self.path, chunk_size=2)
+
+        self.assertEqual((stats.inserted, stats.rejected), (2, 1))
+        self.assertIn("row 2: city_code", stats.errors[0])
+        self.assertEqual(
+            sorted(c.name for c in Cafe.query),
+            ["Test Cafe", "Third Cafe"])
+        self.assertEqual(Cafe.search("third", 10).items[0].name, "Third Cafe")
+        self.assertEqual(
+            Cafe.query.filter_by(name="Third Cafe").one().geohash,
+            geo.encode(37.79, -122.4))
+        self.assertIsNone(
+            Cafe.query.filter_by(name="Test Cafe").one().latitude)
+
+    def test_import_locations(self):
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+        cafe_id = cafe.id
+
+        path = os.path.join(self.tmp.name, "locations.csv")
+        with open(path, "w") as f:
+            f.write("id,latitude,longitude\n")
+            f.write(f"{cafe_id},37.7749,-122.4194\n")
+            f.write(f"{cafe_id},north,west\n")
+
+        with app.test_request_context():
+            stats = importer.import_locations(path)
+
+        self.assertEqual((stats.inserted, stats.rejected), (1, 1))
+        cafe = Cafe.query.get(cafe_id)
+        self.assertEqual((cafe.latitude, cafe.longitude), (37.7749, -122.4194))
+        self.assertEqual(cafe.geohash, geo.encode(37.7749, -122.4194))
+
+    def test_resume(self):
+        with app.test_request_context():
+            importer.import_file("cafes", self.path, chunk_size=2)
+
+            with open(self.path, "a") as f:
+                f.write(json.dumps(dict(CAFE_DATA, name="Fourth")) + "\n")
+
+            stats = importer.import_file("cafes", self.path, chunk_size=2)
+
+        self.assertEqual((stats.skipped, stats.inserted), (3, 1))
+        self.assertEqual(Cafe.query.count(), 3)
+
+    def test_import_users(self):
+        User.query.delete()
+        db.session.add(User.register(**TEST_USER_DATA))
+        db.session.commit()
+        hashed = User.query.one().hashed_password
+
+        path = os.path.join(self.tmp.name, "users.ndjson")
+        with open(path, "w") as f:
+            f.write(json.dumps(TEST_USER_DATA) + "\n")
+            f.write(json.dumps(TEST_USER_DATA_NEW) + "\n")
+            f.write(json.dumps(dict(
+                TEST_USER_DATA_NEW, username="other", password="secret2"
+                )) + "\n")
+            f.write(json.dumps(dict(
+                TEST_USER_DATA_NEW, username="prehashed", password=None,
+                hashed_password=hashed)) + "\n")
+
+        try:
+            with app.app_context(), mock.patch.object(
+                    passwords, 'hash_many',
+                    wraps=passwords.hash_many) as hash_many:
+                stats = importer.import_file("users", path)
+
+            self.assertEqual((stats.inserted, stats.rejected), (3, 1))
+            # one batch, without the taken username or the prehashed one
+            hash_many.assert_called_once_with(["secret", "secret2"])
+
+            self.assertTrue(User.authenticate("new-username", "secret"))
+            self.assertTrue(User.authenticate("other", "secret2"))
+            self.assertTrue(User.authenticate("prehashed", "secret"))
+        finally:
+            User.query.delete()
+            db.session.commit()
+
+
 #######################################
 # users
 
@@ -344,6 +952,37 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u.hashed_password[:4], "$2b$")
         db.session.rollback()
 
+    def test_authenticate_rehashes(self):
+        self.assertEqual(self.user.hashed_password[:7], "$2b$04$")
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        try:
+            rez = User.authenticate("test", "secret")
+            self.assertEqual(rez.hashed_password[:7], "$2b$05$")
+            db.session.commit()
+            self.assertTrue(User.authenticate("test", "secret"))
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+    def test_password_pool_busy(self):
+        queue_depth = app.config['PASSWORD_QUEUE_DEPTH']
+        app.config['PASSWORD_QUEUE_DEPTH'] = 0
+        passwords.shutdown()
+
+        try:
+            with self.assertRaises(PasswordPoolBusy):
+                User.authenticate("test", "secret")
+
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+                self.assertEqual(resp.status_code, 503)
+        finally:
+            app.config['PASSWORD_QUEUE_DEPTH'] = queue_depth
+            passwords.shutdown()
+
 
 class AuthViewsTestCase(TestCase):
     """Tests for views on logging in/logging out/registration."""
@@ -402,6 +1041,27 @@ class AuthViewsTestCase(TestCase):
             self.assertIn(b"Hello, Testy MacTest", resp.data)
             self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
 
+    def test_long_password(self):
+        # 40 characters, but 80 bytes: more than bcrypt can hash
+        password = "\u00e9" * 40
+
+        with app.test_client() as client:
+            resp = client.post(
+                "/signup",
+                data=dict(TEST_USER_DATA_NEW, password=password),
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"cannot be longer than 72 bytes", resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": password},
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+        self.assertFalse(User.authenticate("test", password))
+
     def test_logout(self):
         with app.test_client() as client:
             do_login(client, self.user_id)
@@ -411,6 +1071,66 @@ class AuthViewsTestCase(TestCase):
             self.assertEqual(session.get(CURR_USER_KEY), None)
 
 
+class RateLimitTestCase(TestCase):
+    """Tests for throttling login and signup attempts."""
+
+    def setUp(self):
+        """Allow four attempts per IP and two per username, with next to
+        no refill."""
+
+        self.limits = app.config['RATE_LIMITS']
+        app.config['RATE_LIMITS'] = {
+            'main.login_user': {'ip': (4, 0.001), 'username': (2, 0.001)},
+        }
+        app.config['RATE_LIMIT_ENABLED'] = True
+        app.extensions['rate_limit'].clear()
+
+    def tearDown(self):
+        app.config['RATE_LIMITS'] = self.limits
+        app.config['RATE_LIMIT_ENABLED'] = False
+        app.extensions['rate_limit'].clear()
+
+    def login(self, client, username):
+        return client.post(
+            "/login", data={"username": username, "password": "WRONG"})
+
+    def test_login_throttled(self):
+        with app.test_client() as client:
+            for _ in range(2):
+                self.assertEqual(self.login(client, "test").status_code, 200)
+
+            resp = self.login(client, "Test")
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.mimetype, "text/plain")
+            self.assertGreater(int(resp.headers["Retry-After"]), 0)
+
+            # every attempt counts against the IP, so it has one left
+            self.assertEqual(self.login(client, "other").status_code, 200)
+            self.assertEqual(self.login(client, "another").status_code, 429)
+
+            # only attempts are limited
+            self.assertEqual(client.get("/login").status_code, 200)
+
+    def test_buckets_refill(self):
+        state, wait = ratelimit.take_from(None, 2, 0.5, now=100)
+        self.assertEqual((state, wait), ((1, 100), 0))
+        state, wait = ratelimit.take_from(state, 2, 0.5, now=100)
+        state, wait = ratelimit.take_from(state, 2, 0.5, now=100)
+        self.assertEqual(wait, 2)
+        state, wait = ratelimit.take_from(state, 2, 0.5, now=102)
+        self.assertEqual(wait, 0)
+
+    def test_shared_buckets(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            one = ratelimit.SQLiteBuckets(f"{tmpdir}/buckets.db")
+            two = ratelimit.SQLiteBuckets(f"{tmpdir}/buckets.db")
+
+            self.assertEqual(one.take("ip:1.2.3.4", 2, 0.001), 0)
+            self.assertEqual(two.take("ip:1.2.3.4", 2, 0.001), 0)
+            self.assertGreater(one.take("ip:1.2.3.4", 2, 0.001), 0)
+            self.assertEqual(two.take("ip:5.6.7.8", 2, 0.001), 0)
+
+
 class NavBarTestCase(TestCase):
     """Tests navigation bar."""
 
@@ -511,6 +1231,19 @@ class ProfileViewsTestCase(TestCase):
                 follow_redirects=True)
             self.assertIn(b'Profile edited.', resp.data)
 
+    def test_cached_user_forgotten_on_edit(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            client.get("/cafes")
+            self.assertIn(self.user_id, user_cache)
+
+            resp = client.post(
+                f"/profile/edit",
+                data=TEST_USER_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'new-fn new-ln', resp.data)
+            self.assertEqual(user_cache.get(self.user_id).first_name, "new-fn")
+
 
 #######################################
 # likes
@@ -557,6 +1290,31 @@ class LikeViewsTestCase(TestCase):
 
         db.session.commit()
 
+    def test_like_keeps_cards_and_name_list(self):
+        user_id = self.user.id
+        card_cache.clear()
+
+        with app.test_client() as client:
+            list_etag = client.get("/cafes").headers['ETag']
+            popular_etag = client.get("/cafes?sort=popular").headers['ETag']
+            detail_etag = client.get(f"/cafes/{self.cafe_id}").headers['ETag']
+
+            Like.remove(user_id, self.cafe_id)
+            db.session.commit()
+
+            resp = client.get("/cafes", headers={"If-None-Match": list_etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.get(
+                "/cafes?sort=popular", headers={"If-None-Match": popular_etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['X-Card-Cache'], "1 hit, 0 miss")
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}",
+                headers={"If-None-Match": detail_etag})
+            self.assertEqual(resp.status_code, 200)
+
     def test_no_likes(self):
         with app.test_client() as client:
             do_login(client, self.user.id)
@@ -588,6 +1346,23 @@ class LikeViewsTestCase(TestCase):
             resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
             self.assertIn(b'"likes": true', resp.data)
 
+    def test_user_likes_cafes_batch(self):
+        other = Cafe(**dict(CAFE_DATA, name="Other Cafe"))
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+
+        with app.test_client() as client:
+            do_login(client, self.user.id)
+            resp = client.get(
+                f"/api/likes?cafe_ids={self.cafe_id},{other_id}")
+            self.assertEqual(
+                resp.json,
+                {"likes": {str(self.cafe_id): True, str(other_id): False}})
+
+            resp = client.get("/api/likes?cafe_ids=1,two")
+            self.assertEqual(resp.status_code, 400)
+
     def test_like_cafe(self):
         # delete all likes, post a like, check response and table
         with app.test_client() as client:
@@ -614,6 +1389,218 @@ class LikeViewsTestCase(TestCase):
             ), resp.data)
             self.assertTrue(Like.query.first())
 
+    def test_like_count_floor(self):
+        # setUp's like isn't counted, so unliking it would make the count -1
+        state = Like.remove(self.user.id, self.cafe_id)
+        db.session.commit()
+        self.assertTrue(state.changed)
+        self.assertEqual(Cafe.query.get(self.cafe_id).like_count, 0)
+
+        Cafe.adjust_like_count(self.cafe_id, -1)
+        db.session.commit()
+        self.assertEqual(Cafe.query.get(self.cafe_id).like_count, 0)
+
+    def test_like_counts(self):
+        other = Cafe(**dict(CAFE_DATA, name="Other Cafe"))
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+
+        # setUp added its like behind the counter's back
+        self.assertEqual(Cafe.reconcile_like_counts(), 1)
+        db.session.commit()
+
+        with app.test_client() as client:
+            do_login(client, self.user.id)
+            client.post(
+                "/api/like",
+                data=json.dumps({"cafe_id": other_id}),
+                content_type='application/json'
+            )
+            self.assertEqual(Cafe.query.get(other_id).like_count, 1)
+
+            client.post(
+                "/api/unlike",
+                data=json.dumps({"cafe_id": self.cafe_id}),
+                content_type='application/json'
+            )
+            self.assertEqual(Cafe.query.get(self.cafe_id).like_count, 0)
+            self.assertEqual(Cafe.reconcile_like_counts(), 0)
+
+            page = Cafe.get_page(1, sort='popular')
+            self.assertEqual([c.name for c in page], ["Other Cafe"])
+            page = Cafe.get_page(1, after=page.next_cursor, sort='popular')
+            self.assertEqual([c.name for c in page], ["Test Cafe"])
+
+            resp = client.get("/cafes?sort=popular")
+            html = resp.data.decode('utf8')
+            self.assertLess(html.index("Other Cafe"), html.index("Test Cafe"))
+
+    def test_trending(self):
+        other = Cafe(**dict(CAFE_DATA, name="Other Cafe"))
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+
+        # setUp's like was added without its rollups; count them
+        CafeLikeRollup.rebuild()
+        db.session.commit()
+
+        with app.test_client() as client:
+            do_login(client, self.user.id)
+            client.post(
+                "/api/like",
+                data=json.dumps({"cafe_id": other_id}),
+                content_type='application/json'
+            )
+
+            resp = client.get("/api/cafes/trending")
+            self.assertEqual(resp.json["window"], "24h")
+            self.assertEqual(
+                [(c["name"], c["likes"]) for c in resp.json["cafes"]],
+                [("Test Cafe", 1), ("Other Cafe", 1)])
+
+            client.post(
+                "/api/like/toggle",
+                data=json.dumps({"cafe_id": self.cafe_id}),
+                content_type='application/json'
+            )
+            resp = client.get("/api/cafes/trending?window=7d&limit=5")
+            self.assertEqual(
+                [c["id"] for c in resp.json["cafes"]], [other_id])
+
+            resp = client.get("/api/cafes/trending?window=1y")
+            self.assertEqual(resp.status_code, 400)
+
+        # a rebuild recounts what the like writes kept up
+        def buckets():
+            return {
+                (r.granularity, r.bucket, r.cafe_id, r.likes)
+                for r in CafeLikeRollup.query if r.likes
+            }
+
+        kept = buckets()
+        CafeLikeRollup.rebuild()
+        db.session.commit()
+        self.assertEqual(buckets(), kept)
+
+    def test_trending_windows(self):
+        """Buckets outside the window are left out, and pruned once past
+        their retention."""
+
+        now = datetime(2020, 6, 10, 12, 30)
+        hour = datetime(2020, 6, 10, 12)
+        db.session.add_all([
+            CafeLikeRollup(
+                granularity='hour',
+                bucket=hour - timedelta(hours=h),
+                cafe_id=self.cafe_id,
+                likes=1,
+            )
+            for h in [0, 23, 24, 50]
+        ])
+        db.session.commit()
+
+        self.assertEqual(
+            CafeLikeRollup.trending('24h', 10, now=now),
+            [(self.cafe_id, self.cafe_name, 2)])
+        self.assertEqual(CafeLikeRollup.trending('7d', 10, now=now), [])
+
+        self.assertEqual(CafeLikeRollup.prune(now=now), 1)
+        db.session.commit()
+
+    def test_profile_liked_cafes(self):
+        for i, name in enumerate(["Second Cafe", "Third Cafe"], start=1):
+            cafe = Cafe(**dict(CAFE_DATA, name=name))
+            db.session.add(cafe)
+            db.session.flush()
+            db.session.add(Like(
+                user_id=self.user.id,
+                cafe_id=cafe.id,
+                created_at=self.like.created_at + timedelta(minutes=i),
+            ))
+        db.session.commit()
+
+        per_page = app.config['LIKED_CAFES_PER_PAGE']
+        app.config['LIKED_CAFES_PER_PAGE'] = 2
+
+        try:
+            with app.test_client() as client:
+                do_login(client, self.user.id)
+                html = client.get("/profile").data.decode('utf8')
+                self.assertIn("Liked Cafes (3)", html)
+                self.assertLess(
+                    html.index("Third Cafe"), html.index("Second Cafe"))
+                self.assertNotIn(self.cafe_name, html)
+
+                after = re.search(r'data-after="([^"]+)"', html).group(1)
+                resp = client.get(f"/api/profile/likes?after={after}")
+                self.assertEqual(
+                    [c["name"] for c in resp.json["cafes"]], [self.cafe_name])
+                self.assertIsNone(resp.json["next"])
+        finally:
+            app.config['LIKED_CAFES_PER_PAGE'] = per_page
+
+    def test_recommendations(self):
+        other = Cafe(**dict(CAFE_DATA, name="Other Cafe"))
+        fan = User.register(**dict(TEST_USER_DATA, username="fan"))
+        db.session.add_all([other, fan])
+        db.session.commit()
+        other_id = other.id
+        fan_id = fan.id
+        user_id = self.user.id
+        co_likes.invalidate()
+
+        with app.test_client() as client:
+            do_login(client, fan_id)
+            for cafe_id in [self.cafe_id, other_id]:
+                client.post(
+                    "/api/like",
+                    data=json.dumps({"cafe_id": cafe_id}),
+                    content_type='application/json'
+                )
+
+            html = client.get(f"/cafes/{self.cafe_id}").data.decode('utf8')
+            self.assertIn("People who liked this also liked", html)
+            self.assertIn(f'href="/cafes/{other_id}">Other Cafe', html)
+
+            do_login(client, user_id)
+            html = client.get("/profile").data.decode('utf8')
+            self.assertIn("You might also like", html)
+            self.assertIn(f'href="/cafes/{other_id}">Other Cafe', html)
+
+    def test_detail_like_state(self):
+        Cafe.reconcile_like_counts()
+        db.session.commit()
+
+        def button_classes(html, button_id):
+            return re.search(
+                f'class="([^"]*)" id="{button_id}"', html).group(1).split()
+
+        with app.test_client() as client:
+            html = client.get(f"/cafes/{self.cafe_id}").data.decode('utf8')
+            self.assertNotIn('id="like"', html)
+            self.assertIn('<span id="like-count">1</span>', html)
+
+            do_login(client, self.user.id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            html = resp.data.decode('utf8')
+            self.assertIn("d-none", button_classes(html, "like"))
+            self.assertNotIn("d-none", button_classes(html, "unlike"))
+            # the user snapshot, then the cafe with its like state
+            self.assertLessEqual(int(resp.headers['X-DB-Queries']), 2)
+
+            client.post(
+                "/api/unlike",
+                data=json.dumps({"cafe_id": self.cafe_id}),
+                content_type='application/json'
+            )
+            resp2 = client.get(f"/cafes/{self.cafe_id}")
+            html = resp2.data.decode('utf8')
+            self.assertNotIn("d-none", button_classes(html, "like"))
+            self.assertIn('<span id="like-count">0</span>', html)
+            self.assertNotEqual(resp.headers['ETag'], resp2.headers['ETag'])
+
     def test_unlike_cafe(self):
         with app.test_client() as client:
             # test not logged in response
@@ -642,3 +1629,475 @@ class LikeViewsTestCase(TestCase):
                     user_id=self.user.id,
                     cafe_id=self.cafe_id
                     ).first())
+
+    def test_like_writes_are_idempotent(self):
+        with app.test_client() as client:
+            do_login(client, self.user.id)
+            Like.query.delete()
+            db.session.commit()
+
+            for _ in range(2):
+                resp = client.post(
+                    "/api/like",
+                    data=json.dumps({"cafe_id": self.cafe_id}),
+                    content_type='application/json'
+                )
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json["likes"], True)
+                self.assertEqual(resp.json["like_count"], 1)
+            self.assertEqual(Like.query.count(), 1)
+
+            for _ in range(2):
+                resp = client.post(
+                    "/api/unlike",
+                    data=json.dumps({"cafe_id": self.cafe_id}),
+                    content_type='application/json'
+                )
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json["likes"], False)
+                self.assertEqual(resp.json["like_count"], 0)
+            self.assertEqual(Like.query.count(), 0)
+
+            resp = client.post(
+                "/api/like",
+                data=json.dumps({"cafe_id": self.cafe_id + 1000}),
+                content_type='application/json'
+            )
+            self.assertEqual(resp.status_code, 404)
+
+    def test_toggle_like(self):
+        Like.query.delete()
+        db.session.commit()
+
+        with app.test_client() as client:
+            do_login(client, self.user.id)
+
+            for likes, like_count in [(True, 1), (False, 0), (True, 1)]:
+                resp = client.post(
+                    "/api/like/toggle",
+                    data=json.dumps({"cafe_id": self.cafe_id}),
+                    content_type='application/json'
+                )
+                self.assertEqual(
+                    resp.json, {"likes": likes, "like_count": like_count})
+
+            self.assertTrue(self.user.likes_cafe(self.cafe_id))
+            self.assertEqual(Cafe.reconcile_like_counts(), 0)
+
+
+class RecommendationsTestCase(TestCase):
+    """Tests for co-like recommendations."""
+
+    LIKES = [(1, 10), (1, 20), (2, 10), (2, 20), (2, 30), (3, 30), (3, 40)]
+
+    def test_bulk_counts(self):
+        counts, rows = recommendations._co_like_counts_python(self.LIKES)
+        self.assertEqual(counts, {10: 2, 20: 2, 30: 2, 40: 1})
+        self.assertEqual(rows[10], {20: 2, 30: 1})
+
+        if recommendations.sparse is not None:
+            self.assertEqual(
+                recommendations._co_like_counts_sparse(self.LIKES),
+                (counts, rows))
+
+        with mock.patch.object(recommendations, 'sparse', None):
+            self.assertEqual(
+                recommendations.co_like_counts(self.LIKES), (counts, rows))
+
+    def test_similar_and_suggest(self):
+        index = recommendations.CoLikeIndex(lambda: self.LIKES)
+
+        self.assertEqual(index.similar(10, 2), [20, 30])
+        self.assertEqual(index.suggest(1, 5), [30])
+        self.assertEqual(index.suggest(99, 5), [])
+
+    def test_incremental_matches_rebuild(self):
+        likes = list(self.LIKES)
+        index = recommendations.CoLikeIndex(lambda: likes)
+        index.similar(10, 3)
+
+        index.add(4, 40)
+        index.add(4, 10)
+        index.remove(2, 20)
+        likes[:] = [like for like in likes if like != (2, 20)]
+        likes += [(4, 40), (4, 10)]
+
+        rebuilt = recommendations.CoLikeIndex(lambda: likes)
+        for cafe_id in [10, 20, 30, 40]:
+            self.assertEqual(
+                index.similar(cafe_id, 3), rebuilt.similar(cafe_id, 3))
+        self.assertEqual(index.suggest(1, 3), rebuilt.suggest(1, 3))
+
+    def test_reloads_in_background(self):
+        likes = list(self.LIKES)
+        loading = threading.Event()
+        release = threading.Event()
+
+        def loader():
+            if loading.is_set():
+                release.wait(5)
+            return list(likes)
+
+        index = recommendations.CoLikeIndex(loader, ttl=0.01)
+        self.assertEqual(index.similar(40, 3), [30])
+
+        # another process's likes
+        likes += [(4, 40), (4, 10)]
+        time.sleep(0.02)
+        loading.set()
+
+        # expired: answers from the old matrix, without waiting
+        started = time.monotonic()
+        self.assertEqual(index.similar(40, 3), [30])
+        self.assertLess(time.monotonic() - started, 1)
+
+        # made while the reload's reading, so not in what it reads
+        index.add(5, 40)
+        index.add(5, 20)
+        index.ttl = 600
+        release.set()
+        for thread in threading.enumerate():
+            if thread.name == 'co-likes-reload':
+                thread.join(5)
+
+        rebuilt = recommendations.CoLikeIndex(
+            lambda: likes + [(5, 40), (5, 20)])
+        for cafe_id in [10, 20, 30, 40]:
+            self.assertEqual(
+                index.similar(cafe_id, 3), rebuilt.similar(cafe_id, 3))
+
+
+#######################################
+# read replicas
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for sending reads to replica databases."""
+
+    def setUp(self):
+        """Add a cafe to the primary, and a differently-named copy of it to
+        each of two SQLite replicas."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        user = User.register(**TEST_USER_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add_all([user, cafe])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica1': f"sqlite:///{self.tmpdir.name}/replica1.db",
+            'replica2': f"sqlite:///{self.tmpdir.name}/replica2.db",
+            'broken': f"sqlite:///{self.tmpdir.name}/missing/replica.db",
+        }
+        app.config['READ_REPLICAS'] = ['replica1', 'replica2']
+        app.config['READ_REPLICA_CHECK_INTERVAL'] = 0
+
+        for key in ['replica1', 'replica2']:
+            engine = db.get_engine(app, bind=key)
+            db.Model.metadata.create_all(engine)
+            engine.execute(City.__table__.insert(), CITY_DATA)
+            engine.execute(
+                Cafe.__table__.insert(),
+                dict(CAFE_DATA, id=self.cafe_id, name=f"Cafe on {key}"),
+            )
+
+    def tearDown(self):
+        """Go back to the primary alone, and remove test data."""
+
+        for key in ['replica1', 'replica2']:
+            db.get_engine(app, bind=key).dispose()
+        app.config['SQLALCHEMY_BINDS'] = None
+        app.config['READ_REPLICAS'] = []
+        self.tmpdir.cleanup()
+
+        Like.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def detail_name(self, client):
+        html = client.get(f"/cafes/{self.cafe_id}").data.decode('utf8')
+        return re.search(r'<h1[^>]*>\s*(.*?)\s*</h1>', html).group(1)
+
+    def test_reads_take_turns_on_replicas(self):
+        with app.test_client() as client:
+            names = {self.detail_name(client) for _ in range(4)}
+        self.assertEqual(names, {"Cafe on replica1", "Cafe on replica2"})
+
+    def test_writer_reads_from_primary(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            resp = client.post(
+                "/api/like",
+                data=json.dumps({"cafe_id": self.cafe_id}),
+                content_type='application/json'
+            )
+            self.assertEqual(resp.json["like_count"], 1)
+            self.assertEqual(self.detail_name(client), "Test Cafe")
+
+        with app.test_client() as client:
+            self.assertIn("replica", self.detail_name(client))
+
+    def test_only_orm_selects_use_replicas(self):
+        with app.test_request_context():
+            db.session.info.clear()
+            self.assertIn("replica", Cafe.query.get(self.cafe_id).name)
+
+            db.session.info.clear()
+            self.assertEqual(db.session.execute(
+                text("SELECT name FROM cafes")).scalar(), "Test Cafe")
+
+            db.session.info.clear()
+            self.assertEqual(db.session.connection().execute(
+                text("SELECT name FROM cafes")).scalar(), "Test Cafe")
+
+            db.session.rollback()
+            db.session.info.clear()
+
+    def test_unhealthy_replica(self):
+        app.config['READ_REPLICAS'] = ['broken', 'replica1']
+        with app.test_client() as client:
+            for _ in range(2):
+                self.assertEqual(
+                    self.detail_name(client), "Cafe on replica1")
+
+        app.config['READ_REPLICAS'] = ['broken']
+        with app.test_client() as client:
+            self.assertEqual(self.detail_name(client), "Test Cafe")
+
+
+class LikeBufferTestCase(TestCase):
+    """Tests for write-behind likes."""
+
+    def setUp(self):
+        """Add a city, user and cafe, and buffer likes to a temp file."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        user = User.register(**TEST_USER_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add_all([user, cafe])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = f"{self.tmpdir.name}/likes.log"
+        self.buffer = likebuffer.LikeBuffer(self.path)
+        app.extensions['like_buffer'] = self.buffer
+
+    def tearDown(self):
+        """Stop buffering, and remove test data."""
+
+        del app.extensions['like_buffer']
+        self.tmpdir.cleanup()
+
+        Like.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def post(self, client, url, cafe_id):
+        return client.post(
+            url,
+            data=json.dumps({"cafe_id": cafe_id}),
+            content_type='application/json'
+        )
+
+    def test_pending_like_is_seen(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = self.post(client, "/api/like", self.cafe_id)
+            self.assertEqual(
+                resp.json,
+                {"liked": self.cafe_id, "likes": True, "like_count": 1})
+            self.assertEqual(Like.query.count(), 0)
+
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+            resp = client.get(f"/api/likes?cafe_ids={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": {str(self.cafe_id): True}})
+
+            html = client.get(f"/cafes/{self.cafe_id}").data.decode('utf8')
+            self.assertIn('<span id="like-count">1</span>', html)
+
+        self.assertEqual(self.buffer.flush(write_buffered_likes), 1)
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(Cafe.query.get(self.cafe_id).like_count, 1)
+        self.assertEqual(self.buffer.pending_for(self.user_id), {})
+
+    def test_writes_coalesce(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            self.post(client, "/api/like", self.cafe_id)
+            resp = self.post(client, "/api/unlike", self.cafe_id)
+            self.assertEqual(resp.json["like_count"], 0)
+            resp = self.post(client, "/api/like/toggle", self.cafe_id)
+            self.assertEqual(resp.json, {"likes": True, "like_count": 1})
+
+            resp = self.post(client, "/api/like/toggle", 0)
+            self.assertEqual(resp.status_code, 404)
+
+        with open(self.path, 'rb') as log:
+            self.assertEqual(len(log.readlines()), 4)
+
+        self.assertEqual(self.buffer.flush(write_buffered_likes), 1)
+        self.assertEqual(Like.query.count(), 1)
+
+        with open(self.path, 'rb') as log:
+            self.assertEqual(len(log.readlines()), 1)
+
+    def test_log_replayed(self):
+        """A log left by another process is read and flushed; operations
+        for missing cafes, and a torn last line, are skipped."""
+
+        with open(self.path, 'wb') as log:
+            log.write(b"flaskcafe-likes before\n")
+            log.write(f"{self.user_id} {self.cafe_id} 1\n".encode())
+            log.write(f"{self.user_id} 0 1\n".encode())
+            log.write(f"{self.user_id} {self.cafe_id} 0".encode())
+
+        restarted = likebuffer.LikeBuffer(self.path)
+        self.assertEqual(
+            restarted.pending_for(self.user_id), {self.cafe_id: True, 0: True})
+
+        self.assertEqual(restarted.flush(write_buffered_likes), 2)
+        self.assertEqual(
+            [(like.user_id, like.cafe_id) for like in Like.query],
+            [(self.user_id, self.cafe_id)])
+
+        # the first buffer sees that the log was flushed
+        self.assertEqual(self.buffer.pending_for(self.user_id), {})
+
+    def test_logging_during_flush(self):
+        """The log isn't locked while a flush writes: likes are logged, and
+        those being written are still pending, meanwhile. A failed write
+        is tried again first."""
+
+        self.buffer.record(1, 10, 'add', lambda: False)
+
+        def failing_write(operations):
+            # another process
+            other = likebuffer.LikeBuffer(self.path)
+            other.record(1, 20, 'add', lambda: False)
+            self.assertEqual(other.pending_for(1), {10: True, 20: True})
+            raise RuntimeError("database is down")
+
+        with self.assertRaises(RuntimeError):
+            self.buffer.flush(failing_write)
+        self.assertEqual(self.buffer.pending_for(1), {10: True, 20: True})
+
+        written = []
+        self.assertEqual(self.buffer.flush(written.append), 2)
+        self.assertEqual(written, [{(1, 10): True}, {(1, 20): True}])
+        self.assertEqual(self.buffer.pending_for(1), {})
+
+    def test_stored_state_read_locked(self):
+        """No flush can commit between reading the likes table and logging
+        the op that depends on it."""
+
+        def read_stored():
+            with open(f"{self.path}.lock", 'a+b') as lock:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+
+        self.assertEqual(
+            self.buffer.record(1, 10, 'toggle', read_stored), (True, True))
+        self.assertIsNone(self.buffer.record(1, 0, 'add', lambda: None))
+        self.assertEqual(self.buffer.pending_for(1), {10: True})
+
+
+#######################################
+# load test harness
+
+
+class LoadTestReportTestCase(TestCase):
+    """Tests for load test result summaries."""
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([7], 95), 7)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_summarize(self):
+        samples = [
+            ("GET /cafes", 200, 0.010, 1),
+            ("GET /cafes", 200, 0.030, 3),
+            ("POST /api/like", 500, 0.020, None),
+        ]
+        results = loadtest.summarize(samples, 2)
+
+        cafes = results["endpoints"]["GET /cafes"]
+        self.assertEqual(cafes["requests"], 2)
+        self.assertEqual(cafes["rps"], 1)
+        self.assertEqual(cafes["p50_ms"], 10)
+        self.assertEqual(cafes["queries_per_request"], 2)
+        self.assertEqual(results["totals"]["errors"], 1)
+        self.assertIsNone(
+            results["endpoints"]["POST /api/like"]["queries_per_request"])
+
+
+#######################################
+# seed script
+
+
+class SeedTestCase(TestCase):
+    """Tests for the seed script."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'seed.db')
+
+    def run_seed(self):
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{self.path}')
+        return subprocess.run(
+            [sys.executable, 'seed.py'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=120,
+        )
+
+    def test_seed(self):
+        result = self.run_seed()
+        self.assertEqual(result.returncode, 0, result.stderr.decode('utf8'))
+
+        with sqlite3.connect(self.path) as conn:
+            users = conn.execute(
+                'SELECT username FROM users ORDER BY username').fetchall()
+            cafes = conn.execute('SELECT COUNT(*) FROM cafes').fetchone()
+
+            like_counts = conn.execute(
+                'SELECT like_count FROM cafes ORDER BY id').fetchall()
+            rollups = conn.execute(
+                'SELECT SUM(likes) FROM cafe_like_rollups'
+                ' GROUP BY granularity').fetchall()
+
+        self.assertEqual(users, [('admin',), ('test',)])
+        self.assertEqual(cafes, (2,))
+        self.assertEqual(like_counts, [(2,), (1,)])
+        self.assertTrue(rollups)
+        self.assertEqual(set(rollups), {(3,)})
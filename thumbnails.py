@@ -0,0 +1,368 @@
+"""Image thumbnails for Flask Cafe.
+
+Cafes and users have an image_url, often a full-size original on another
+site. When one is saved, ThumbnailMaker fetches it (with a pluggable
+fetcher) in a small thread pool and writes fixed-size WebP and JPEG
+thumbnails of it, for each of SIZES, to THUMBNAIL_DIR. Their names come
+from a hash of the source image, so a file never changes once written and
+can be cached forever; the hash is stored on the row, and templates build
+the thumbnail URLs from it (falling back to image_url until it's set).
+
+Settings come from the app's config:
+
+- THUMBNAIL_FETCHER: 'url' (fetch_url), a callable taking a URL and a
+  byte limit and returning the image's bytes, or None to make no
+  thumbnails (default 'url')
+- THUMBNAIL_DIR: where thumbnails are written (default
+  instance/thumbnails)
+- THUMBNAIL_POOL_SIZE: worker threads; 0 makes thumbnails inline
+  (default 2)
+- THUMBNAIL_QUEUE_DEPTH: most images being made or waiting in this
+  process; more are skipped, for `flask make-thumbnails` to catch up
+  (default 32)
+- THUMBNAIL_MAX_SOURCE_BYTES: largest source image fetched (default 20MB)
+"""
+
+
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse, urlsplit
+
+import requests
+import urllib3
+from flask import current_app
+from werkzeug.security import safe_join
+from PIL import Image, ImageOps
+
+
+logger = logging.getLogger('flaskcafe.thumbnails')
+
+# name: (width, height, crop); cropped thumbnails fill the box exactly,
+# others fit inside it
+SIZES = {
+    'card': (400, 300, True),
+    'page': (600, 600, False),
+}
+
+# extension: (Pillow format, save options)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# bump when SIZES, FORMATS or render change, so old names aren't reused
+VERSION = 1
+
+NAME_RE = re.compile(r'^[0-9a-f]{24}-[a-z]+\.[a-z]+$')
+
+# fetch_url follows at most this many redirects, checking each one
+MAX_REDIRECTS = 3
+REDIRECTS = {301, 302, 303, 307, 308}
+
+
+class ThumbnailError(Exception):
+    """Raised when an image can't be fetched or read."""
+
+
+def public_address(host, port):
+    """Return an IP address of host, if every address it resolves to is
+    public: not loopback, private, link-local, reserved or multicast.
+    Raises ThumbnailError otherwise, so users' image URLs can't make the
+    server fetch from inside its own network."""
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = [ipaddress.ip_address(info[4][0]) for info in infos]
+    except (OSError, UnicodeError, ValueError) as exc:
+        raise ThumbnailError(f"Can't resolve {host}: {exc}") from exc
+
+    for address in addresses:
+        address = getattr(address, 'ipv4_mapped', None) or address
+        if not address.is_global or address.is_multicast:
+            raise ThumbnailError(f'{host} is not a public address')
+
+    return addresses[0]
+
+
+def _get_public(url):
+    """Start a GET of url, an http(s) URL on a public host, connected to
+    the address public_address checked; the caller reads and releases the
+    response. Redirects aren't followed."""
+
+    parts = urlsplit(url)
+    try:
+        port = parts.port
+    except ValueError as exc:
+        raise ThumbnailError(f'Bad URL {url}: {exc}') from exc
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ThumbnailError(f'{url} is not an http(s) URL')
+
+    https = parts.scheme == 'https'
+    port = port or (443 if https else 80)
+    address = str(public_address(parts.hostname, port))
+
+    if https:
+        # the certificate is checked against the host, not the address
+        pool = urllib3.HTTPSConnectionPool(
+            address,
+            port,
+            server_hostname=parts.hostname,
+            assert_hostname=parts.hostname,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=requests.certs.where(),
+            timeout=10,
+            retries=False,
+        )
+    else:
+        pool = urllib3.HTTPConnectionPool(
+            address, port, timeout=10, retries=False)
+
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    return pool.urlopen(
+        'GET',
+        path,
+        headers={'Host': parts.netloc.rpartition('@')[2]},
+        redirect=False,
+        preload_content=False,
+    )
+
+
+def fetch_url(url, max_bytes):
+    """Return the bytes of the image at url: a file under the app's static
+    folder if url is site-relative ("/static/..."), else fetched over
+    HTTP(S) from a public address (see public_address), checking every
+    redirect the same way."""
+
+    if url.startswith('/'):
+        path = urlparse(url).path
+        prefix = current_app.static_url_path + '/'
+        if not path.startswith(prefix):
+            raise ThumbnailError(f'{url} is not a static file')
+        return LocalFileFetcher(current_app.static_folder)(
+            path[len(prefix):], max_bytes)
+
+    for _ in range(MAX_REDIRECTS + 1):
+        try:
+            response = _get_public(url)
+        except urllib3.exceptions.HTTPError as exc:
+            raise ThumbnailError(f"Couldn't fetch {url}: {exc}") from exc
+
+        try:
+            if response.status in REDIRECTS and \
+                    response.headers.get('Location'):
+                url = urljoin(url, response.headers['Location'])
+                continue
+            if response.status != 200:
+                raise ThumbnailError(
+                    f"Couldn't fetch {url}: HTTP {response.status}")
+
+            data = bytearray()
+            for chunk in response.stream(64 * 1024):
+                data += chunk
+                if len(data) > max_bytes:
+                    raise ThumbnailError(f'{url} is over {max_bytes} bytes')
+            return bytes(data)
+
+        except urllib3.exceptions.HTTPError as exc:
+            raise ThumbnailError(f"Couldn't fetch {url}: {exc}") from exc
+        finally:
+            response.release_conn()
+
+    raise ThumbnailError(f'{url}: more than {MAX_REDIRECTS} redirects')
+
+
+class LocalFileFetcher:
+    """Fetcher reading each URL's path from under root, ignoring its scheme
+    and host: a stand-in for fetch_url in tests and offline."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __call__(self, url, max_bytes):
+        path = safe_join(self.root, urlparse(url).path.lstrip('/'))
+        if path is None or not os.path.isfile(path):
+            raise ThumbnailError(f'No file for {url}')
+        if os.path.getsize(path) > max_bytes:
+            raise ThumbnailError(f'{url} is over {max_bytes} bytes')
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+FETCHERS = {
+    'url': fetch_url,
+}
+
+
+def image_key(data):
+    """Return the hash naming the thumbnails of source image data."""
+
+    digest = hashlib.sha256(f'thumbnails v{VERSION}\n'.encode('ascii'))
+    digest.update(data)
+    return digest.hexdigest()[:24]
+
+
+def thumbnail_name(key, size, ext):
+    """Return the file name of the size thumbnail, in format ext, for
+    image_key key."""
+
+    return f'{key}-{size}.{ext}'
+
+
+def render(data):
+    """Return {(size, ext): bytes} of every thumbnail of image data."""
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ThumbnailError(f"Can't read image: {exc}") from exc
+
+    rendered = {}
+    for size, (width, height, crop) in SIZES.items():
+        if crop:
+            thumb = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            thumb = image.copy()
+            thumb.thumbnail((width, height), Image.LANCZOS)
+
+        for ext, (fmt, options) in FORMATS.items():
+            out = io.BytesIO()
+            thumb.save(out, fmt, **options)
+            rendered[(size, ext)] = out.getvalue()
+
+    return rendered
+
+
+def make(url, fetch, directory, max_bytes):
+    """Fetch the image at url and write its thumbnails to directory, unless
+    they're there already. Returns its image_key."""
+
+    data = fetch(url, max_bytes)
+    key = image_key(data)
+
+    names = {
+        (size, ext): thumbnail_name(key, size, ext)
+        for size in SIZES for ext in FORMATS
+    }
+    if all(os.path.exists(os.path.join(directory, name))
+           for name in names.values()):
+        return key
+
+    os.makedirs(directory, exist_ok=True)
+    for size_ext, thumb in render(data).items():
+        # write then rename, so a thumbnail is never seen half-written
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(thumb)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, os.path.join(directory, names[size_ext]))
+
+    return key
+
+
+class ThumbnailMaker:
+    """Makes thumbnails in a bounded thread pool, per the app's config."""
+
+    def __init__(self):
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def directory(app):
+        return app.config.get('THUMBNAIL_DIR') or \
+            os.path.join(app.instance_path, 'thumbnails')
+
+    @staticmethod
+    def fetcher(app):
+        fetcher = app.config.get('THUMBNAIL_FETCHER', 'url')
+        return FETCHERS.get(fetcher, fetcher)
+
+    def _get_pool(self, app):
+        """Return (pool, slots) for this process, starting it if needed;
+        see PasswordHasher._get_pool."""
+
+        with self._lock:
+            if self._pid != os.getpid():
+                size = app.config.get('THUMBNAIL_POOL_SIZE', 2)
+                depth = app.config.get('THUMBNAIL_QUEUE_DEPTH', 32)
+                self._pool = ThreadPoolExecutor(
+                    size, thread_name_prefix='thumbnails') if size else None
+                self._slots = threading.BoundedSemaphore(depth)
+                self._pid = os.getpid()
+            return self._pool, self._slots
+
+    def make_now(self, url):
+        """Make url's thumbnails in this thread; return its image_key, or
+        None if there's no fetcher configured."""
+
+        app = current_app
+        fetch = self.fetcher(app)
+        if not fetch or not url:
+            return None
+
+        return make(
+            url,
+            fetch,
+            self.directory(app),
+            app.config.get('THUMBNAIL_MAX_SOURCE_BYTES', 20 * 1024 * 1024),
+        )
+
+    def submit(self, url, save):
+        """Make url's thumbnails in the pool, then call save(image_key) in
+        an app context. Returns False if there's no room in the queue, or
+        nothing to do.
+
+        Failures are logged, not raised: the page just keeps showing the
+        original image.
+        """
+
+        app = current_app._get_current_object()
+        if not self.fetcher(app) or not url:
+            return False
+
+        pool, slots = self._get_pool(app)
+        if not slots.acquire(blocking=False):
+            logger.warning('thumbnail queue full; skipping %s', url)
+            return False
+
+        def work():
+            try:
+                save(self.make_now(url))
+            except ThumbnailError as exc:
+                logger.warning('no thumbnails for %s: %s', url, exc)
+            except Exception:
+                logger.exception('making thumbnails for %s failed', url)
+            finally:
+                slots.release()
+
+        def run():
+            with app.app_context():
+                work()
+
+        if pool is None:
+            work()
+        else:
+            pool.submit(run)
+        return True
+
+    def shutdown(self):
+        """Wait for, then stop, this process's pool, if it has one."""
+
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+            self._pid = None
@@ -0,0 +1,46 @@
+"""Production entry point for Flask Cafe.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn.conf.py preloads this module in the master process and forks the
+workers from it, so the imports, the app and its compiled templates are
+built once and shared copy-on-write. Boot times go to the
+"flaskcafe.boot" log.
+"""
+
+import time
+
+_started = time.monotonic()
+
+import logging
+import os
+
+from app import create_app
+from models import db
+
+
+logger = logging.getLogger('flaskcafe.boot')
+
+
+def warm_up(app):
+    """Do the app's lazy start-up work now, before workers are forked:
+    compile every template."""
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def after_fork(app):
+    """Drop any database connections the worker inherited; they belong to
+    the master."""
+
+    binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
+    for bind in binds:
+        db.get_engine(app, bind=bind).dispose()
+
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+warm_up(app)
+
+boot_seconds = time.monotonic() - _started
+logger.info('app loaded in %.0f ms', boot_seconds * 1000)